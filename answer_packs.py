@@ -0,0 +1,201 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+from .metrics import METRICS
+from .semantic_cache import normalize_text
+
+# File pack: header | câu trả lời (zlib) | index sắp xếp theo key | metadata JSON
+# header: magic, version, count, data_offset, index_offset, meta_offset, meta_length
+MAGIC = b"GAPK"
+VERSION = 2
+HEADER = struct.Struct("<4sIQQQQQ")
+# entry của index: key (16 byte đầu của sha1), offset trong file, độ dài
+ENTRY = struct.Struct("<16sQI4x")
+KEY_SIZE = 16
+PACK_SUFFIX = ".gapk"
+
+
+def pack_key(namespace, content):
+    """Key của một câu trả lời: hash của CardPrompt.pack_namespace (prompt key,
+    template, system context) + nội dung card đã chuẩn hoá."""
+    raw = namespace + "\x1f" + normalize_text(content)
+    return hashlib.sha1(raw.encode("utf-8")).digest()[:KEY_SIZE]
+
+
+class PackError(ValueError):
+    """File không phải answer pack hợp lệ."""
+
+
+def write_pack(path, entries, meta=None):
+    """Ghi answer pack từ entries [(pack_namespace, content, answer)] → số câu trả lời.
+
+    Key trùng thì giữ câu trả lời sau cùng. File được ghi ra file tạm rồi đổi
+    tên nên pack đang được dùng không bao giờ bị đọc dở.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        count = _write_entries(tmp_path, entries, meta)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+def _write_entries(tmp_path, entries, meta):
+    index = {}
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        for namespace, content, answer in entries:
+            if not namespace or not answer or not (content or "").strip():
+                continue
+            blob = zlib.compress(answer.encode("utf-8"))
+            index[pack_key(namespace, content)] = (f.tell(), len(blob))
+            f.write(blob)
+        index_offset = f.tell()
+        for key in sorted(index):
+            offset, length = index[key]
+            f.write(ENTRY.pack(key, offset, length))
+        meta = dict(meta or {}, entries=len(index), created=int(time.time()), version=VERSION)
+        meta_blob = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        meta_offset = f.tell()
+        f.write(meta_blob)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(index), HEADER.size, index_offset, meta_offset, len(meta_blob)))
+    return len(index)
+
+
+class AnswerPack:
+    """Answer pack chỉ đọc, memory-mapped.
+
+    Mở pack chỉ đọc header (không phụ thuộc số entry); tra cứu là binary
+    search trên index trong mmap, nên chỉ vài trang của file được đọc.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise PackError("empty file")
+        if len(self.mm) < HEADER.size:
+            self.close()
+            raise PackError("file too small")
+        magic, version, count, _, index_offset, meta_offset, meta_length = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise PackError("not an answer pack (or unsupported version)")
+        if index_offset + count * ENTRY.size > len(self.mm) or meta_offset + meta_length > len(self.mm):
+            self.close()
+            raise PackError("truncated file")
+        self.count = count
+        self.index_offset = index_offset
+        self.meta_offset = meta_offset
+        self.meta_length = meta_length
+
+    @property
+    def meta(self):
+        try:
+            return json.loads(self.mm[self.meta_offset:self.meta_offset + self.meta_length])
+        except ValueError:
+            return {}
+
+    def _key_at(self, i):
+        start = self.index_offset + i * ENTRY.size
+        return self.mm[start:start + KEY_SIZE]
+
+    def lookup(self, key):
+        """Câu trả lời cho key (bytes), hoặc None (kể cả khi entry hỏng: pack là của người khác)."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._key_at(lo) != key:
+            return None
+        _, offset, length = ENTRY.unpack_from(self.mm, self.index_offset + lo * ENTRY.size)
+        if offset + length > len(self.mm):
+            METRICS.incr("packs.corrupt")
+            return None
+        try:
+            return zlib.decompress(self.mm[offset:offset + length]).decode("utf-8")
+        except (zlib.error, UnicodeDecodeError):
+            METRICS.incr("packs.corrupt")
+            return None
+
+    def close(self):
+        self.mm.close()
+
+
+class AnswerPackShelf:
+    """Các pack đã import (thư mục packs trong user_files): tầng cache chỉ đọc
+    đứng sau response cache của máy và trước Gemini API."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.packs = [] # Pack import sau cùng đứng đầu (được tra trước)
+        os.makedirs(directory, exist_ok=True)
+        paths = [os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(PACK_SUFFIX)]
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            try:
+                self.packs.append(AnswerPack(path))
+            except (OSError, PackError):
+                # Pack hỏng không làm hỏng các pack còn lại
+                pass
+
+    def get(self, card_prompt):
+        """Câu trả lời cho CardPrompt từ pack đầu tiên có nó, hoặc None."""
+        namespace = card_prompt.pack_namespace
+        if not self.packs or namespace is None:
+            return None
+        key = pack_key(namespace, card_prompt.content)
+        for pack in self.packs:
+            answer = pack.lookup(key)
+            if answer is not None:
+                METRICS.incr("packs.hits")
+                return answer
+        METRICS.incr("packs.misses")
+        return None
+
+    def import_pack(self, source):
+        """Kiểm tra rồi chép pack vào thư mục packs → AnswerPack.
+
+        Không ghi đè file đang được mmap: pack trùng tên được lưu với tên mới
+        và đứng trước pack cũ.
+        """
+        AnswerPack(source).close()
+        base = os.path.basename(source)
+        if base.endswith(PACK_SUFFIX):
+            base = base[:-len(PACK_SUFFIX)]
+        with self.lock:
+            target = os.path.join(self.directory, base + PACK_SUFFIX)
+            counter = 2
+            while os.path.exists(target):
+                target = os.path.join(self.directory, f"{base}-{counter}{PACK_SUFFIX}")
+                counter += 1
+            shutil.copyfile(source, target)
+            pack = AnswerPack(target)
+            # Gán list mới: thread đang tra cứu vẫn dùng list cũ an toàn
+            self.packs = [pack] + self.packs
+        return pack
+
+    def close(self):
+        with self.lock:
+            for pack in self.packs:
+                pack.close()
+            self.packs = []
@@ -0,0 +1,181 @@
+import json
+
+from .gemini_client import GeminiError, extract_text, finish_reason
+from .tracing import TRACER
+
+# Schema cho structured output: mảng {card_id, answer}
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "card_id": {"type": "STRING"},
+            "answer": {"type": "STRING"},
+        },
+        "required": ["card_id", "answer"],
+    },
+}
+
+BATCH_INSTRUCTION = (
+    "Apply the instruction template below to EACH item of the JSON list that follows. "
+    "The placeholder {text} in the template stands for the item's \"text\"; other "
+    "placeholders like {Name} stand for the line \"Name: ...\" of the item's \"text\". "
+    "Answer every item independently and return a JSON array with one object "
+    "{\"card_id\": <item card_id>, \"answer\": <answer>} per item.\n\n"
+    "Instruction template:\n"
+)
+
+# Ước lượng thô: ~4 ký tự / token
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class BatchItem:
+    """Một card cần sinh câu trả lời trong bulk job."""
+
+    def __init__(self, card_id, text):
+        self.card_id = str(card_id)
+        self.text = text
+        self.attempts = 0
+
+
+class AdaptiveBatcher:
+    """Gộp K card cùng prompt vào một request generateContent.
+
+    K thay đổi theo kiểu AIMD: tăng 1 sau mỗi batch thành công trọn vẹn,
+    giảm một nửa khi output bị cắt (MAX_TOKENS) hoặc JSON không hợp lệ.
+    Chỉ những item lỗi mới được đưa lại vào hàng đợi.
+    """
+
+    def __init__(self, client, max_batch=20, max_attempts=3,
+                 max_output_tokens=8192, max_input_tokens=32000, deck_id=None, prompt_key=None,
+                 cancel_token=None):
+        self.client = client
+        self.cancel_token = cancel_token
+        self.deck_id = deck_id
+        self.prompt_key = prompt_key
+        self.max_batch = max(1, max_batch)
+        self.max_attempts = max_attempts
+        self.max_output_tokens = max_output_tokens
+        self.max_input_tokens = max_input_tokens
+        self.batch_size = min(4, self.max_batch)
+        self.requests_sent = 0
+
+    def _per_item_output_tokens(self):
+        # Mỗi câu trả lời tối đa max_tokens như request đơn lẻ, cộng overhead JSON
+        max_tokens = self.client.profile(self.deck_id).max_tokens or self.client.get_config().get("max_tokens", 500)
+        return max_tokens + 20
+
+    def _take_batch(self, queue, template):
+        """Lấy tối đa K item từ đầu hàng đợi sao cho vừa ngân sách token."""
+        per_item_out = self._per_item_output_tokens()
+        limit = min(self.batch_size, max(1, self.max_output_tokens // per_item_out))
+        input_tokens = estimate_tokens(BATCH_INSTRUCTION + template)
+        batch = []
+        while queue and len(batch) < limit:
+            cost = estimate_tokens(queue[0].text) + 10
+            if batch and input_tokens + cost > self.max_input_tokens:
+                break
+            input_tokens += cost
+            batch.append(queue.pop(0))
+        return batch
+
+    def build_payload(self, template, batch):
+        items = [{"card_id": item.card_id, "text": item.text} for item in batch]
+        prompt = BATCH_INSTRUCTION + template + "\n\nItems:\n" + json.dumps(items, ensure_ascii=False)
+        # Model và thinking budget theo latency profile của deck (bulk không fallback)
+        thinking_budget = self.client.profile(self.deck_id).thinking_budget
+        options = {} if thinking_budget is None else {"thinkingConfig": {"thinkingBudget": thinking_budget}}
+        return self.client.build_payload(
+            prompt,
+            max_tokens=min(self.max_output_tokens, self._per_item_output_tokens() * len(batch))
+                       + (thinking_budget or 0),
+            responseMimeType="application/json",
+            responseSchema=BATCH_RESPONSE_SCHEMA,
+            **options
+        )
+
+    @staticmethod
+    def parse_answers(result, batch):
+        """Validate kết quả, trả về {card_id: answer} cho các item hợp lệ."""
+        expected = {item.card_id for item in batch}
+        data = json.loads(extract_text(result))
+        if not isinstance(data, list):
+            raise ValueError("batch response is not a JSON array")
+        answers = {}
+        for entry in data:
+            if not isinstance(entry, dict):
+                continue
+            card_id = str(entry.get("card_id", ""))
+            answer = entry.get("answer")
+            if card_id in expected and isinstance(answer, str) and answer.strip():
+                answers[card_id] = answer.strip()
+        return answers
+
+    def _shrink(self):
+        self.batch_size = max(1, self.batch_size // 2)
+
+    def _grow(self):
+        self.batch_size = min(self.max_batch, self.batch_size + 1)
+
+    def run(self, template, items, on_result, on_failed=None, should_stop=None):
+        """Chạy toàn bộ items.
+
+        on_result(card_id, answer) được gọi cho mỗi item thành công,
+        on_failed(card_id, error) cho item hết lượt thử. Khi mất mạng, thiếu
+        API key, Gemini không khả dụng (circuit breaker mở) hoặc hết ngân sách
+        token, mọi item còn lại thất bại ngay với error = GeminiError.kind.
+        Khi cancel_token bị huỷ thì dừng ngay, item còn lại không bị tính là lỗi.
+        """
+        queue = list(items)
+        while queue:
+            if should_stop and should_stop():
+                return
+            batch = self._take_batch(queue, template)
+            payload = self.build_payload(template, batch)
+            self.requests_sent += 1
+
+            answers = {}
+            error = ""
+            try:
+                with TRACER.span("bulk.batch", "scheduler", size=len(batch)):
+                    result = self.client.generate(payload, deck_id=self.deck_id, prompt_key=self.prompt_key,
+                                                  cancel_token=self.cancel_token, request_class="bulk")
+                truncated = finish_reason(result) == "MAX_TOKENS"
+                answers = self.parse_answers(result, batch)
+                if truncated or len(answers) < len(batch):
+                    self._shrink()
+                else:
+                    self._grow()
+            except GeminiError as e:
+                if e.kind == "cancelled":
+                    return
+                error = str(e) or e.kind
+                if e.kind in ("api_key_missing", "network", "unavailable", "budget"):
+                    # Client đã retry; thử tiếp chỉ tốn thời gian
+                    for item in batch + queue:
+                        if on_failed:
+                            on_failed(item.card_id, e.kind)
+                    return
+                self._shrink()
+            except ValueError as e:
+                # JSON hỏng, thường do output bị cắt
+                error = str(e)
+                self._shrink()
+
+            failed = []
+            for item in batch:
+                if item.card_id in answers:
+                    on_result(item.card_id, answers[item.card_id])
+                    continue
+                item.attempts += 1
+                if item.attempts >= self.max_attempts:
+                    if on_failed:
+                        on_failed(item.card_id, error or "missing from batch response")
+                else:
+                    failed.append(item)
+            # Item lỗi được thử lại trước, trong batch nhỏ hơn
+            queue[:0] = failed
@@ -0,0 +1,129 @@
+import json
+
+from aqt.qt import QTimer
+
+from .metrics import METRICS
+
+# Phiên bản protocol JS ↔ Python; tăng khi đổi format message hoặc DOM op
+PROTOCOL_VERSION = 3
+PREFIX = "gemini:"
+
+# Runtime phía webview: gửi message JSON có kèm dữ liệu, áp dụng batch DOM op
+BRIDGE_JS = """
+(function() {
+    if (window.geminiBridge && window.geminiBridge.v === %(version)d) return;
+    var lastSend = 0;
+    window.geminiBridge = {
+        v: %(version)d,
+        post: function(type, data) {
+            var msg = Object.assign({v: %(version)d, type: type}, data || {});
+            pycmd('%(prefix)s' + JSON.stringify(msg));
+        },
+        // Gửi nội dung ô input cùng message (không cần Python đọc lại DOM).
+        // Enter + click (hoặc bấm Enter hai lần) trong 500 ms chỉ gửi một lần.
+        send: function() {
+            var input = document.getElementById('gemini-input-text');
+            var text = input ? input.value.trim() : '';
+            var now = Date.now();
+            if (!text || now - lastSend < 500) return;
+            lastSend = now;
+            input.value = '';
+            this.post('send', {text: text});
+        },
+        apply: function(ops) {
+            var m = document.getElementById('gemini-chat-messages');
+            var scroll = false;
+            ops.forEach(function(op) {
+                if (op.op === 'append' && m) {
+                    m.insertAdjacentHTML('beforeend', op.html);
+                    scroll = true;
+                } else if (op.op === 'prepend' && m) {
+                    var oldHeight = m.scrollHeight;
+                    m.insertAdjacentHTML('afterbegin', op.html);
+                    m.scrollTop += m.scrollHeight - oldHeight;
+                    m.dataset.hasMore = op.has_more ? '1' : '0';
+                    delete m.dataset.loading;
+                } else if (op.op === 'context' && m) {
+                    // Panel: chuyển sang transcript của note khác
+                    m.innerHTML = op.html;
+                    m.dataset.hasMore = op.has_more ? '1' : '0';
+                    delete m.dataset.loading;
+                    var field = document.getElementById('gemini-input-text');
+                    if (field) field.focus();
+                    scroll = true;
+                } else if (op.op === 'typing') {
+                    var typing = document.getElementById('gemini-typing');
+                    if (typing) typing.classList.toggle('visible', op.visible);
+                } else if (op.op === 'input') {
+                    var input = document.getElementById('gemini-input-text');
+                    if (input) input.value = op.text;
+                } else if (op.op === 'status') {
+                    var header = document.getElementById('gemini-chat-header');
+                    var status = document.getElementById('gemini-service-status');
+                    if (header) header.dataset.service = op.state;
+                    if (status) status.textContent = op.text;
+                } else if (op.op === 'hide') {
+                    var c = document.getElementById('gemini-chat-container');
+                    if (c) c.style.display = 'none';
+                }
+            });
+            if (scroll) m.scrollTop = m.scrollHeight;
+        }
+    };
+})();
+""" % {"version": PROTOCOL_VERSION, "prefix": PREFIX}
+
+
+def parse_message(message):
+    """Message JSON từ webview → dict có "type", hoặc None nếu không phải của add-on.
+
+    Message sai version hoặc hỏng trả về {"type": "invalid"} để vẫn được
+    đánh dấu là đã xử lý.
+    """
+    if not message.startswith(PREFIX):
+        return None
+    METRICS.incr("bridge.js_messages")
+    METRICS.incr("bridge.js_bytes", len(message.encode("utf-8")))
+    try:
+        data = json.loads(message[len(PREFIX):])
+    except ValueError:
+        return {"type": "invalid"}
+    if not isinstance(data, dict) or data.get("v") != PROTOCOL_VERSION or not isinstance(data.get("type"), str):
+        return {"type": "invalid"}
+    return data
+
+
+def js_call(function, *args):
+    """Câu lệnh JS gọi function với tham số đã escape bằng json.dumps."""
+    return f"{function}({', '.join(json.dumps(arg, ensure_ascii=False) for arg in args)});"
+
+
+class DomBatch:
+    """Gom các DOM op trong một vòng event loop rồi gửi bằng một lần web.eval."""
+
+    def __init__(self, get_web):
+        self.get_web = get_web # callable trả về webview hiện tại (hoặc None)
+        self.ops = []
+        self.scheduled = False
+
+    def queue(self, op, **args):
+        args["op"] = op
+        self.ops.append(args)
+        if not self.scheduled:
+            self.scheduled = True
+            QTimer.singleShot(0, self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        ops, self.ops = self.ops, []
+        if ops:
+            self.eval("if (window.geminiBridge) " + js_call("geminiBridge.apply", ops))
+
+    def eval(self, js):
+        """web.eval có đếm số lần gọi và số byte gửi sang webview."""
+        web = self.get_web()
+        if not web:
+            return
+        METRICS.incr("bridge.py_evals")
+        METRICS.incr("bridge.py_bytes", len(js.encode("utf-8")))
+        web.eval(js)
@@ -0,0 +1,195 @@
+from aqt import mw
+from aqt.qt import *
+from aqt.utils import showInfo
+
+from .batching import AdaptiveBatcher, BatchItem
+from .debug_tools import DebugTools
+from .languages import get_text
+from .metrics import METRICS
+from .prompt_templates import load_template
+from .tracing import traced
+from .transport import CancelToken
+
+
+class BulkThread(QThread):
+    """Chạy AdaptiveBatcher trong thread riêng, trả kết quả về main thread qua signal."""
+
+    result_ready = pyqtSignal(str, str)
+    item_failed = pyqtSignal(str, str)
+
+    def __init__(self, client, template, items, max_batch, deck_id=None, prompt_key=None):
+        super().__init__()
+        # Huỷ job → huỷ luôn batch đang chờ server trả lời
+        self.token = CancelToken()
+        self.batcher = AdaptiveBatcher(client, max_batch=max_batch, deck_id=deck_id,
+                                       prompt_key=prompt_key, cancel_token=self.token)
+        self.template = template
+        self.items = items
+
+    def run(self):
+        self.batcher.run(
+            self.template,
+            self.items,
+            on_result=self.result_ready.emit,
+            on_failed=self.item_failed.emit,
+            should_stop=lambda: self.token.cancelled,
+        )
+
+
+class BulkJob:
+    """Sinh câu trả lời cho toàn bộ deck và ghi vào trường output của note."""
+
+    FLUSH_EVERY = 50
+
+    def __init__(self, bot, deck_id):
+        self.bot = bot
+        self.deck_id = str(deck_id)
+        self.debug = DebugTools("BulkJob")
+        self.lang = bot.config.get("language", "vi")
+        self.settings = bot.config["deck_settings"].get(self.deck_id, {})
+        self.output_field = self.settings.get("output_field", "")
+        self.prompt_key = self.settings.get("selected_prompt") or bot.config.get("selected_prompt")
+        self.template = bot.config["custom_prompts"].get(self.prompt_key) or "Giải thích về: {text}"
+        self.card_to_note = {}
+        self.card_prompts = {}
+        self.pending = {}
+        self.done = 0
+        self.failed = 0
+        self.queued = 0
+        self.deferred = 0
+        self.thread = None
+        self.progress = None
+
+    @traced("bulk.collect", "scheduler")
+    def collect_items(self):
+        """Lấy một card cho mỗi note có trường output còn trống.
+
+        Card đã có câu trả lời trong response cache hoặc answer pack được ghi
+        luôn, không gửi API.
+        """
+        deck_ids = mw.col.decks.deck_and_child_ids(int(self.deck_id))
+        ids = ",".join(str(did) for did in deck_ids)
+        rows = mw.col.db.all(f"SELECT id, nid FROM cards WHERE did IN ({ids}) ORDER BY nid, ord")
+
+        target_field = self.settings.get("target_field", self.bot.config["target_field"])
+        items = []
+        seen = set()
+        for cid, nid in rows:
+            if nid in seen:
+                continue
+            seen.add(nid)
+            card = mw.col.get_card(cid)
+            note = card.note()
+            if self.output_field not in note or note[self.output_field].strip():
+                continue
+            text = self.bot.card_content(card, self.template, target_field, count_tokens=True)
+            if not text.strip():
+                continue
+            card_prompt = self.bot.make_card_prompt(self.deck_id, self.prompt_key, self.template, text)
+            cached = self.bot.cached_answer(card_prompt)
+            if cached is not None:
+                self.pending[nid] = cached
+                self.done += 1
+                continue
+            self.card_to_note[str(cid)] = nid
+            self.card_prompts[str(cid)] = card_prompt
+            items.append(BatchItem(cid, text))
+        return items
+
+    def start(self):
+        if not self.output_field:
+            showInfo(get_text(self.lang, "bulk_no_output_field"))
+            return
+        items = self.collect_items()
+        if not items:
+            if self.pending:
+                self.on_finished()
+            else:
+                showInfo(get_text(self.lang, "bulk_nothing_to_do"))
+            return
+
+        self.total = len(items) + self.done
+        self.progress = QProgressDialog(
+            get_text(self.lang, "bulk_progress", done=self.done, total=self.total),
+            get_text(self.lang, "btn_cancel"), 0, self.total, mw
+        )
+        self.progress.setWindowModality(Qt.WindowModality.WindowModal)
+        self.progress.canceled.connect(self.cancel)
+        self.progress.show()
+        # Batch prompt dùng template với placeholder chuẩn hoá ({text} hoặc {Tên field})
+        self.thread = BulkThread(self.bot.client, load_template(self.template).batch_template(), items,
+                                 self.bot.config.get("bulk_max_batch", 20), self.deck_id, self.prompt_key)
+        self.thread.result_ready.connect(self.on_result)
+        self.thread.item_failed.connect(self.on_failed)
+        self.thread.finished.connect(self.on_finished)
+        self.thread.start()
+
+    def cancel(self):
+        if self.thread:
+            self.thread.token.cancel()
+
+    def on_result(self, card_id, answer):
+        nid = self.card_to_note.get(card_id)
+        if nid is not None:
+            self.pending[nid] = answer
+        if self.bot.response_cache and card_id in self.card_prompts:
+            self.bot.response_cache.put(self.card_prompts[card_id], answer)
+        self.done += 1
+        self._update_progress()
+        if len(self.pending) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def on_failed(self, card_id, error):
+        outbox = self.bot.outbox
+        if error in ("network", "unavailable", "budget") and outbox and card_id in self.card_prompts:
+            # Mất mạng / Gemini không khả dụng / hết ngân sách token → vào outbox,
+            # câu trả lời sẽ được ghi vào note khi gửi lại được
+            outbox.add_bulk(self.card_to_note[card_id], int(card_id), self.deck_id,
+                            self.output_field, self.card_prompts[card_id])
+            if error != "budget":
+                if error == "network":
+                    outbox.mark_offline()
+                self.queued += 1
+            else:
+                self.deferred += 1
+        else:
+            self.failed += 1
+            METRICS.incr("bulk.failed", kind=error)
+            # self.debug.log(f"Bulk item {card_id} failed: {error}")
+        self._update_progress()
+
+    def _update_progress(self):
+        if self.progress:
+            finished = self.done + self.failed + self.queued + self.deferred
+            self.progress.setValue(finished)
+            self.progress.setLabelText(
+                get_text(self.lang, "bulk_progress", done=finished, total=self.total)
+            )
+
+    def flush(self):
+        """Ghi các câu trả lời đang chờ vào note trong một lần update."""
+        if not self.pending:
+            return
+        notes = []
+        for nid, answer in self.pending.items():
+            note = mw.col.get_note(nid)
+            if self.output_field in note:
+                note[self.output_field] = answer
+                notes.append(note)
+        self.pending = {}
+        if notes:
+            mw.col.update_notes(notes)
+
+    def on_finished(self):
+        self.flush()
+        if self.progress:
+            self.progress.close()
+            self.progress = None
+        requests_sent = self.thread.batcher.requests_sent if self.thread else 0
+        msg = get_text(self.lang, "bulk_done", done=self.done, failed=self.failed, requests=requests_sent)
+        if self.queued:
+            msg += "\n" + get_text(self.lang, "bulk_queued_offline", queued=self.queued)
+        if self.deferred:
+            msg += "\n" + get_text(self.lang, "bulk_deferred_budget", deferred=self.deferred)
+        showInfo(msg)
+        self.thread = None
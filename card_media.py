@@ -0,0 +1,200 @@
+import base64
+import hashlib
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote
+
+from .card_text import resolve_field_name
+from .metrics import METRICS
+from .prompt_templates import load_template
+
+IMG_SRC_RE = re.compile(r"<img\b[^>]*?\bsrc\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE)
+
+# Định dạng Gemini nhận trực tiếp khi không cần (hoặc không thể) thu nhỏ
+MIME_TYPES = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+    ".webp": "image/webp", ".heic": "image/heic", ".heif": "image/heif",
+}
+# Định dạng QImage đọc được để thu nhỏ
+SCALABLE = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+
+# Không có Qt (headless) thì chỉ gửi ảnh gốc nhỏ hơn giới hạn này
+MAX_RAW_BYTES = 512 * 1024
+
+
+def image_names(field_html):
+    """Tên file ảnh (trong media folder) được field tham chiếu, không trùng, giữ thứ tự."""
+    names = []
+    for match in IMG_SRC_RE.finditer(field_html or ""):
+        src = html.unescape(next(group for group in match.groups() if group is not None)).strip()
+        if not src or "://" in src or src.startswith("data:") or src in names:
+            continue
+        names.append(src)
+    return names
+
+
+def template_images(note, template, target_field):
+    """Ảnh trong các field mà template đưa vào prompt (trường mục tiêu và field {Tên})."""
+    fields = []
+    for placeholder in load_template(template).placeholders:
+        if placeholder.kind == "text":
+            fields.append(resolve_field_name(note, target_field))
+        elif placeholder.kind == "field" and placeholder.name in note:
+            fields.append(placeholder.name)
+    names = []
+    for field_name in fields:
+        if field_name:
+            names += [name for name in image_names(note[field_name]) if name not in names]
+    return names
+
+
+class ImageCache:
+    """Ảnh của card → inlineData cho generateContent.
+
+    Ảnh được thu nhỏ về tối đa max_dimension pixel, encode lại (JPEG, PNG nếu
+    có alpha) rồi lưu base64 trên đĩa theo key = hash(tên file, mtime, kích
+    thước, cấu hình). File ảnh đổi → key đổi, nên ảnh chỉ bị encode lại khi
+    thực sự thay đổi. Chạy được trong background thread (QImage, không QPixmap).
+    """
+
+    def __init__(self, directory, max_dimension=768, quality=80, max_files=2000):
+        self.directory = directory
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.memory = OrderedDict() # key → part (vài ảnh gần nhất, tránh đọc lại file)
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    def key(self, path):
+        """Key cache của file ảnh, None nếu file không tồn tại."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        raw = "\x1f".join([os.path.basename(path), str(stat.st_mtime_ns), str(stat.st_size),
+                           str(self.max_dimension), str(self.quality)])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def part(self, path, key=None):
+        """{"inlineData": {...}} cho file ảnh, None nếu không đọc / encode được."""
+        key = key or self.key(path)
+        if key is None:
+            return None
+        with self.lock:
+            part = self.memory.get(key)
+            if part is not None:
+                self.memory.move_to_end(key)
+                METRICS.incr("images.memory_hits")
+                return part
+        cache_path = os.path.join(self.directory, key + ".b64")
+        try:
+            with open(cache_path, "r", encoding="ascii") as f:
+                mime_type, data = f.read().split("\n", 1)
+            METRICS.incr("images.disk_hits")
+        except (OSError, ValueError):
+            try:
+                encoded = self.encode(path)
+            except OSError:
+                # File ảnh bị xoá / không đọc được
+                encoded = None
+            if encoded is None:
+                return None
+            mime_type, data = encoded
+            tmp_path = cache_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="ascii") as f:
+                    f.write(mime_type + "\n" + data)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # Đĩa đầy / thư mục profile chỉ đọc: vẫn gửi ảnh, chỉ không cache trên đĩa
+                METRICS.incr("images.cache_write_errors")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            METRICS.incr("images.encoded")
+            METRICS.incr("images.encoded_bytes", len(data))
+        part = {"inlineData": {"mimeType": mime_type, "data": data}}
+        with self.lock:
+            self.memory[key] = part
+            while len(self.memory) > 16:
+                self.memory.popitem(last=False)
+        return part
+
+    def encode(self, path):
+        """(mime type, base64) của ảnh đã thu nhỏ; ảnh gốc nếu không thu nhỏ được."""
+        ext = os.path.splitext(path)[1].lower()
+        if ext in SCALABLE:
+            try:
+                scaled = self._scale(path)
+            except ImportError:
+                # Không có Qt (headless runner)
+                scaled = None
+            if scaled is not None:
+                return scaled
+        if ext not in MIME_TYPES or os.path.getsize(path) > MAX_RAW_BYTES:
+            return None
+        with open(path, "rb") as f:
+            return MIME_TYPES[ext], base64.b64encode(f.read()).decode("ascii")
+
+    def _scale(self, path):
+        from aqt.qt import QBuffer, QByteArray, QImage, QIODevice, Qt
+
+        image = QImage(path)
+        if image.isNull():
+            return None
+        if max(image.width(), image.height()) > self.max_dimension:
+            image = image.scaled(self.max_dimension, self.max_dimension,
+                                 Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        if image.hasAlphaChannel():
+            image.save(buffer, "PNG")
+            mime_type = "image/png"
+        else:
+            image.save(buffer, "JPEG", self.quality)
+            mime_type = "image/jpeg"
+        buffer.close()
+        return mime_type, base64.b64encode(bytes(data)).decode("ascii")
+
+    def prune(self):
+        """Giữ tối đa max_files ảnh đã encode (xoá file cũ nhất)."""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".b64")]
+        except OSError:
+            return
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def media_path(media_dir, name):
+    """Đường dẫn file media cho src của <img>, None nếu không có trong media folder."""
+    for candidate in (name, unquote(name)):
+        path = os.path.join(media_dir, os.path.basename(candidate))
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def attach_images(contents, parts):
+    """Bản sao của contents với ảnh đặt trước text của lượt user đầu tiên."""
+    if not parts:
+        return contents
+    contents = list(contents)
+    for i, content in enumerate(contents):
+        if content.get("role", "user") == "user":
+            contents[i] = {**content, "parts": list(parts) + list(content.get("parts", []))}
+            break
+    return contents
@@ -0,0 +1,135 @@
+import html
+import re
+import threading
+from collections import OrderedDict
+
+from .batching import estimate_tokens
+from .metrics import METRICS
+from .prompt_templates import DEFAULT_CAP, load_template
+
+# Cloze trong cùng (không chứa {{ hay }}); cloze lồng nhau được xử lý từ trong ra
+_CLOZE_PART = r"((?:(?!\{\{|\}\}).)*?)"
+CLOZE_RE = re.compile(r"\{\{c(\d+)::" + _CLOZE_PART + r"(?:::" + _CLOZE_PART + r")?\}\}", re.DOTALL)
+BLOCK_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+BREAK_RE = re.compile(r"<br\s*/?>|</(?:p|div|li|tr|h[1-6])\s*>", re.IGNORECASE)
+CELL_RE = re.compile(r"</t[dh]\s*>", re.IGNORECASE)
+TAG_RE = re.compile(r"<[^>]+>")
+MEDIA_RE = re.compile(r"\[sound:[^\]]*\]")
+
+
+def resolve_clozes(text, ordinal=None):
+    """Cloze của card hiện tại (ordinal = card.ord + 1) thành [đáp án], cloze khác thành text."""
+    def replace(match):
+        answer = match.group(2)
+        return f"[{answer}]" if ordinal is not None and int(match.group(1)) == ordinal else answer
+
+    # Lặp để xử lý cloze lồng nhau
+    while True:
+        resolved = CLOZE_RE.sub(replace, text)
+        if resolved == text:
+            return resolved
+        text = resolved
+
+
+def clean_field(text, ordinal=None):
+    """HTML của field → text gọn để đưa vào prompt.
+
+    Bỏ script/style, tag, [sound:...] (ảnh mất theo tag <img>), giải mã entity,
+    resolve cloze và gộp khoảng trắng (giữ xuống dòng giữa các khối).
+    """
+    text = resolve_clozes(text or "", ordinal)
+    text = BLOCK_RE.sub(" ", text)
+    text = BREAK_RE.sub("\n", text)
+    text = CELL_RE.sub(" ", text)
+    text = TAG_RE.sub("", text)
+    text = MEDIA_RE.sub(" ", text)
+    text = html.unescape(text).replace("\xa0", " ")
+    lines = (" ".join(line.split()) for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+class CardTextCache:
+    """Memo text đã làm sạch theo (note id, note mod, field, card ord).
+
+    Note bị sửa thì mod đổi nên entry cũ không bao giờ bị dùng lại; LRU giới
+    hạn số entry giữ trong bộ nhớ.
+    """
+
+    def __init__(self, max_entries=512):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, note, field_name, ordinal=None, deck_id=None):
+        """Text sạch của field; deck_id khác None → ghi nhận token tiết kiệm cho deck."""
+        key = (note.id, note.mod, field_name, ordinal)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            raw = note[field_name]
+            entry = (clean_field(raw, ordinal), estimate_tokens(raw))
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        text, raw_tokens = entry
+        if deck_id is not None:
+            METRICS.incr("card_text.raw_tokens", raw_tokens, deck=str(deck_id))
+            METRICS.incr("card_text.sent_tokens", estimate_tokens(text), deck=str(deck_id))
+        return text
+
+
+def resolve_field_name(note, target_field):
+    """Tên field thực tế của note cho target_field (đúng tên, không phân biệt hoa
+    thường, rồi field đầu tiên), None nếu note không có field nào."""
+    if target_field in note:
+        return target_field
+    for field_name in note.keys():
+        if field_name.lower() == target_field.lower():
+            return field_name
+    if note.fields:
+        return note.keys()[0]
+    return None
+
+
+def card_content(card, note, template, target_field, text_cache, deck_name, cap=DEFAULT_CAP, deck_id=None):
+    """Khối nội dung của card cho template: giá trị các placeholder (field đã làm
+    sạch, deck, tags, ord), có giới hạn độ dài; "" nếu các field đều rỗng.
+
+    Không phụ thuộc aqt: dùng chung cho GUI và headless runner.
+    deck_name(did) → tên deck; deck_id khác None → ghi nhận token tiết kiệm.
+    """
+    compiled = load_template(template)
+    values = {}
+    for placeholder in compiled.placeholders:
+        if placeholder.kind == "text":
+            field_name = resolve_field_name(note, target_field)
+            value = text_cache.get(note, field_name, card.ord + 1, deck_id) if field_name else ""
+        elif placeholder.kind == "field":
+            value = text_cache.get(note, placeholder.name, card.ord + 1, deck_id) \
+                if placeholder.name in note else ""
+        elif placeholder.kind == "deck":
+            value = deck_name(card.did)
+        elif placeholder.kind == "tags":
+            value = " ".join(note.tags)
+        else:
+            value = str(card.ord + 1)
+        values[placeholder.name] = value
+    return compiled.content(values, cap)
+
+
+def token_savings_report(deck_name=str):
+    """Token tiết kiệm được nhờ làm sạch nội dung card, theo deck."""
+    lines = []
+    for labels, raw_tokens in sorted(METRICS.by_labels("card_text.raw_tokens").items()):
+        deck = dict(labels)["deck"]
+        sent_tokens = METRICS.get("card_text.sent_tokens", deck=deck)
+        saved = raw_tokens - sent_tokens
+        rate = saved / raw_tokens * 100 if raw_tokens else 0
+        lines.append(
+            f"{deck_name(deck)}: ~{int(saved)} tokens saved ({rate:.0f}%, "
+            f"{int(sent_tokens)} sent / {int(raw_tokens)} raw)"
+        )
+    return lines
@@ -0,0 +1,39 @@
+from aqt import mw
+from aqt.qt import *
+from aqt.webview import AnkiWebView
+
+
+class ChatPanel(QDockWidget):
+    """Chat trong dock widget của cửa sổ chính, với webview riêng.
+
+    Trang chat được load một lần và giữ nguyên khi đổi card: ChatWindow chỉ
+    gửi DOM op "context" (transcript của note mới), trang của reviewer không
+    bị inject gì thêm.
+    """
+
+    def __init__(self, title):
+        super().__init__(title, mw)
+        self.setObjectName("GeminiChatPanel")
+        self.setAllowedAreas(Qt.DockWidgetArea.LeftDockWidgetArea | Qt.DockWidgetArea.RightDockWidgetArea)
+        self.web = AnkiWebView(parent=self)
+        self.setWidget(self.web)
+        self.loaded = False
+        mw.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, self)
+        self.hide()
+
+    def load(self, html):
+        """Load trang chat (chỉ lần đầu); DOM op gửi trước khi load xong được webview giữ lại."""
+        if not self.loaded:
+            self.loaded = True
+            self.web.stdHtml(html, context=self)
+
+    def present(self):
+        self.show()
+        self.raise_()
+        self.web.setFocus()
+
+    def dispose(self):
+        self.hide()
+        mw.removeDockWidget(self)
+        self.web.cleanup()
+        self.deleteLater()
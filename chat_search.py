@@ -0,0 +1,104 @@
+import re
+import sqlite3
+import threading
+
+# Đánh dấu đoạn khớp trong snippet (ký tự điều khiển → escape HTML an toàn rồi mới thay)
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+def build_match_query(text):
+    """Chuyển từ khoá người dùng thành câu MATCH của FTS5.
+
+    Mỗi từ được đặt trong ngoặc kép (không cho cú pháp FTS5 lọt vào), từ cuối
+    khớp tiền tố để kết quả hiện ngay khi đang gõ.
+    """
+    terms = re.findall(r"\w+", text or "")
+    if not terms:
+        return None
+    quoted = ['"%s"' % t for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+class SearchHit:
+    __slots__ = ("turn_id", "note_id", "deck_id", "prompt_key", "role", "snippet", "rank")
+
+    def __init__(self, turn_id, note_id, deck_id, prompt_key, role, snippet, rank):
+        self.turn_id = turn_id
+        self.note_id = note_id
+        self.deck_id = deck_id
+        self.prompt_key = prompt_key
+        self.role = role
+        self.snippet = snippet
+        self.rank = rank
+
+
+class ChatSearchIndex:
+    """Index FTS5 trên các lượt chat đã lưu (rowid = chat_turns.id).
+
+    Transcript được nén trong chat_turns nên index giữ bản text riêng; nó được
+    cập nhật mỗi khi lưu một lượt, còn việc xoá lượt được trigger SQLite lo.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        try:
+            self._create_table("unicode61 remove_diacritics 2")
+        except sqlite3.OperationalError:
+            # SQLite cũ (< 3.27) chưa có remove_diacritics 2
+            self._create_table("unicode61")
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_turns_fts_delete AFTER DELETE ON chat_turns BEGIN "
+            "DELETE FROM chat_turns_fts WHERE rowid = old.id; END"
+        )
+
+    def _create_table(self, tokenizer):
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_turns_fts USING fts5("
+            "text, note_id UNINDEXED, deck_id UNINDEXED, prompt_key UNINDEXED, role UNINDEXED, "
+            f"tokenize = '{tokenizer}', prefix = '2 3')"
+        )
+
+    def last_indexed(self):
+        """Id lượt chat lớn nhất đã có trong index."""
+        return self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM chat_turns_fts").fetchone()[0]
+
+    def add(self, turn_id, note_id, deck_id, prompt_key, role, text):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chat_turns_fts (rowid, text, note_id, deck_id, prompt_key, role) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (turn_id, text, note_id, str(deck_id) if deck_id is not None else None, prompt_key, role),
+            )
+
+    def search(self, text, deck_id=None, limit=50):
+        """Các lượt chat khớp từ khoá, xếp theo bm25 (tốt nhất trước)."""
+        query = build_match_query(text)
+        if not query:
+            return []
+        sql = (
+            "SELECT rowid, note_id, deck_id, prompt_key, role, "
+            f"snippet(chat_turns_fts, 0, '{MATCH_START}', '{MATCH_END}', '…', 16), rank "
+            "FROM chat_turns_fts WHERE chat_turns_fts MATCH ?"
+        )
+        params = [query]
+        if deck_id is not None:
+            sql += " AND deck_id = ?"
+            params.append(str(deck_id))
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        try:
+            rows = self.conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            return []
+        return [SearchHit(*row) for row in rows]
+
+
+def create_search_index(conn):
+    """ChatSearchIndex, hoặc None nếu SQLite không có FTS5."""
+    try:
+        return ChatSearchIndex(conn)
+    except sqlite3.OperationalError:
+        return None
@@ -0,0 +1,157 @@
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+from .chat_search import create_search_index
+
+
+def _pack(text):
+    return zlib.compress((text or "").encode("utf-8"), 6)
+
+
+def _unpack(blob):
+    return zlib.decompress(blob).decode("utf-8") if blob else ""
+
+
+class ChatTurn:
+    """Một lượt chat đã lưu: text gốc và HTML đã render (để hiện lại không cần render)."""
+
+    __slots__ = ("seq", "role", "text", "html")
+
+    def __init__(self, seq, role, text, html):
+        self.seq = seq
+        self.role = role
+        self.text = text
+        self.html = html
+
+
+class ChatSession:
+    """Transcript của một note; chỉ giữ các lượt gần nhất trong bộ nhớ."""
+
+    def __init__(self, note_id, turns, has_more):
+        self.note_id = note_id
+        self.deck_id = None       # Deck/prompt của card đang mở (gắn tag cho search index)
+        self.prompt_key = None
+        self.turns = turns        # ChatTurn đã load, cũ → mới
+        self.has_more = has_more  # Còn lượt cũ hơn trong database
+
+    def history(self, max_turns):
+        """History cho API: max_turns lượt gần nhất, bắt đầu bằng lượt của user."""
+        turns = self.turns[-max_turns:] if max_turns else self.turns
+        while turns and turns[0].role != "user":
+            turns = turns[1:]
+        return [{"role": t.role, "parts": [{"text": t.text}]} for t in turns]
+
+
+class ChatSessionStore:
+    """Lưu transcript theo note id trong SQLite (text + HTML nén zlib).
+
+    Khi mở chat chỉ load `page_size` lượt cuối; các trang cũ hơn được lấy khi
+    cuộn lên. Tối đa `max_sessions` session được giữ trong bộ nhớ (LRU);
+    session bị đẩy ra khỏi LRU nhưng vẫn đang được dùng (chat đang mở, câu
+    trả lời đang chờ) được tìm lại qua weakref, nên mỗi note chỉ có một session.
+    Mỗi lượt mới cũng được thêm vào index full-text (nếu SQLite có FTS5).
+    """
+
+    def __init__(self, conn, page_size=6, max_sessions=20):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.page_size = page_size
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.evicted = weakref.WeakValueDictionary() # note id → session đã ra khỏi LRU, còn được tham chiếu
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_turns ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, note_id INTEGER, seq INTEGER, role TEXT, "
+            "text BLOB, html BLOB, created REAL)"
+        )
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS chat_turns_note_seq ON chat_turns (note_id, seq)")
+        self.search_index = create_search_index(conn)
+        if self.search_index:
+            self._index_missing()
+
+    def _index_missing(self):
+        """Đưa vào index các lượt được lưu trước khi có index."""
+        rows = self.conn.execute(
+            "SELECT id, note_id, role, text FROM chat_turns WHERE id > ? ORDER BY id",
+            (self.search_index.last_indexed(),),
+        ).fetchall()
+        for turn_id, note_id, role, text in rows:
+            self.search_index.add(turn_id, note_id, None, None, role, _unpack(text))
+
+    def _fetch(self, note_id, before_seq=None):
+        """Một trang lượt chat (cũ → mới) trước before_seq, và cờ còn trang cũ hơn."""
+        if before_seq is None:
+            before_seq = 2 ** 62
+        rows = self.conn.execute(
+            "SELECT seq, role, text, html FROM chat_turns WHERE note_id = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (note_id, before_seq, self.page_size + 1),
+        ).fetchall()
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        turns = [ChatTurn(seq, role, _unpack(text), _unpack(html)) for seq, role, text, html in reversed(rows)]
+        return turns, has_more
+
+    def get(self, note_id):
+        """Session của note (tạo mới nếu chưa có lượt nào)."""
+        with self.lock:
+            session = self.sessions.get(note_id)
+            if session is not None:
+                self.sessions.move_to_end(note_id)
+                return session
+            session = self.evicted.pop(note_id, None)
+        if session is None:
+            turns, has_more = self._fetch(note_id)
+            session = ChatSession(note_id, turns, has_more)
+        with self.lock:
+            # Thread khác có thể vừa tạo session cho note này
+            session = self.sessions.setdefault(note_id, session)
+            self.sessions.move_to_end(note_id)
+            while len(self.sessions) > self.max_sessions:
+                old_id, old = self.sessions.popitem(last=False)
+                self.evicted[old_id] = old
+        return session
+
+    def load_older(self, session):
+        """Load trang lượt cũ hơn vào đầu session, trả về các lượt vừa load."""
+        if not session.has_more or not session.turns:
+            return []
+        turns, has_more = self._fetch(session.note_id, session.turns[0].seq)
+        session.turns[:0] = turns
+        session.has_more = has_more
+        return turns
+
+    def append(self, session, role, text, html):
+        with self.lock:
+            # seq lấy trong database (không từ session trong bộ nhớ) nên không bao giờ trùng
+            cursor = self.conn.execute(
+                "INSERT INTO chat_turns (note_id, seq, role, text, html, created) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ?, ?, ? FROM chat_turns WHERE note_id = ?",
+                (session.note_id, role, _pack(text), _pack(html), time.time(), session.note_id),
+            )
+            seq = self.conn.execute("SELECT seq FROM chat_turns WHERE id = ?", (cursor.lastrowid,)).fetchone()[0]
+        turn = ChatTurn(seq, role, text, html)
+        if self.search_index:
+            self.search_index.add(cursor.lastrowid, session.note_id, session.deck_id,
+                                  session.prompt_key, role, text)
+        session.turns.append(turn)
+        return turn
+
+    def remove_last(self, session):
+        """Xoá lượt cuối (vd: câu hỏi bị lỗi/đưa vào outbox)."""
+        if not session.turns:
+            return
+        turn = session.turns.pop()
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM chat_turns WHERE note_id = ? AND seq = ?", (session.note_id, turn.seq)
+            )
+
+    def clear(self, session):
+        with self.lock:
+            self.conn.execute("DELETE FROM chat_turns WHERE note_id = ?", (session.note_id,))
+        session.turns = []
+        session.has_more = False
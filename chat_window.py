@@ -2,94 +2,198 @@ from aqt import mw
 from aqt.qt import *
 import re
 import json
+import math
+import itertools
+from html import escape
 from aqt.utils import showInfo
 
+from .bridge import BRIDGE_JS, DomBatch
 from .debug_tools import DebugTools
 from .languages import get_text
+from .metrics import METRICS
+from .transport import CancelToken
+
+_request_ids = itertools.count(1)
+
+
+class ChatRequest:
+    """Một lượt chat gửi đi cùng ngữ cảnh card và session của nó.
+
+    Mỗi request có id riêng và một CancelToken: đổi card / đóng chat sẽ huỷ
+    request ở tầng HTTP và kết quả trễ (nếu có) bị bỏ qua.
+    """
+
+    def __init__(self, history, question, card=None, prompt_key=None, card_prompt=None,
+                 session=None, turn=None, media=()):
+        self.request_id = next(_request_ids)
+        self.token = CancelToken()
+        self.session = session # ChatSession đã gửi câu hỏi
+        self.turn = turn # Lượt user tương ứng trong session
+        self.history = list(history) # Snapshot, main thread có thể sửa history trong lúc chờ
+        self.question = question
+        self.card_id = card.id if card else None
+        self.note_id = card.nid if card else None
+        self.deck_id = card.did if card else None
+        self.prompt_key = prompt_key
+        self.card_prompt = card_prompt # Chỉ có khi là prompt tự động của card → dùng cache
+        self.media = media # Ảnh của card gửi kèm mọi lượt chat (không chỉ lượt đầu)
 
 
 class GeminiThread(QThread):
-    finished = pyqtSignal(str)
+    finished = pyqtSignal(str, str) # (response, status: ok / error / queued)
 
-    def __init__(self, parent, history):
+    def __init__(self, parent, request):
         super().__init__()
         self.parent = parent # This is the GeminiChatBot instance
-        self.history = history
+        self.request = request
 
     def run(self):
         # Call the API through the parent (GeminiChatBot) instance
-        response = self.parent.call_gemini_api(self.history)
-        self.finished.emit(str(response))
+        response, status = self.parent.answer_chat(self.request)
+        self.finished.emit(str(response), status)
 
 
 class ChatWindow:
-    """Phiên bản inject trực tiếp vào webview (không dùng QDialog)."""
+    """Phiên bản inject trực tiếp vào webview (không dùng QDialog).
+
+    panel: ChatPanel (dock widget) → chat nằm trong webview riêng của panel
+    thay vì trang của reviewer, và giữ nguyên khi đổi card.
+    """
 
-    def __init__(self, parent):
+    def __init__(self, parent, panel=None):
         self.parent = parent # This is the GeminiChatBot instance
         self.debug = DebugTools("ChatWindow")
-        self.thread = None
-        self.conversation_history = [] 
+        self.pending = {} # request_id → (ChatRequest, GeminiThread) đang chờ trả lời
+        self.panel = panel
+        self.dom = DomBatch(self._web)
+        self.session = None # ChatSession của note hiện tại (transcript được lưu)
+        self.prompt_key = None # Prompt key của deck hiện tại (để thống kê)
+        self.auto_prompt = None # Prompt tự động đã điền sẵn cho card hiện tại
+        self.card_prompt = None # CardPrompt tương ứng (key của response cache)
+        self.status_refresh = False # Đã hẹn cập nhật trạng thái Gemini trên header
+        self.t = self.texts()
         # self.debug.log("Initializing injected ChatWindow...")
         self.register_handlers()
         # self.inject_ui() # Don't inject on init, only when explicitly opened
 
+    def _web(self):
+        if self.panel:
+            return self.panel.web
+        return mw.reviewer.web if mw.reviewer else None
+
     def register_handlers(self):
-        """Register message handlers"""
-        from aqt.gui_hooks import webview_did_receive_js_message
-        webview_did_receive_js_message.append(self.handle_pycmd)
+        """Đăng ký route của cửa sổ chat với router của add-on"""
+        router = self.parent.router
+        router.add("send", self.on_send, owner=self)
+        router.add("close", lambda data: self.close(), owner=self)
+        router.add("load_more", lambda data: self.load_more(), owner=self)
         # self.debug.log("PyCmd handlers registered")
 
-    def clear_history(self):
-        """Delete conversation history"""
-        self.conversation_history = []
-        # self.debug.log("Chat history cleared")
+    def dispose(self):
+        """Đóng chat và gỡ route (khi ChatWindow bị bỏ đi)."""
+        self.close()
+        self.parent.router.remove_owner(self)
+
+    def set_session(self, session):
+        """Chuyển sang transcript của note khác"""
+        self.session = session
 
-    def handle_pycmd(self, handled, message, context):
-        """Handle commands from JS via pycmd()"""
-        # self.debug.log(f"Bridge command received: {message}")
+    @property
+    def conversation_history(self):
+        """History gửi cho API: các lượt gần nhất của session hiện tại"""
+        if not self.session:
+            return []
+        return self.session.history(self.parent.config.get("chat_context_turns", 10))
 
-        if message == "gemini_chat_close":
-            self.close()
-            return True, None
-        elif message == "gemini_chat_send_message":
-            if mw.reviewer and mw.reviewer.web:
-                js_get_input = """
-                (function() {
-                    var inputBox = document.getElementById('gemini-input-text');
-                    var inputText = inputBox ? inputBox.value.trim() : '';
-                    inputBox.value = ''; 
-                    return inputText;
-                })();
-                """
+    def cancel_pending(self):
+        """Huỷ các request đang chờ (đổi card, đóng chat, đóng profile).
 
-                def got_input(prompt):
-                    if prompt:  # Check not None or empty
-                        self.send_message(prompt)
-                        # self.add_message("user", prompt)
+        Thread được giữ trong self.pending tới khi kết thúc; lượt user chưa có
+        câu trả lời bị bỏ khỏi transcript để history vẫn xen kẽ user/model.
+        """
+        for request, thread in self.pending.values():
+            if request.token.cancelled:
+                continue
+            request.token.cancel()
+            session = request.session
+            if session and session.turns and session.turns[-1] is request.turn:
+                self.parent.sessions.remove_last(session)
+        if self.pending:
+            self.hide_typing()
 
-                mw.reviewer.web.evalWithCallback(js_get_input, got_input)
-            return True, None
+    def clear_history(self):
+        """Delete conversation history"""
+        if self.session:
+            self.parent.sessions.clear(self.session)
+        # self.debug.log("Chat history cleared")
 
-        return handled
+    def on_send(self, data):
+        """Message "send" từ JS: nội dung ô input đi kèm message"""
+        text = data.get("text")
+        if isinstance(text, str) and text.strip():
+            self.send_message(text.strip())
 
 
     # ==================== UI INJECTION ====================
+    def show(self):
+        """Hiện chat cho session hiện tại.
+
+        Reviewer: inject lại UI vào trang của card. Panel: trang đã load chỉ
+        nhận một DOM op "context" với transcript của note.
+        """
+        if not self.panel:
+            self.inject_ui()
+            return
+        if not self.panel.loaded:
+            self.panel.load(self.build_html())
+        self.dom.queue("context", html=self.session_html(), has_more=bool(self.session and self.session.has_more))
+        # Request của note này có thể vẫn đang chờ (panel không huỷ request khi đổi card)
+        waiting = any(request.session is self.session and not request.token.cancelled
+                      for request, _ in self.pending.values())
+        self.dom.queue("typing", visible=waiting)
+        self.update_service_status()
+        self.panel.present()
+
+    def session_html(self):
+        """Transcript đã lưu của note: HTML đã render sẵn, không render lại"""
+        turns = self.session.turns if self.session else []
+        if not turns:
+            return self.render_message("bot", self.t['welcome'])
+        return "".join(turn.html for turn in turns)
+
     def inject_ui(self):
         """Inject CSS + HTML into reviewer and display it."""
-        
-        # Localization
+        html_content = self.build_html()
+
+        # Áp dụng các DOM op còn chờ trước, rồi inject runtime bridge + UI trong một lần eval
+        self.dom.flush()
+        js_code_to_inject = BRIDGE_JS + f"""
+        (function() {{
+            var existingChatContainer = document.getElementById('gemini-chat-container');
+            if (existingChatContainer) {{
+                existingChatContainer.style.display = 'flex'; // Just show it if already exists
+                existingChatContainer.querySelector('#gemini-input-text').focus();
+            }} else {{
+                document.body.insertAdjacentHTML('beforeend', {json.dumps(html_content, ensure_ascii=False)});
+                var m = document.getElementById('gemini-chat-messages');
+                if (m) m.scrollTop = m.scrollHeight;
+            }}
+            console.log('Gemini Chat Window injected/shown successfully');
+        }})();
+        """
+        self.dom.eval(js_code_to_inject)
+        self.update_service_status()
+        # self.debug.log("Injected chat UI successfully")
+
+    def texts(self):
+        """Các chuỗi giao diện theo ngôn ngữ hiện tại"""
         lang = self.parent.config.get("language", "vi")
-        
-        self.t = {
-            "header": get_text(lang, "header"),
-            "placeholder": get_text(lang, "placeholder"),
-            "send": get_text(lang, "send"),
-            "typing": get_text(lang, "typing"),
-            "welcome": get_text(lang, "welcome"),
-            "you": get_text(lang, "you"),
-            "ai": get_text(lang, "ai")
-        }
+        return {key: get_text(lang, key) for key in ("header", "placeholder", "send", "typing", "welcome", "you", "ai")}
+
+    def build_html(self):
+        """CSS + HTML của cửa sổ chat (kèm runtime bridge khi ở panel)."""
+        # Localization
+        self.t = self.texts()
         t = self.t
 
         # CSS và HTML cho cửa sổ chat
@@ -183,6 +287,18 @@ class ChatWindow:
             }}
         }}
 
+        /* Panel: chiếm cả webview của dock widget */
+        #gemini-chat-container.panel {{
+            position: static;
+            width: 100%;
+            height: 100vh;
+            border-radius: 0;
+            box-shadow: none;
+            animation: none;
+            opacity: 1;
+            transform: none;
+        }}
+
         #gemini-chat-header {{
             padding: 20px 24px;
             background: var(--header-bg);
@@ -211,6 +327,26 @@ class ChatWindow:
             border-radius: 50%;
         }}
 
+        #gemini-chat-header[data-service="open"] #gemini-header-title::before {{
+            background: #dc2626;
+        }}
+
+        #gemini-chat-header[data-service="half_open"] #gemini-header-title::before {{
+            background: #d97706;
+        }}
+
+        #gemini-service-status {{
+            margin-left: auto;
+            margin-right: 12px;
+            font-size: 12px;
+            font-weight: 500;
+            color: #d97706;
+        }}
+
+        #gemini-chat-header[data-service="open"] #gemini-service-status {{
+            color: #dc2626;
+        }}
+
         #gemini-close-btn {{
             background: transparent;
             border: none;
@@ -384,19 +520,25 @@ class ChatWindow:
         </style>
         """
 
+        # Panel nhận transcript qua op "context" sau khi load
+        turns_html = "" if self.panel else self.session_html()
+        has_more = "1" if self.session and self.session.has_more and not self.panel else "0"
+
         html_content = css + f"""
-        <div id="gemini-chat-container">
+        <div id="gemini-chat-container"{' class="panel"' if self.panel else ''}>
             <div id="gemini-chat-header">
                 <div id="gemini-header-title">{t['header']}</div>
-                <button id="gemini-close-btn" onclick="pycmd('gemini_chat_close')">×</button>
+                <div id="gemini-service-status"></div>
+                <button id="gemini-close-btn" onclick="geminiBridge.post('close')">×</button>
             </div>
-            <div id="gemini-chat-messages"></div>
+            <div id="gemini-chat-messages" data-has-more="{has_more}"
+                 onscroll="if(this.scrollTop<40 && this.dataset.hasMore==='1' && !this.dataset.loading){{this.dataset.loading='1'; geminiBridge.post('load_more');}}">{turns_html}</div>
             <div id="gemini-chat-input-area">
                 <div id="gemini-typing">{t['typing']}</div>
                 <div id="gemini-input-wrapper">
                     <input id="gemini-input-text" type="text" placeholder="{t['placeholder']}"
-           onkeypress="if(event.key==='Enter'){{pycmd('gemini_chat_send_message'); event.preventDefault();}}" />
-                    <button id="gemini-send-btn" onclick="pycmd('gemini_chat_send_message')">
+           onkeypress="if(event.key==='Enter'){{geminiBridge.send(); event.preventDefault();}}" />
+                    <button id="gemini-send-btn" onclick="geminiBridge.send()">
                         <svg viewBox="0 0 24 24"><path d="M2.01 21L23 12 2.01 3 2 10l15 2-15 2z"></path></svg>
                     </button>
                 </div>
@@ -413,153 +555,164 @@ class ChatWindow:
         </script>
         """
 
-        reviewer = mw.reviewer.web
-        js_code_to_inject = f"""
-        (function() {{
-            var existingChatContainer = document.getElementById('gemini-chat-container');
-            if (existingChatContainer) {{
-                existingChatContainer.style.display = 'flex'; // Just show it if already exists
-                existingChatContainer.querySelector('#gemini-input-text').focus();
-            }} else {{
-                document.body.insertAdjacentHTML('beforeend', `{html_content}`);
-            }}
-            console.log('Gemini Chat Window injected/shown successfully');
-        }})();
-        """
-        reviewer.eval(js_code_to_inject)
-        # self.debug.log("Injected chat UI successfully")
-        # Add an initial greeting from the bot when the chat window is opened
-        if mw.reviewer and mw.reviewer.web:
-            js_check = f"""
-            (function() {{
-                const msgs = document.querySelectorAll('.bot-message');
-                for (let m of msgs) {{
-                    if (m.innerText.includes("{t['welcome']}")) {{
-                        return true; // already exists
-                    }}
-                }}
-                return false;
-            }})();
-            """
+        if self.panel:
+            return (f"<style>body {{ margin: 0; padding: 0; overflow: hidden; }}</style>"
+                    f"<script>{BRIDGE_JS}</script>" + html_content)
+        return html_content
 
-            def callback(exists):
-                if not exists:
-                    self.add_message("bot", t['welcome'])
+    def update_service_status(self):
+        """Hiện trạng thái circuit breaker của Gemini trên header.
+
+        Khi breaker đang mở, hẹn cập nhật lại lúc tới lượt thăm dò để người
+        dùng biết Gemini không khả dụng chứ không phải đang chậm.
+        """
+        lang = self.parent.config.get("language", "vi")
+        state, retry_in = self.parent.client.breaker().snapshot()
+        if state == "open":
+            text = get_text(lang, "status_unavailable", seconds=math.ceil(retry_in))
+            if not self.status_refresh:
+                self.status_refresh = True
+                QTimer.singleShot(int(retry_in * 1000) + 200, self._refresh_service_status)
+        elif state == "half_open":
+            text = get_text(lang, "status_recovering")
+        else:
+            text = ""
+        self.dom.queue("status", state=state, text=text)
 
-            mw.reviewer.web.evalWithCallback(js_check, callback)
+    def _refresh_service_status(self):
+        self.status_refresh = False
+        self.update_service_status()
 
     def close(self):
-        """Ẩn cửa sổ chat."""
-        # self.debug.log(f"Has reviewer web: {bool(mw.reviewer and mw.reviewer.web)}")
-        # self.debug.log(f"Has mw.web: {bool(mw.web)}")
-
-        if mw.reviewer and mw.reviewer.web:
-            mw.reviewer.web.eval("""
-            var chatContainer = document.getElementById('gemini-chat-container');
-            if (chatContainer){
-                chatContainer.style.display = 'none';
-            } else {
-                console.log('Gemini Chat Container not found to hide.');
-            }
-            """)
-        else:
-            # fallback: dùng context trực tiếp nếu có
-            try:
-                context.web.eval("""
-                var chatContainer = document.getElementById('gemini-chat-container');
-                if (chatContainer) chatContainer.style.display = 'none';
-                """)
-            except:
-                pass
+        """Ẩn cửa sổ chat (và huỷ request đang chờ)."""
+        self.cancel_pending()
+        if self.panel:
+            self.panel.hide()
+            return
+        self.dom.queue("hide")
+        self.dom.flush()
         # self.debug.log("Chat window hidden instantly via bridge command.")
 
 
     # ==================== MESSAGE HANDLING ====================
+    def render_message(self, sender, message):
+        """Render tin nhắn thành HTML (được lưu cùng transcript)"""
+        # Use stored translations or fallback
+        t = getattr(self, 't', {"you": "Bạn", "ai": "AI"})
+
+        if sender == "user":
+            return f"<div class='message user-message'><b>{t['you']}:</b> {escape(message)}</div>"
+
+        # Bot message - xử lý markdown cơ bản
+        # Code block (đơn giản)
+        html = re.sub(r'```(.*?)```', r'<pre><code>\1</code></pre>', message, flags=re.DOTALL)
+        # Inline code
+        html = re.sub(r'`(.*?)`', r'<code>\1</code>', html)
+        # Bold
+        html = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', html)
+        # Italic
+        html = re.sub(r'\*(.*?)\*', r'<i>\1</i>', html)
+        # Newlines
+        html = html.replace('\n', '<br>')
+        return f"<div class='message bot-message'><div class='bot-message-content'><b>{t['ai']}:</b> {html}</div></div>"
+
+    def append_html(self, html):
+        """Chèn HTML tin nhắn vào cuối khung chat"""
+        self.dom.queue("append", html=html)
+
     def add_message(self, sender, message):
-        """Thêm tin nhắn vào DOM"""
-        # Escape backticks and dollar signs for JavaScript template literals
+        """Thêm tin nhắn vào DOM (không lưu vào transcript)"""
         # showInfo(f"Adding message: [{sender}] {message[:50]}...")
         if message is None:
+            return None
+        html = self.render_message(sender, message)
+        self.append_html(html)
+        return html
+
+    def add_turn(self, role, text, session=None):
+        """Lưu một lượt chat vào transcript của note và hiện nếu đang mở note đó"""
+        session = session or self.session
+        html = self.render_message("user" if role == "user" else "bot", text)
+        if session is self.session:
+            self.append_html(html)
+        if session:
+            return self.parent.sessions.append(session, role, text, html)
+
+    def load_more(self):
+        """Cuộn lên đầu → load trang lượt chat cũ hơn"""
+        if not self.session:
             return
-        
-        # Use stored translations or fallback
-        t = getattr(self, 't', {"you": "Bạn", "ai": "AI"})
-        
-        safe_message = message.replace("`", "\\`").replace("${", "\\${}")
-        if sender == "user":
-            js = f"""
-            var m = document.getElementById('gemini-chat-messages');
-            if (m) {{
-                m.innerHTML += `<div class='message user-message'><b>{t['you']}:</b> {safe_message}</div>`;
-                m.scrollTop = m.scrollHeight;
-            }}
-            """
-            mw.reviewer.web.eval(js)
-        else:
-            # Bot message - xử lý markdown cơ bản
-            # Bold
-            safe_message = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', safe_message)
-            # Italic
-            safe_message = re.sub(r'\*(.*?)\*', r'<i>\1</i>', safe_message)
-            # Code block (đơn giản)
-            safe_message = re.sub(r'```(.*?)```', r'<pre><code>\1</code></pre>', safe_message, flags=re.DOTALL)
-            # Inline code
-            safe_message = re.sub(r'`(.*?)`', r'<code>\1</code>', safe_message)
-            # Newlines
-            safe_message = safe_message.replace('\n', '<br>')
-
-            js = f"""
-            var m = document.getElementById('gemini-chat-messages');
-            if (m) {{
-                m.innerHTML += `<div class='message bot-message'><div class='bot-message-content'><b>{t['ai']}:</b> {safe_message}</div></div>`;
-                m.scrollTop = m.scrollHeight;
-            }}
-            """
-            mw.reviewer.web.eval(js)
+        turns = self.parent.sessions.load_older(self.session)
+        self.dom.queue("prepend", html="".join(turn.html for turn in turns), has_more=self.session.has_more)
 
     def pre_fill_input(self, text):
-        """Điền sẵn text vào ô input."""
-        if not text:
-            # If text is empty, clear the input
-            js = """
-            var input = document.getElementById('gemini-input-text');
-            if (input) input.value = '';
-            """
-        else:
-            safe_text = text.replace("`", "\\`").replace("${", "\\${}")
-            js = f"""
-            var input = document.getElementById('gemini-input-text');
-            if (input) input.value = `{safe_text}`;
-            """
-        if mw.reviewer and mw.reviewer.web:
-            mw.reviewer.web.eval(js)
+        """Điền sẵn text vào ô input (rỗng → xoá ô input).
+
+        Ô input chỉ có một dòng nên xuống dòng (content nhiều field) thành khoảng trắng.
+        """
+        self.dom.queue("input", text=" ".join((text or "").split("\n")))
 
     def send_message(self, message):
         """Gửi tin nhắn đến Gemini."""
-        # 1. Hiển thị tin nhắn user
-        self.add_message("user", message)
-        
+        for request, _ in self.pending.values():
+            if (request.session is self.session and request.question == message
+                    and not request.token.cancelled):
+                # Câu hỏi này đang chờ trả lời → bỏ lần gửi trùng
+                METRICS.incr("chat.duplicate_sends")
+                return
+        # Chỉ prompt tự động (chưa sửa, ở lượt đầu) mới được tra cache
+        card_prompt = None
+        if (not (self.session and self.session.turns) and self.auto_prompt
+                and message.split() == self.auto_prompt.split()):
+            card_prompt = self.card_prompt
+
+        self.parent.has_chatted_for_card = True
+
+        # 1. Hiển thị và lưu tin nhắn user
+        turn = self.add_turn("user", message)
+
         # 2. Hiển thị typing indicator
         self.show_typing()
 
-        # 3. Cập nhật lịch sử
-        self.conversation_history.append({"role": "user", "parts": [{"text": message}]})
-
-        # 4. Gọi API (trong thread riêng để không chặn UI)
-        self.thread = GeminiThread(self.parent, self.conversation_history)
-        self.thread.finished.connect(self.on_api_response)
-        self.thread.start()
-
-    def on_api_response(self, response):
-        """Xử lý phản hồi từ API."""
-        self.hide_typing()
-        self.add_message("bot", response)
-        self.conversation_history.append({"role": "model", "parts": [{"text": response}]})
+        # 3. Gọi API (trong thread riêng để không chặn UI)
+        request = ChatRequest(self.conversation_history, message, self.parent.current_card,
+                              self.prompt_key, card_prompt, self.session, turn,
+                              self.card_prompt.media if self.card_prompt else ())
+        thread = GeminiThread(self.parent, request)
+        thread.finished.connect(
+            lambda response, status: self.on_api_response(request, response, status)
+        )
+        self.pending[request.request_id] = (request, thread)
+        thread.start()
+
+    def on_api_response(self, request, response, status="ok"):
+        """Xử lý phản hồi từ API (lưu vào session đã gửi câu hỏi)."""
+        self.pending.pop(request.request_id, None)
+        if request.token.cancelled:
+            # Kết quả trễ của request đã huỷ: không hiện. Câu trả lời cho prompt
+            # tự động của card đã được lưu vào response cache.
+            return
+        session = request.session
+        if session is self.session:
+            self.hide_typing()
+        self.update_service_status()
+        if status == "ok":
+            self.add_turn("model", response, session)
+            return
+        if session is self.session:
+            self.add_message("bot", response)
+        if session and session.turns and session.turns[-1].role == "user":
+            # Lỗi hoặc đã vào outbox → bỏ lượt user để history vẫn xen kẽ user/model
+            self.parent.sessions.remove_last(session)
+
+    def show_delivered(self, turns):
+        """Hiện và lưu các câu trả lời nhận được từ outbox (hỏi khi offline)."""
+        for question, answer in turns:
+            self.add_turn("user", question)
+            self.add_turn("model", answer)
 
     def show_typing(self):
-        if mw.reviewer and mw.reviewer.web:
-            mw.reviewer.web.eval("document.getElementById('gemini-typing').classList.add('visible');")
+        self.dom.queue("typing", visible=True)
 
     def hide_typing(self):
-        if mw.reviewer and mw.reviewer.web:
-            mw.reviewer.web.eval("document.getElementById('gemini-typing').classList.remove('visible');")
+        self.dom.queue("typing", visible=False)
@@ -0,0 +1,105 @@
+import hashlib
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Ngừng gọi một backend đang lỗi liên tục thay vì chờ timeout mỗi lần.
+
+    closed: request đi bình thường; failure_threshold lỗi liên tiếp → open.
+    open: request thất bại ngay; sau reset_timeout giây → half_open.
+    half_open: cho đúng một request thăm dò; thành công → closed, lỗi → open
+    lại với reset_timeout gấp đôi (tối đa max_reset_timeout).
+    Lỗi ở đây là lỗi mạng, timeout hoặc 5xx; 4xx/429 nghĩa là server vẫn sống.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, max_reset_timeout=300.0):
+        self.lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self):
+        """True nếu request được gửi (request thăm dò khi half_open)."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+            self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open()
+
+    def release(self):
+        """Request bị huỷ giữa chừng: không tính là thành công hay lỗi."""
+        with self.lock:
+            self.probing = False
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probing = False
+
+    def retry_in(self):
+        """Số giây tới lần thăm dò kế tiếp (0 nếu không open)."""
+        with self.lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def snapshot(self):
+        """(state, số giây tới lần thăm dò kế tiếp); open đã hết hạn chờ được báo là half_open."""
+        retry_in = self.retry_in()
+        with self.lock:
+            state = self.state
+        if state == OPEN and retry_in <= 0:
+            state = HALF_OPEN
+        return state, retry_in
+
+
+def _key_id(api_key):
+    # Không giữ API key thô làm key của dict (tránh lộ trong log / debug)
+    return hashlib.sha1((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+
+class BreakerRegistry:
+    """Một CircuitBreaker cho mỗi (backend, API key)."""
+
+    def __init__(self, **options):
+        self.lock = threading.Lock()
+        self.options = options
+        self.breakers = {}
+
+    def get(self, backend, api_key):
+        key = (backend, _key_id(api_key))
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = CircuitBreaker(**self.options)
+            return breaker
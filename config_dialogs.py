@@ -5,11 +5,25 @@ from aqt.utils import showInfo
 from PyQt6.QtCore import Qt
 from .debug_tools import DebugTools
 from .languages import get_text
+from .latency_profiles import DEFAULT_PROFILE, PROFILES
+from .tracing import traced
+from .prompt_templates import TemplateError, compile_template
 
 
 # ======================================================================
 # CONFIG DIALOG — GLOBAL SETTINGS
 # ======================================================================
+
+def template_error(lang, text, field_names=None):
+    """Thông báo lỗi của template (None nếu hợp lệ); field_names → kiểm tra {Tên field}."""
+    try:
+        compiled = compile_template(text)
+        if field_names:
+            compiled.validate_fields(field_names)
+    except TemplateError as e:
+        return get_text(lang, "error_template_" + e.code, **e.details)
+    return None
+
 class ConfigDialog(QDialog):
     def __init__(self, config, parent):
         super().__init__(mw)
@@ -21,7 +35,7 @@ class ConfigDialog(QDialog):
     def initUI(self):
         lang = self.config.get("language", "vi")
         self.setWindowTitle(get_text(lang, "config_title"))
-        self.setFixedSize(500, 650)
+        self.setFixedSize(500, 680)
         
         layout = QVBoxLayout()
 
@@ -60,6 +74,14 @@ class ConfigDialog(QDialog):
         self.enabled.setChecked(self.config.get("enabled", True))
         layout.addWidget(self.enabled)
 
+        self.chat_panel = QCheckBox(get_text(lang, "chat_panel_label"))
+        self.chat_panel.setChecked(self.config.get("chat_panel", False))
+        layout.addWidget(self.chat_panel)
+
+        self.stall_watchdog = QCheckBox(get_text(lang, "stall_watchdog_label"))
+        self.stall_watchdog.setChecked(self.config.get("stall_watchdog", False))
+        layout.addWidget(self.stall_watchdog)
+
         # --- Max Tokens ---
         layout.addWidget(QLabel(get_text(lang, "max_tokens_label")))
         self.max_tokens = QSpinBox()
@@ -132,12 +154,15 @@ class ConfigDialog(QDialog):
 
     # Return updated config
     def get_config(self):
+        # Giữ lại các key khác (cài đặt nâng cao) không có trên dialog
         return {
+            **self.config,
             "enabled": self.enabled.isChecked(),
+            "chat_panel": self.chat_panel.isChecked(),
+            "stall_watchdog": self.stall_watchdog.isChecked(),
             "language": self.language.currentData(),
             "theme": self.theme.currentData(),
             "api_key": self.api_key.text(),
-            "api_key": self.api_key.text(),
             "max_tokens": self.max_tokens.value(),
             "selected_prompt": self.default_prompt.currentData() or self.default_prompt.currentText(),
             "custom_prompts": self.config.get("custom_prompts", {}),
@@ -158,8 +183,9 @@ class ConfigDialog(QDialog):
         if not text:
             showInfo(get_text(lang, "error_prompt_empty"))
             return
-        if "{text}" not in text and "{field_content}" not in text:
-            showInfo(get_text(lang, "error_prompt_format"))
+        error = template_error(lang, text)
+        if error:
+            showInfo(error)
             return
 
         self.config.setdefault("custom_prompts", {})
@@ -220,7 +246,7 @@ class DeckConfigDialog(QDialog):
     def setup_ui(self):
         lang = self.config.get("language", "vi")
         self.setWindowTitle(get_text(lang, "deck_config_title"))
-        self.setFixedSize(420, 580)
+        self.setFixedSize(460, 830)
 
         layout = QVBoxLayout()
 
@@ -231,7 +257,7 @@ class DeckConfigDialog(QDialog):
         self.deck_search.textChanged.connect(self.filter_decks)
         layout.addWidget(self.deck_search)
         self.deck_combo = QComboBox()
-        self.deck_combo.currentIndexChanged.connect(self.load_deck_settings)
+        self.deck_combo.currentIndexChanged.connect(lambda index: self.load_deck_settings())
         layout.addWidget(self.deck_combo)
         self.all_decks = sorted(mw.col.decks.all(), key=lambda d: d["name"].lower())
         self._populate_deck_combo(self.all_decks)
@@ -240,12 +266,21 @@ class DeckConfigDialog(QDialog):
         self.deck_enabled = QCheckBox(get_text(lang, "enable_deck_chatbot"))
         layout.addWidget(self.deck_enabled)
 
+        # Gửi kèm ảnh trong field (image occlusion, deck hình ảnh)
+        self.deck_send_images = QCheckBox(get_text(lang, "send_images_label"))
+        layout.addWidget(self.deck_send_images)
+
         # Target field
         layout.addWidget(QLabel(get_text(lang, "target_field_label")))
         self.deck_target_field = QComboBox()
         self.deck_target_field.setEditable(True)
         layout.addWidget(self.deck_target_field)
 
+        # Output field (bulk generation)
+        layout.addWidget(QLabel(get_text(lang, "output_field_label")))
+        self.deck_output_field = QComboBox()
+        layout.addWidget(self.deck_output_field)
+
         # Prompt selector
         layout.addWidget(QLabel(get_text(lang, "deck_prompt_label")))
         self.deck_selected_prompt = QComboBox()
@@ -256,6 +291,20 @@ class DeckConfigDialog(QDialog):
         layout.addWidget(self.deck_selected_prompt)
         self.deck_selected_prompt.currentIndexChanged.connect(self._on_prompt_changed)
 
+        # Latency profile (model, độ dài câu trả lời, thinking budget)
+        layout.addWidget(QLabel(get_text(lang, "latency_profile_label")))
+        self.deck_latency_profile = QComboBox()
+        for name in PROFILES:
+            self.deck_latency_profile.addItem(get_text(lang, f"latency_profile_{name}"), name)
+        layout.addWidget(self.deck_latency_profile)
+
+        # Deck-level system context (grammar reference, style rules, examples...)
+        layout.addWidget(QLabel(get_text(lang, "system_context_label")))
+        self.deck_system_context = QPlainTextEdit()
+        self.deck_system_context.setPlaceholderText(get_text(lang, "system_context_placeholder"))
+        self.deck_system_context.setFixedHeight(120)
+        layout.addWidget(self.deck_system_context)
+
         # Custom prompt section
         layout.addWidget(QLabel(get_text(lang, "create_custom_prompt_label")))
         self.custom_key = QLineEdit()
@@ -280,6 +329,10 @@ class DeckConfigDialog(QDialog):
         btn_check_types.clicked.connect(self.check_deck_notetypes)
         btn_layout.addWidget(btn_check_types)
 
+        btn_bulk = QPushButton(get_text(lang, "btn_bulk_generate"))
+        btn_bulk.clicked.connect(self.run_bulk_generation)
+        btn_layout.addWidget(btn_bulk)
+
         layout.addLayout(btn_layout)
         layout.addStretch()
         self.setLayout(layout)
@@ -357,9 +410,20 @@ class DeckConfigDialog(QDialog):
             return []
         return [fld["name"] for fld in model["flds"]]
 
+    def _get_deck_fields(self, deck_id):
+        """Field của notetype dùng trong deck (hoặc subdeck đầu tiên có card)."""
+        model_id = self._get_model_id_for_deck(deck_id)
+        if not model_id:
+            for sub in self._get_subdecks(deck_id):
+                model_id = self._get_model_id_for_deck(sub["id"])
+                if model_id:
+                    break
+        return self._get_fields_for_model(model_id)
+
     # =========================================================
     # LOAD SETTINGS
     # =========================================================
+    @traced("load_deck_settings")
     def load_deck_settings(self):
         deck_id = str(self.deck_combo.currentData())
         deck_name = self.deck_combo.currentText()
@@ -368,6 +432,7 @@ class DeckConfigDialog(QDialog):
         deck_settings = self.config.setdefault("deck_settings", {})
         settings = deck_settings.get(deck_id, {})
         self.deck_enabled.setChecked(settings.get("enabled", True))
+        self.deck_send_images.setChecked(settings.get("send_images", False))
 
         model_id = self._get_model_id_for_deck(deck_id)
         if not model_id:
@@ -392,6 +457,19 @@ class DeckConfigDialog(QDialog):
             self.deck_target_field.addItem("Không tìm thấy trường")
             self.deck_target_field.setEnabled(False)
 
+        self.deck_output_field.clear()
+        self.deck_output_field.addItem("—", "")
+        for field in fields:
+            self.deck_output_field.addItem(field, field)
+        idx = self.deck_output_field.findData(settings.get("output_field", ""))
+        self.deck_output_field.setCurrentIndex(idx if idx != -1 else 0)
+
+        self.deck_system_context.setPlainText(settings.get("system_context", ""))
+
+        idx = self.deck_latency_profile.findData(
+            settings.get("latency_profile") or self.config.get("latency_profile", DEFAULT_PROFILE))
+        self.deck_latency_profile.setCurrentIndex(idx if idx != -1 else 0)
+
         saved_key = settings.get("selected_prompt", "default_simple")
         idx = self.deck_selected_prompt.findData(saved_key)
         if idx != -1:
@@ -417,8 +495,9 @@ class DeckConfigDialog(QDialog):
         if not text:
             showInfo(get_text(lang, "error_prompt_empty"))
             return
-        if "{text}" not in text and "{field_content}" not in text:
-            showInfo(get_text(lang, "error_prompt_format"))
+        error = template_error(lang, text, self._get_deck_fields(str(self.deck_combo.currentData())))
+        if error:
+            showInfo(error)
             return
 
         self.config.setdefault("custom_prompts", {})
@@ -464,8 +543,9 @@ class DeckConfigDialog(QDialog):
             if not custom_prompt:
                 showInfo(get_text(lang, "error_custom_prompt_empty"))
                 return
-            if "{text}" not in custom_prompt and "{field_content}" not in custom_prompt:
-                showInfo(get_text(lang, "error_prompt_format"))
+            error = template_error(lang, custom_prompt, self._get_fields_for_model(model_id))
+            if error:
+                showInfo(error)
                 return
 
             # Tạo key tạm riêng cho deck này
@@ -478,9 +558,15 @@ class DeckConfigDialog(QDialog):
         else:
             selected_prompt_key = selected_data or self.deck_selected_prompt.currentText()
 
+        system_context = self.deck_system_context.toPlainText().strip()
+        self._invalidate_context_cache(deck_id, system_context)
         self.config["deck_settings"][deck_id] = {
             "enabled": self.deck_enabled.isChecked(),
+            "send_images": self.deck_send_images.isChecked(),
             "target_field": self.deck_target_field.currentText(),
+            "output_field": self.deck_output_field.currentData() or "",
+            "system_context": system_context,
+            "latency_profile": self.deck_latency_profile.currentData(),
             "selected_prompt": selected_prompt_key
         }
 
@@ -496,9 +582,14 @@ class DeckConfigDialog(QDialog):
 
         for sub in same_model_subs:
             sid = str(sub["id"])
+            self._invalidate_context_cache(sid, system_context)
             self.config["deck_settings"][sid] = {
                 "enabled": self.deck_enabled.isChecked(),
+                "send_images": self.deck_send_images.isChecked(),
                 "target_field": self.deck_target_field.currentText(),
+                "output_field": self.deck_output_field.currentData() or "",
+                "system_context": system_context,
+                "latency_profile": self.deck_latency_profile.currentData(),
                 "selected_prompt": self.deck_selected_prompt.currentData()
                                     or self.deck_selected_prompt.currentText()
             }
@@ -516,6 +607,23 @@ class DeckConfigDialog(QDialog):
         showInfo(msg)
         # self.debug.log(f"[SAVE DONE] {deck_name} – Model ID={model_id}")
 
+    def _invalidate_context_cache(self, deck_id, system_context):
+        """Bỏ cached content của deck nếu system context thay đổi."""
+        old = self.config["deck_settings"].get(deck_id, {}).get("system_context", "")
+        if old != system_context:
+            self.parent.client.context_cache.invalidate(deck_id)
+
+    # =========================================================
+    # BULK GENERATION
+    # =========================================================
+    def run_bulk_generation(self):
+        """Sinh câu trả lời cho mọi note của deck (dùng cài đặt đã lưu)."""
+        deck_id = str(self.deck_combo.currentData())
+        if deck_id not in self.config.get("deck_settings", {}):
+            showInfo(get_text(self.config.get("language", "vi"), "bulk_save_first"))
+            return
+        self.parent.run_bulk_job(deck_id)
+
     # =========================================================
     # CHECK NOTETYPE (SIMPLIFIED VERSION)
     # =========================================================
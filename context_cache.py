@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+
+from .gemini_client import GeminiError
+
+
+def _hash_text(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class DeckContextCache:
+    """Cache system instruction của từng deck qua cachedContents API.
+
+    Mỗi deck có tối đa một cached content, được tham chiếu bằng tên
+    (cachedContents/...) trong mọi request của deck đó. Entry được gia hạn
+    trước khi hết hạn, bị bỏ khi nội dung instruction thay đổi, và nếu cache
+    không dùng được thì instruction được gửi inline qua systemInstruction.
+    """
+
+    # Không thử lại việc tạo cache cho cùng nội dung trong khoảng này
+    FAILURE_COOLDOWN = 600
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.entries = {}   # deck_id -> {"hash", "model", "name", "expires_at"}
+        self.failures = {}  # (deck_id, hash) -> thời điểm thất bại
+        self.stale = []     # tên cached content cần xoá trên server
+
+    def _settings(self):
+        config = self.client.get_config()
+        return (
+            config.get("context_cache_ttl", 3600),
+            config.get("context_cache_min_tokens", 1024),
+        )
+
+    def invalidate(self, deck_id):
+        """Bỏ cache của deck (vd: khi instruction của deck thay đổi)."""
+        with self.lock:
+            entry = self.entries.pop(str(deck_id), None)
+            if entry:
+                self.stale.append(entry["name"])
+            self.failures = {k: v for k, v in self.failures.items() if k[0] != str(deck_id)}
+
+    def _drop_stale(self):
+        with self.lock:
+            names, self.stale = self.stale, []
+        for name in names:
+            try:
+                self.client.delete_cached_content(name)
+            except GeminiError:
+                pass
+
+    def get_name(self, deck_id, system_text, model):
+        """Trả về tên cached content còn hiệu lực, hoặc None nếu phải gửi inline."""
+        deck_id = str(deck_id)
+        ttl, min_tokens = self._settings()
+        if ttl <= 0 or len(system_text) // 4 < min_tokens:
+            return None
+
+        self._drop_stale()
+        text_hash = _hash_text(system_text)
+        now = time.time()
+
+        with self.lock:
+            failed_at = self.failures.get((deck_id, text_hash))
+            if failed_at and now - failed_at < self.FAILURE_COOLDOWN:
+                return None
+            entry = self.entries.get(deck_id)
+            if entry and (entry["hash"] != text_hash or entry["model"] != model):
+                self.stale.append(entry["name"])
+                del self.entries[deck_id]
+                entry = None
+
+        # Gia hạn khi còn dưới 1/5 TTL
+        refresh_margin = ttl / 5
+        if entry and entry["expires_at"] - now > refresh_margin:
+            return entry["name"]
+
+        try:
+            if entry:
+                try:
+                    self.client.update_cached_content_ttl(entry["name"], ttl)
+                    name = entry["name"]
+                except GeminiError:
+                    name = self.client.create_cached_content(model, system_text, ttl)
+            else:
+                name = self.client.create_cached_content(model, system_text, ttl)
+        except GeminiError:
+            with self.lock:
+                self.failures[(deck_id, text_hash)] = now
+                self.entries.pop(deck_id, None)
+            return None
+
+        with self.lock:
+            self.entries[deck_id] = {
+                "hash": text_hash,
+                "model": model,
+                "name": name,
+                "expires_at": now + ttl,
+            }
+        return name
+
+    def apply(self, deck_id, system_text, payload, model):
+        """Gắn deck context vào payload (cachedContent hoặc systemInstruction)."""
+        payload = dict(payload)
+        name = self.get_name(deck_id, system_text, model)
+        if name:
+            payload["cachedContent"] = name
+            payload.pop("systemInstruction", None)
+        else:
+            payload["systemInstruction"] = {"parts": [{"text": system_text}]}
+        return payload
@@ -0,0 +1,163 @@
+import http.client
+import json
+import socket
+import ssl
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from .gemini_client import DEFAULT_MODEL, GEMINI_BASE_URL, GeminiError, extract_text
+from .latency_profiles import percentile
+
+PHASES = ("dns", "connect", "tls", "ttfb", "total")
+
+PROBE_PROMPT = "Reply with the single word OK."
+
+
+def mask_key(api_key):
+    return f"…{api_key[-4:]}" if api_key and len(api_key) > 4 else "-"
+
+
+class ProbeResult:
+    """Kết quả một lần gọi: thời gian từng pha (giây) và loại kết quả."""
+
+    def __init__(self):
+        self.timings = {}
+        self.outcome = "ok" # ok, dns, connect, tls, timeout, network, http <status>, invalid
+        self.usage = None
+
+
+def probe_once(base_url, api_key, model=DEFAULT_MODEL, timeout=30):
+    """Gọi generateContent trên connection mới, đo DNS / TCP / TLS / TTFB / tổng.
+
+    Không dùng session chung (keep-alive) để mỗi lần đo đủ các pha của một
+    request "lạnh".
+    """
+    result = ProbeResult()
+    parts = urlsplit(base_url)
+    host = parts.hostname
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    path = f"{parts.path}/models/{model}:generateContent?key={api_key}"
+    body = json.dumps({
+        "contents": [{"parts": [{"text": PROBE_PROMPT}]}],
+        "generationConfig": {"maxOutputTokens": 5, "temperature": 0},
+    }).encode("utf-8")
+    start = time.perf_counter()
+    phase = "dns"
+    sock = None
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        result.timings["dns"] = time.perf_counter() - start
+
+        phase = "connect"
+        mark = time.perf_counter()
+        family, socktype, proto, _, address = infos[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        result.timings["connect"] = time.perf_counter() - mark
+
+        if parts.scheme == "https":
+            phase = "tls"
+            mark = time.perf_counter()
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+            result.timings["tls"] = time.perf_counter() - mark
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn.sock = sock
+
+        phase = "network"
+        mark = time.perf_counter()
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        result.timings["ttfb"] = time.perf_counter() - mark
+        data = response.read()
+        result.timings["total"] = time.perf_counter() - start
+        if response.status != 200:
+            result.outcome = f"http {response.status}"
+            return result
+        try:
+            parsed = json.loads(data)
+            extract_text(parsed)
+            result.usage = parsed.get("usageMetadata")
+        except (ValueError, GeminiError):
+            result.outcome = "invalid"
+    except socket.timeout:
+        result.outcome = "timeout"
+    except (OSError, http.client.HTTPException):
+        result.outcome = phase
+    finally:
+        if sock is not None:
+            sock.close()
+    return result
+
+
+class Diagnostics:
+    """Đo độ trễ và độ ổn định của endpoint Gemini cho mỗi (backend, API key).
+
+    Mỗi target được gọi calls lần tuần tự (độ trễ từng pha, p50/p95) rồi calls
+    lần song song (throughput, p95 dưới tải). Chạy trong background thread;
+    report() trả về các dòng text để hiển thị.
+    """
+
+    def __init__(self, targets, calls=5, model=DEFAULT_MODEL, timeout=30, on_usage=None):
+        self.targets = targets # [(base_url, api_key)]
+        self.calls = max(1, calls)
+        self.model = model
+        self.timeout = timeout
+        self.on_usage = on_usage # on_usage(usageMetadata): ghi nhận token đã dùng
+        self.results = [] # [(base_url, api_key, sequential, concurrent, wall time)]
+
+    def _probe(self, base_url, api_key):
+        result = probe_once(base_url, api_key, self.model, self.timeout)
+        if result.usage and self.on_usage:
+            self.on_usage(result.usage)
+        return result
+
+    def run(self):
+        for base_url, api_key in self.targets:
+            sequential = [self._probe(base_url, api_key) for _ in range(self.calls)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.calls) as pool:
+                concurrent = list(pool.map(lambda _: self._probe(base_url, api_key), range(self.calls)))
+            self.results.append((base_url, api_key, sequential, concurrent, time.perf_counter() - start))
+        return self
+
+    @property
+    def healthy(self):
+        """True nếu mọi target đều có ít nhất một lần gọi thành công."""
+        return bool(self.results) and all(
+            any(r.outcome == "ok" for r in sequential + concurrent)
+            for _, _, sequential, concurrent, _ in self.results
+        )
+
+    def report(self):
+        lines = []
+        for base_url, api_key, sequential, concurrent, wall in self.results:
+            lines.append(f"=== {urlsplit(base_url).hostname} · key {mask_key(api_key)} · {self.model} ===")
+            lines.append(f"Sequential ({len(sequential)} calls, new connection each):")
+            for phase in PHASES:
+                values = [r.timings[phase] for r in sequential if phase in r.timings]
+                if values:
+                    lines.append(
+                        f"  {phase:<8} p50 {percentile(values, 50) * 1000:6.0f} ms   "
+                        f"p95 {percentile(values, 95) * 1000:6.0f} ms"
+                    )
+            totals = [r.timings["total"] for r in concurrent if r.outcome == "ok"]
+            ok = len(totals)
+            lines.append(f"Concurrent ({len(concurrent)} calls):")
+            lines.append(f"  throughput {ok / wall:.2f} successful calls/s (wall {wall:.2f} s)")
+            if totals:
+                lines.append(f"  total    p95 {percentile(totals, 95) * 1000:6.0f} ms")
+            outcomes = Counter(r.outcome for r in sequential + concurrent)
+            lines.append("Results: " + ", ".join(f"{name} × {count}" for name, count in outcomes.most_common()))
+            lines.append("")
+        return lines
+
+
+def default_targets(config):
+    """Các (backend, API key) đang được cấu hình."""
+    api_key = config.get("api_key")
+    return [(GEMINI_BASE_URL, api_key)] if api_key else []
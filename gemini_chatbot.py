@@ -1,19 +1,40 @@
 import os
 import json
-import requests
+import sqlite3
 import time
 from typing import Dict, Any
 
 from aqt import mw
 from aqt.qt import *
-from aqt.utils import showInfo
+from aqt.utils import showInfo, tooltip
 from aqt.webview import AnkiWebView
 
 # Import các module con
 from .debug_tools import DebugTools
+from .gemini_client import GeminiClient, GeminiError, extract_text
+from .response_cache import CardPrompt, ResponseCache
+from .metrics import METRICS
+from .storage import USER_FILES_DIR, connect, user_files_path
+from .outbox import MAX_ATTEMPTS, Outbox, is_online
+from .chat_sessions import ChatSessionStore
+from .bulk_jobs import BulkJob
 from .chat_window import ChatWindow
+from .chat_panel import ChatPanel
 from .config_dialogs import ConfigDialog, DeckConfigDialog
+from .search_dialog import ChatSearchDialog
 from .languages import get_text
+from .prompt_layout import assemble_prompt, prefix_cache_report
+from .bridge import BRIDGE_JS
+from .router import CommandRouter
+from .card_text import CardTextCache, card_content, resolve_field_name, token_savings_report
+from .prompt_templates import DEFAULT_CAP
+from .usage import UsageStore, usage_report
+from .diagnostics import Diagnostics, default_targets
+from .prefetch import Prefetcher
+from .answer_packs import AnswerPackShelf, PackError, write_pack
+from .card_media import ImageCache, attach_images, media_path, template_images
+from .stall_watchdog import WATCHDOG
+from .tracing import TRACER, traced
 
 
 class GeminiChatBot:
@@ -22,220 +43,148 @@ class GeminiChatBot:
         # self.debug.log("Initializing GeminiChatBot...")
 
         self.config = self.load_config()
+        self.usage = self.open_usage_store()
+        self.client = GeminiClient(lambda: self.config, self.usage)
         self.current_card = None
         self.has_chatted_for_card = False
         self.chat_window: ChatWindow = None # Type hint for better clarity
+        self.chat_panel: ChatPanel = None # Dock widget cho chế độ chat_panel (tạo khi mở lần đầu)
+        self.router = CommandRouter() # Handler duy nhất cho message từ webview
+        self.card_text = CardTextCache() # Nội dung field đã làm sạch, theo (note id, mod)
+        self.bulk_job: BulkJob = None
+        self.response_cache = self.open_response_cache()
+        self.packs = self.open_answer_packs()
+        self.images = self.open_image_cache()
+        self.outbox = self.open_outbox()
+        self.outbox_draining = False
+        self.diagnostics_running = False
+        self.sessions = self.open_session_store()
+        self.prefetcher = Prefetcher(self) # Sinh trước câu trả lời cho các card sắp tới
 
         self.setup_menu()
         self.register_handlers()
         self.register_hooks()
         self.register_shortcut()
+        self.start_outbox_timer()
+        self.apply_watchdog()
 
         # self.debug.log("GeminiChatBot initialized successfully", True)
 
-    def register_shortcut(self):
-        """Register global shortcut Ctrl+Y to open chat window"""
+    def open_response_cache(self):
+        """Mở cache câu trả lời (exact + semantic), None nếu không mở được"""
         try:
-            # Ctrl + Y → open ChatBot
-            shortcut_open = QShortcut(QKeySequence("Ctrl+Y"), mw)
-            shortcut_open.setContext(Qt.ShortcutContext.ApplicationShortcut)
-            shortcut_open.activated.connect(self.open_chat_window)
-
-            # Ctrl + U → close ChatBot
-            shortcut_close = QShortcut(QKeySequence("Ctrl+U"), mw)
-            shortcut_close.setContext(Qt.ShortcutContext.ApplicationShortcut)
-            shortcut_close.activated.connect(self.close_chat_window)
-
-            # self.debug.log("Shortcut Ctrl+Y and Ctrl + U registered for Gemini ChatBot")
+            return ResponseCache(connect(), lambda: self.config, user_files_path("semantic_index.npy"))
         except Exception as e:
-            # self.debug.log(f"Error registering shortcut: {e}", True)
-            pass
-
-    def register_handlers(self):
-        """Register message handlers"""
-        from aqt.gui_hooks import webview_did_receive_js_message
-        webview_did_receive_js_message.append(self.handle_pycmd)
-        # self.debug.log("PyCmd handlers registered")
-
-    def register_hooks(self):
-        """Register all hooks"""
-        from aqt import gui_hooks
-
-        hooks = [
-            (gui_hooks.reviewer_did_show_question, self.on_show_question),
-            (gui_hooks.reviewer_will_end, self.on_review_end),
-            (gui_hooks.profile_will_close, self.cleanup),
-            (gui_hooks.state_will_change, self.on_state_change)
-        ]
-
-        for hook, handler in hooks:
-            hook.append(handler)
-
-        # self.debug.log(f"Registered {len(hooks)} hooks")
-
-    def on_state_change(self, new_state, old_state):
-        """Debug state changes"""
-        # self.debug.log(f"State change: {old_state} → {new_state}")
-        if old_state == "review" and new_state != "review":
-            # self.debug.log("Leaving review → cleaning UI")
-            self._cleanup_injected_elements()
-
-            if self.chat_window:
-                self.chat_window.close()
-                self.chat_window = None
-
-    def handle_pycmd(self, handled, cmd, context):
-        """
-        Handle pycmd messages
-        """
-        already_handled, result = handled
-
-        if already_handled:
-            return handled
-
-        # self.debug.log(f"PyCmd received: {cmd}")
-
-        if cmd == "gemini_chat_open":
-            self.open_chat_window()
-            return (True, None)
-        elif cmd.startswith("gemini_chat_send:"):
-            message = cmd.split(":", 1)[1]
-            if self.chat_window:
-                self.chat_window.send_message(message)
-                self.has_chatted_for_card = True
-            return (True, None)
-        
-        return handled
-
-    def load_config(self) -> Dict[str, Any]:
-        """Load configuration với defaults"""
-        default_config = {
-            "enabled": True,
-            "api_key": "",
-            "max_tokens": 500,
-            "selected_prompt": "explain_simple",
-            "target_field": "Front",
-            "custom_prompts": {
-                "explain_simple": "Bạn có muốn biết thêm về: {text} ngắn gọn trong 100 chữ",
-                "synonyms_antonyms": "Từ đồng nghĩa/trái nghĩa của: {text}",
-                "real_world_examples": "Ví dụ thực tế về: {text}",
-                "memory_tips": "Mẹo ghi nhớ cho: {text}"
-            },
-            "deck_settings": {}
-        }
+            # self.debug.log(f"Response cache error: {e}", True)
+            return None
 
+    def open_answer_packs(self):
+        """Answer pack đã import (cache chỉ đọc dùng chung trong nhóm), None nếu lỗi"""
         try:
-            user_config = mw.addonManager.getConfig(__name__) or {}
-            # self.debug.log(f"User config loaded: {user_config}")
-            # Deep merge
-            config = default_config.copy()
-            config.update(user_config)
-            config["custom_prompts"] = {**default_config["custom_prompts"], **user_config.get("custom_prompts", {})}
-
-            # self.debug.log("Configuration loaded successfully")
-            return config
-
+            return AnswerPackShelf(os.path.join(USER_FILES_DIR, "packs"))
         except Exception as e:
-            # self.debug.log(f"Config load error: {e}", True)
-            return default_config
+            # self.debug.log(f"Answer packs error: {e}", True)
+            return None
 
-    def save_config(self):
-        """Save configuration"""
+    def open_image_cache(self):
+        """Ảnh đã thu nhỏ (base64) để gửi kèm prompt, None nếu lỗi"""
         try:
-            mw.addonManager.writeConfig(__name__, self.config)
-            # self.debug.log("Configuration saved")
+            return ImageCache(os.path.join(USER_FILES_DIR, "image_cache"),
+                              self.config.get("image_max_dimension", 768))
         except Exception as e:
-            # self.debug.log(f"Config save error: {e}", True)
-            pass
+            # self.debug.log(f"Image cache error: {e}", True)
+            return None
 
-    def setup_menu(self):
-        """Add menu items"""
+    def open_usage_store(self):
+        """Token đã dùng theo ngày (cho ngân sách), None nếu không mở được"""
         try:
-            menu = QMenu("Gemini ChatBot", mw)
-            lang = self.config.get("language", "vi")
-
-            actions = [
-                (get_text(lang, "menu_config"), self.show_config_dialog),
-                (get_text(lang, "menu_deck_config"), self.show_deck_config),
-                (get_text(lang, "menu_test_api"), self.test_api_key),
-                (get_text(lang, "menu_debug"), self.show_debug_info)
-            ]
-
-            for name, handler in actions:
-                action = QAction(name, mw)
-                action.triggered.connect(handler)
-                menu.addAction(action)
-
-            mw.form.menuTools.addMenu(menu)
-            # self.debug.log("Menu setup completed")
-
+            return UsageStore(connect())
         except Exception as e:
-            # self.debug.log(f"Menu setup error: {e}", True)
-            pass
-
-    def show_debug_info(self):
-        """Show debug information"""
-        info = [
-            "=== GEMINI CHATBOT DEBUG INFO ===",
-            f"Addon Enabled: {self.config['enabled']}",
-            f"API Key Set: {'Yes' if self.config['api_key'] else 'No'}",
-            f"Current Card: {self.current_card.id if self.current_card else 'None'}",
-            f"Reviewer Active: {mw.reviewer is not None}",
-            f"WebView Ready: {mw.reviewer and mw.reviewer.web is not None}",
-            "",
-            "Check console for detailed logs"
-        ]
+            # self.debug.log(f"Usage store error: {e}", True)
+            return None
 
-        showInfo("\n".join(info))
-
-    def on_show_question(self, card):
-        """Called when question is shown"""
+    def open_outbox(self):
+        """Mở outbox (hàng đợi request khi offline), None nếu không mở được"""
         try:
-            # self.debug.log("=== on_show_question TRIGGERED ===")
-            # self.debug.log(self.debug.inspect_card(card))
-
-            # Remove existing chat UI and button on new card
-            self._cleanup_injected_elements()
-
-            # Check if addon is enabled
-            if not self.config["enabled"]:
-                # self.debug.log("Addon disabled in config")
-                return
-            
-            if self.chat_window:
-                self.chat_window.clear_history()
-
-            # Check if reviewer and webview are ready
-            if not mw.reviewer or not mw.reviewer.web:
-                # self.debug.log("Reviewer or WebView not ready")
-                return
-
-            self.current_card = card
-            self.has_chatted_for_card = False
-
-            # Get deck settings
-            deck_id = str(card.did)
-            deck_settings = self.config["deck_settings"].get(deck_id, {})
-            deck_enabled = deck_settings.get("enabled", False)
-
-            if not deck_enabled:
-                # self.debug.log(f"ChatBot disabled for deck {deck_id}")
-                return
+            return Outbox(connect())
+        except Exception as e:
+            # self.debug.log(f"Outbox error: {e}", True)
+            return None
 
-            # Get target field text
-            target_field = deck_settings.get("target_field", self.config["target_field"])
-            field_text = self.get_field_text(card, target_field)
+    def open_session_store(self):
+        """Transcript theo note; nếu không mở được database thì chỉ giữ trong bộ nhớ"""
+        page_size = self.config.get("chat_page_size", 6)
+        max_sessions = self.config.get("chat_sessions_in_memory", 20)
+        try:
+            return ChatSessionStore(connect(), page_size, max_sessions)
+        except Exception as e:
+            # self.debug.log(f"Session store error: {e}", True)
+            return ChatSessionStore(sqlite3.connect(":memory:", check_same_thread=False), page_size, max_sessions)
 
-            if not field_text.strip():
-                # self.debug.log(f"Empty field text for field: {target_field}")
-                return
+    def start_outbox_timer(self):
+        """Định kỳ kiểm tra mạng và xả outbox"""
+        if not self.outbox:
+            return
+        self.outbox_timer = QTimer(mw)
+        self.outbox_timer.timeout.connect(self.check_outbox)
+        self.outbox_timer.start(int(self.config.get("outbox_probe_interval", 30)) * 1000)
 
-            # Get prompt template
-            prompt_key = deck_settings.get("selected_prompt", self.config["selected_prompt"])
-            prompt_template = self.config["custom_prompts"].get(prompt_key, "Bạn có muốn biết thêm về: {text}")
+    def check_outbox(self):
+        if self.outbox_draining or not self.config.get("api_key") or not mw.col:
+            return
+        if not self.outbox.is_offline() and not self.outbox.pending_count():
+            return
+        self.outbox_draining = True
+        mw.taskman.run_in_background(self._drain_outbox, self._on_outbox_drained)
+
+    def _drain_outbox(self):
+        """Chạy ở background thread"""
+        if not is_online():
+            self.outbox.mark_offline()
+            return []
+        self.outbox.mark_online()
+        with TRACER.span("outbox.drain", "scheduler"):
+            return self.outbox.drain(
+                self.client, self.response_cache, self.config.get("language", "vi"),
+                concurrency=self.config.get("outbox_concurrency", 2),
+            )
+
+    @traced("outbox.deliver")
+    def _on_outbox_drained(self, future):
+        """Main thread: ghi câu trả lời của bulk item vào note"""
+        self.outbox_draining = False
+        try:
+            delivered = future.result()
+        except Exception as e:
+            # self.debug.log(f"Outbox drain error: {e}", True)
+            return
+        notes = []
+        done_ids = []
+        for row_id, note_id, output_field, answer in delivered:
+            done_ids.append(row_id)
+            try:
+                note = mw.col.get_note(note_id)
+            except Exception:
+                continue # Note đã bị xoá
+            if output_field in note and not note[output_field].strip():
+                note[output_field] = answer
+                notes.append(note)
+        if notes:
+            mw.col.update_notes(notes)
+        self.outbox.remove(done_ids)
+
+    def make_card_prompt(self, deck_id, prompt_key, template, content, media=()):
+        """CardPrompt dùng làm key cache cho (deck, prompt, nội dung card, ảnh gửi kèm)"""
+        # Model của profile cấu hình (không phải profile dự phòng) để key không đổi khi fallback
+        return CardPrompt(prompt_key, template, content, self.client.profile(deck_id).model,
+                          self.client.deck_system_context(deck_id), media)
 
-            # self.debug.log(f"Showing button for: {field_text[:30]}...")
-            self.show_chatbot_button(field_text, prompt_template)
+    def register_shortcut(self):
+        """Register global shortcut Ctrl+Y to open chat window"""
+        try:
+            # Ctrl + Y → open ChatBot
+            shortcut_open = QShortcut(QKeySequence("Ctrl+Y"), mw)
+            shortcut_open.setContext(Qt.ShortcutContext.ApplicationShortcut)
             shortcut_open.activated.connect(self.open_chat_window)
 
             # Ctrl + U → close ChatBot
@@ -249,9 +198,9 @@ class GeminiChatBot:
             pass
 
     def register_handlers(self):
-        """Register message handlers"""
-        from aqt.gui_hooks import webview_did_receive_js_message
-        webview_did_receive_js_message.append(self.handle_pycmd)
+        """Register message handlers (một router duy nhất cho mọi message của add-on)"""
+        self.router.register()
+        self.router.add("open", lambda data: self.open_chat_window(), owner=self)
         # self.debug.log("PyCmd handlers registered")
 
     def register_hooks(self):
@@ -270,46 +219,55 @@ class GeminiChatBot:
 
         # self.debug.log(f"Registered {len(hooks)} hooks")
 
+    @traced("on_state_change")
     def on_state_change(self, new_state, old_state):
         """Debug state changes"""
         # self.debug.log(f"State change: {old_state} → {new_state}")
         if old_state == "review" and new_state != "review":
             # self.debug.log("Leaving review → cleaning UI")
             self._cleanup_injected_elements()
+            self.prefetcher.stop()
 
-            if self.chat_window:
+            # Chat ở dock panel vẫn mở sau khi rời màn hình review
+            if self.chat_window and not self.chat_window.panel:
                 self.chat_window.close()
                 self.chat_window = None
 
-    def handle_pycmd(self, handled, cmd, context):
-        """
-        Handle pycmd messages
-        """
-        already_handled, result = handled
-
-        if already_handled:
-            return handled
-
-        # self.debug.log(f"PyCmd received: {cmd}")
-
-        if cmd == "gemini_chat_open":
-            self.open_chat_window()
-            return (True, None)
-        elif cmd.startswith("gemini_chat_send:"):
-            message = cmd.split(":", 1)[1]
-            if self.chat_window:
-                self.chat_window.send_message(message)
-                self.has_chatted_for_card = True
-            return (True, None)
-        
-        return handled
-
     def load_config(self) -> Dict[str, Any]:
         """Load configuration với defaults"""
         default_config = {
             "enabled": True,
             "api_key": "",
             "max_tokens": 500,
+            "latency_profile": "fast",
+            "latency_objective": 8,
+            "bulk_max_batch": 20,
+            "context_cache_ttl": 3600,
+            "context_cache_min_tokens": 1024,
+            "semantic_cache_enabled": True,
+            "outbox_probe_interval": 30,
+            "outbox_concurrency": 2,
+            "chat_page_size": 6,
+            "chat_sessions_in_memory": 20,
+            "chat_context_turns": 10,
+            "prompt_placeholder_cap": 4000,
+            "daily_token_budget": 0,
+            "monthly_token_budget": 0,
+            "budget_chat_reserve": 0.2,
+            "request_deadline": 40,
+            "bulk_request_deadline": 120,
+            "diagnostics_calls": 5,
+            "prefetch_cards": 5,
+            "prefetch_idle_delay": 2,
+            "chat_panel": False,
+            "stall_watchdog": False,
+            "stall_threshold_ms": 200,
+            "trace_cprofile": False,
+            "trace_tracemalloc": False,
+            "image_max_dimension": 768,
+            "image_max_per_card": 3,
+            "semantic_cache_max_entries": 10000,
+            "semantic_cache_thresholds": {"default": 0.92},
             "selected_prompt": "explain_simple",
             "target_field": "Front",
             "custom_prompts": {
@@ -336,6 +294,7 @@ class GeminiChatBot:
             # self.debug.log(f"Config load error: {e}", True)
             return default_config
 
+    @traced("save_config")
     def save_config(self):
         """Save configuration"""
         try:
@@ -354,13 +313,19 @@ class GeminiChatBot:
             actions = [
                 (get_text(lang, "menu_config"), self.show_config_dialog),
                 (get_text(lang, "menu_deck_config"), self.show_deck_config),
-                (get_text(lang, "menu_test_api"), self.test_api_key),
-                (get_text(lang, "menu_debug"), self.show_debug_info)
+                (get_text(lang, "menu_search"), self.show_search_dialog),
+                (get_text(lang, "menu_export_pack"), self.export_answer_pack),
+                (get_text(lang, "menu_import_pack"), self.import_answer_pack),
+                (get_text(lang, "menu_test_api"), self.run_diagnostics),
+                (get_text(lang, "menu_debug"), self.show_debug_info),
+                (get_text(lang, "menu_stall_report"), self.show_stall_report),
+                (get_text(lang, "menu_trace"), self.toggle_trace_capture)
             ]
 
             for name, handler in actions:
                 action = QAction(name, mw)
-                action.triggered.connect(handler)
+                # Bỏ tham số checked: handler có thể được bọc bởi traced (*args)
+                action.triggered.connect(lambda checked=False, handler=handler: handler())
                 menu.addAction(action)
 
             mw.form.menuTools.addMenu(menu)
@@ -370,6 +335,57 @@ class GeminiChatBot:
             # self.debug.log(f"Menu setup error: {e}", True)
             pass
 
+    def show_search_dialog(self):
+        """Tìm trong các cuộc chat đã lưu"""
+        lang = self.config.get("language", "vi")
+        if not self.sessions.search_index:
+            showInfo(get_text(lang, "search_unavailable"))
+            return
+        self.search_dialog = ChatSearchDialog(self.config, self.sessions.search_index)
+        self.search_dialog.show()
+
+    def apply_watchdog(self):
+        """Bật / tắt stall watchdog theo config"""
+        if self.config.get("stall_watchdog", False):
+            WATCHDOG.start(self.config.get("stall_threshold_ms", 200))
+        else:
+            WATCHDOG.stop()
+
+    def toggle_trace_capture(self):
+        """Bắt đầu / dừng ghi trace (Chrome Trace Event format) để phân tích hiệu năng"""
+        lang = self.config.get("language", "vi")
+        if not TRACER.enabled:
+            TRACER.start(profile=self.config.get("trace_cprofile", False),
+                         memory=self.config.get("trace_tracemalloc", False))
+            tooltip(get_text(lang, "trace_started"))
+            return
+        events, other, profiler = TRACER.stop()
+        default = os.path.join(USER_FILES_DIR, time.strftime("gemini-trace-%Y%m%d-%H%M%S.json"))
+        path, _ = QFileDialog.getSaveFileName(mw, get_text(lang, "menu_trace"), default, "Chrome trace (*.json)")
+        if not path:
+            return
+        if not path.endswith(".json"):
+            path += ".json"
+        try:
+            TRACER.export(path, events, other, profiler)
+        except OSError as e:
+            showInfo(get_text(lang, "trace_save_failed", error=e))
+            return
+        showInfo(get_text(lang, "trace_saved", count=len(events), path=path))
+
+    def show_stall_report(self):
+        """Các lần UI bị treo, xếp theo entry point của add-on đang chạy"""
+        lang = self.config.get("language", "vi")
+        threshold = self.config.get("stall_threshold_ms", 200)
+        if not WATCHDOG.enabled:
+            showInfo(get_text(lang, "stall_watchdog_off"))
+            return
+        lines = WATCHDOG.report()
+        if not lines:
+            showInfo(get_text(lang, "stall_report_empty", threshold=threshold))
+            return
+        showInfo("\n".join([get_text(lang, "stall_report_title", threshold=threshold), ""] + lines))
+
     def show_debug_info(self):
         """Show debug information"""
         info = [
@@ -384,16 +400,100 @@ class GeminiChatBot:
             "Check console for detailed logs"
         ]
 
+        info += [
+            "",
+            "=== RESPONSE CACHE ===",
+            f"Exact hits: {int(METRICS.get('cache.exact_hits'))}",
+            f"Semantic hits: {int(METRICS.get('cache.semantic_hits'))}",
+            f"Misses: {int(METRICS.get('cache.misses'))}",
+            f"Semantic index: {'on' if self.response_cache and self.response_cache.semantic is not None else 'off'}",
+        ]
+        if self.packs and self.packs.packs:
+            info += ["", "=== ANSWER PACKS ==="]
+            info += [f"{pack.name}: {pack.count:,} answers" for pack in self.packs.packs]
+            info.append(f"Hits: {int(METRICS.get('packs.hits'))}, misses: {int(METRICS.get('packs.misses'))}, "
+                        f"corrupt entries: {int(METRICS.get('packs.corrupt'))}")
+        info += [
+            "",
+            "=== REQUESTS ===",
+            f"Calls: {int(METRICS.get('singleflight.calls'))}",
+            f"Shared with an in-flight call: {int(METRICS.get('singleflight.shared'))} "
+            f"({self.client.flights.dedup_rate():.0%})",
+            f"Duplicate chat sends ignored: {int(METRICS.get('chat.duplicate_sends'))}",
+            "Circuit breaker: {} (retry in {:.0f}s)".format(*self.client.breaker().snapshot()),
+            f"Prefetched answers: {int(METRICS.get('prefetch.generated'))} generated, "
+            f"{int(METRICS.get('prefetch.hits'))} used in chat",
+            f"Images: {int(METRICS.get('images.encoded'))} encoded "
+            f"({int(METRICS.get('images.encoded_bytes')) // 1024} KB base64), "
+            f"{int(METRICS.get('images.disk_hits') + METRICS.get('images.memory_hits'))} from cache",
+        ]
+        bulk_failed = METRICS.by_labels("bulk.failed")
+        if bulk_failed:
+            kinds = ", ".join(f"{dict(labels).get('kind')}: {int(count)}" for labels, count in sorted(bulk_failed.items()))
+            info.append(f"Bulk items failed: {int(sum(bulk_failed.values()))} ({kinds})")
+        latency = self.client.latency.snapshot()
+        if latency:
+            info += ["", f"=== LATENCY (objective p95 {self.config.get('latency_objective', 8)}s) ==="]
+            for model, (samples, p95, degraded) in sorted(latency.items()):
+                info.append(f"{model}: p95 {p95:.1f}s over {samples} requests"
+                            + (" — slow, using a faster profile" if degraded else ""))
+            info.append(f"Fallback requests: {int(sum(METRICS.by_labels('latency.fallbacks').values()))}, "
+                        f"probes: {int(sum(METRICS.by_labels('latency.probes').values()))}")
+        actions = METRICS.get("bridge.actions")
+        round_trips = METRICS.get("bridge.js_messages") + METRICS.get("bridge.py_evals")
+        info += [
+            "",
+            "=== WEBVIEW BRIDGE ===",
+            f"JS → Python: {int(METRICS.get('bridge.js_messages'))} messages, {int(METRICS.get('bridge.js_bytes'))} bytes",
+            f"Python → JS: {int(METRICS.get('bridge.py_evals'))} evals, {int(METRICS.get('bridge.py_bytes'))} bytes",
+            f"Round trips per user action: {round_trips / actions:.1f}" if actions else "Round trips per user action: -",
+            f"Router: {len(self.router.routes)} routes, {int(METRICS.get('router.invocations'))} invocations",
+        ]
+        if self.outbox:
+            info += [
+                "",
+                "=== OUTBOX ===",
+                f"Offline: {'Yes' if self.outbox.is_offline() else 'No'}",
+                f"Pending: {self.outbox.pending_count()}",
+                f"Failed (gave up after {MAX_ATTEMPTS} API errors): {self.outbox.failed_count()}",
+            ]
+
+        prefix_lines = prefix_cache_report(self._deck_name)
+        if prefix_lines:
+            info += ["", "=== PREFIX CACHE ==="] + prefix_lines
+
+        savings_lines = token_savings_report(self._deck_name)
+        if savings_lines:
+            info += ["", "=== CARD TEXT CLEANUP ==="] + savings_lines
+
+        if self.usage:
+            info += ["", "=== TOKEN USAGE ==="] + usage_report(self.usage, self.client.budget, self._deck_name)
+
         showInfo("\n".join(info))
 
+    def _deck_name(self, deck_id):
+        """Tên deck cho báo cáo, fallback về id"""
+        try:
+            return mw.col.decks.name(int(deck_id))
+        except Exception:
+            return str(deck_id)
+
+    @traced("on_show_question")
     def on_show_question(self, card):
         """Called when question is shown"""
         try:
             # self.debug.log("=== on_show_question TRIGGERED ===")
             # self.debug.log(self.debug.inspect_card(card))
 
-            # Remove existing chat UI and button on new card
-            self._cleanup_injected_elements()
+            panel_mode = self.config.get("chat_panel", False)
+            if self.chat_window:
+                # Câu trả lời cho card trước không còn cần: huỷ request đang chờ (cả socket)
+                # và tách transcript của note trước khỏi cửa sổ chat
+                self.chat_window.cancel_pending()
+                self.chat_window.set_session(None)
+            if not panel_mode:
+                # Remove existing chat UI and button on new card
+                self._cleanup_injected_elements()
 
             # Check if addon is enabled
             if not self.config["enabled"]:
@@ -407,6 +507,13 @@ class GeminiChatBot:
 
             self.current_card = card
             self.has_chatted_for_card = False
+            # Card tiếp theo được sinh trước khi người dùng không thao tác
+            self.prefetcher.schedule()
+
+            if panel_mode:
+                # Chat ở dock panel: không inject gì vào trang reviewer, chỉ chuyển ngữ cảnh
+                self.switch_panel_card()
+                return
 
             # Get deck settings
             deck_id = str(card.did)
@@ -436,24 +543,27 @@ class GeminiChatBot:
             # self.debug.log(f"Error in on_show_question: {e}", True)
             pass
 
-    def get_field_text(self, card, target_field):
-        """Get text from target field"""
-        note = card.note()
-
-        # Try exact match first
-        if target_field in note:
-            return note[target_field]
+    def get_field_text(self, card, target_field, count_tokens=False):
+        """Get cleaned text from target field (không HTML, media; cloze theo card.ord).
 
-        # Try case-insensitive match
-        for field_name, field_value in note.items():
-            if field_name.lower() == target_field.lower():
-                return field_value
-
-        # Fallback to first field
-        if note.fields:
-            return note.fields[0]
-
-        return ""
+        count_tokens: text được đưa vào prompt → ghi nhận token tiết kiệm cho deck.
+        """
+        note = card.note()
+        field_name = self.resolve_field_name(note, target_field)
+        if field_name is None:
+            return ""
+        deck_id = card.did if count_tokens else None
+        return self.card_text.get(note, field_name, card.ord + 1, deck_id)
+
+    def card_content(self, card, template, target_field, count_tokens=False):
+        """Khối nội dung của card cho template (xem card_text.card_content)"""
+        return card_content(card, card.note(), template, target_field, self.card_text, self._deck_name,
+                            self.config.get("prompt_placeholder_cap", DEFAULT_CAP),
+                            card.did if count_tokens else None)
+
+    def resolve_field_name(self, note, target_field):
+        """Tên field thực tế của note cho target_field"""
+        return resolve_field_name(note, target_field)
 
     def show_chatbot_button(self, text: str, prompt: str):
         """Show floating chatbot button"""
@@ -572,14 +682,14 @@ class GeminiChatBot:
             {css}
             <div id="gemini-chatbot-tooltip-container">
                 <div class="gemini-tooltip">{formatted_prompt}</div>
-                <button id="gemini-chatbot-btn" onclick="pycmd('gemini_chat_open')">
+                <button id="gemini-chatbot-btn" onclick="geminiBridge.post('open')">
                     {robot_icon}
                 </button>
             </div>
             """
 
-            # Inject into reviewer webview
-            js_code = f"""
+            # Inject into reviewer webview (cùng runtime bridge cho nút mở chat)
+            js_code = BRIDGE_JS + f"""
             console.log('Injecting Gemini ChatBot button...');
 
             // Remove existing button and tooltip container
@@ -587,7 +697,7 @@ class GeminiChatBot:
             if (existingBtnContainer) existingBtnContainer.remove();
 
             // Add new button
-            document.body.insertAdjacentHTML('beforeend', `{html}`);
+            document.body.insertAdjacentHTML('beforeend', {json.dumps(html, ensure_ascii=False)});
 
             console.log('Gemini ChatBot button injected successfully');
             """
@@ -611,9 +721,12 @@ class GeminiChatBot:
             mw.reviewer.web.eval(js_cleanup)
             # self.debug.log("Cleaned up injected chat UI elements.")
 
+    @traced("on_review_end")
     def on_review_end(self):
         """Clean up when review ends"""
         try:
+            if self.chat_window:
+                self.chat_window.cancel_pending()
             self._cleanup_injected_elements()
             # self.debug.log("Review ended - cleanup completed")
         except Exception as e:
@@ -623,7 +736,7 @@ class GeminiChatBot:
     def close_chat_window(self):
         """Close chat window"""
         if self.chat_window:
-            self.chat_window.close()
+            self.chat_window.dispose()
             self.chat_window = None
             # self.debug.log("Chat window closed")    
 
@@ -640,44 +753,14 @@ class GeminiChatBot:
             return
 
         try:
+            panel_mode = self.config.get("chat_panel", False)
+            if self.chat_window and bool(self.chat_window.panel) != panel_mode:
+                # Đã đổi chế độ hiển thị trong config
+                self.close_chat_window()
             # Initialize chat_window if it doesn't exist
             if self.chat_window is None:
-                self.chat_window = ChatWindow(self)
-                # Inject/show the chat UI
-            self.chat_window.inject_ui()
-            # ====== TẠO PROMPT TỰ ĐỘNG ======
-            
-            deck_id = str(self.current_card.did)
-            deck_settings = self.config["deck_settings"].get(deck_id, {})
-            # self.debug.log(f"Deck settings for chat window: {deck_settings}")
-
-            target_field = deck_settings.get("target_field")
-            # self.debug.log(f"Target field: {target_field}")
-
-            # ✅ Lấy content của field
-            card_content = self.get_field_text(self.current_card, target_field)
-            # self.debug.log(f"Field value: {card_content}")
-
-            prompt_key = deck_settings.get("selected_prompt") \
-                        or self.config.get("selected_prompt")
-
-            # self.debug.log(f"Prompt key selected: {prompt_key}")
-
-            prompt_template = self.config["custom_prompts"].get(prompt_key)
-
-            # Nếu prompt không nằm trong custom_prompt → dùng default
-            if not prompt_template:
-                prompt_template = "Giải thích về: {text}"
-
-            # self.debug.log(f"Resolved prompt template: {prompt_template}")
-            auto_prompt = prompt_template.replace("{text}", card_content)
-            # self.debug.log(f"Auto prompt generated: {auto_prompt}")
-
-            if not self.has_chatted_for_card:
-                self.chat_window.pre_fill_input(auto_prompt)
-            else:
-                self.chat_window.pre_fill_input("")
-            # self.debug.log("Chat window injected/shown successfully")
+                self.chat_window = ChatWindow(self, self.open_chat_panel() if panel_mode else None)
+            self.attach_chat_card()
 
         except Exception as e:
             lang = self.config.get("language", "vi")
@@ -687,76 +770,217 @@ class GeminiChatBot:
                 showInfo(f"Error: {e}")
             # self.debug.log(f"Error opening chat window: {e}", True)
 
-    def call_gemini_api(self, input_data) -> str:
-        """Call Gemini API với error handling"""
-        lang = self.config.get("language", "vi")
-        if not self.config.get("api_key"):
-            return get_text(lang, "api_key_missing")
+    def open_chat_panel(self):
+        """Dock widget của chat (tạo một lần, webview được giữ lại)"""
+        if self.chat_panel is None:
+            self.chat_panel = ChatPanel(get_text(self.config.get("language", "vi"), "header"))
+        return self.chat_panel
+
+    def close_chat_panel(self):
+        """Bỏ dock widget (đổi config: theme, ngôn ngữ...); lần mở sau tạo lại"""
+        if self.chat_window and self.chat_window.panel:
+            self.close_chat_window()
+        if self.chat_panel:
+            self.chat_panel.dispose()
+            self.chat_panel = None
+
+    def switch_panel_card(self):
+        """Card mới trong chế độ panel: chuyển chat đang mở sang note của card"""
+        chat_window = self.chat_window
+        if not chat_window or not chat_window.panel or not chat_window.panel.isVisible():
+            return
+        try:
+            self.attach_chat_card()
+        except Exception:
+            # Deck không bật chatbot: vẫn hiện transcript, không có prompt tự động
+            chat_window.pre_fill_input("")
+
+    def attach_chat_card(self):
+        """Gắn cửa sổ chat với card hiện tại: transcript của note, câu trả lời từ
+        outbox và prompt tự động."""
+        # Transcript đã lưu của note (chỉ các lượt gần nhất)
+        self.chat_window.set_session(self.sessions.get(self.current_card.nid))
+        self.chat_window.session.deck_id = self.current_card.did
+        self.chat_window.auto_prompt = self.chat_window.card_prompt = None
+        # Inject/show the chat UI
+        self.chat_window.show()
+        if self.outbox:
+            # Câu trả lời cho các câu hỏi gửi lúc offline
+            delivered = self.outbox.take_delivered_chat(self.current_card.nid)
+            if delivered:
+                self.chat_window.show_delivered(delivered)
+                self.has_chatted_for_card = True
+        # ====== TẠO PROMPT TỰ ĐỘNG ======
+        prompt_key, auto_prompt, card_prompt = self.auto_prompt_for(self.current_card, count_tokens=True)
+        self.chat_window.prompt_key = prompt_key
+        self.chat_window.session.prompt_key = prompt_key
+        self.chat_window.auto_prompt = auto_prompt
+        self.chat_window.card_prompt = card_prompt
+        # self.debug.log(f"Auto prompt generated: {auto_prompt}")
+
+        if not self.has_chatted_for_card and not self.chat_window.session.turns:
+            self.chat_window.pre_fill_input(auto_prompt)
+        else:
+            self.chat_window.pre_fill_input("")
+        # self.debug.log("Chat window injected/shown successfully")
 
-        api_key = self.config.get("api_key")
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:generateContent?key={api_key}"
+    def auto_prompt_for(self, card, count_tokens=False):
+        """Prompt tự động của card → (prompt_key, auto_prompt, card_prompt).
+
+        Dùng chung cho chat và prefetch để hai bên gửi cùng một payload.
+        """
+        deck_id = str(card.did)
+        deck_settings = self.config["deck_settings"].get(deck_id, {})
+        # self.debug.log(f"Deck settings for chat window: {deck_settings}")
+
+        target_field = deck_settings.get("target_field")
+        # self.debug.log(f"Target field: {target_field}")
+
+        prompt_key = deck_settings.get("selected_prompt") \
+                    or self.config.get("selected_prompt")
+
+        # self.debug.log(f"Prompt key selected: {prompt_key}")
+
+        prompt_template = self.config["custom_prompts"].get(prompt_key)
+
+        # Nếu prompt không nằm trong custom_prompt → dùng default
+        if not prompt_template:
+            prompt_template = "Giải thích về: {text}"
+
+        # ✅ Lấy content của card cho các placeholder của template
+        card_content = self.card_content(card, prompt_template, target_field, count_tokens)
+        # self.debug.log(f"Field value: {card_content}")
+
+        # Instruction tĩnh trước, nội dung card sau (tận dụng implicit prefix cache)
+        # Ô input một dòng sẽ bỏ mất xuống dòng → dùng ": " làm phân cách
+        auto_prompt = assemble_prompt(prompt_template, card_content, self.config.get("language", "vi"),
+                                      separator=": ")
+        media = self.card_media(card, prompt_template, target_field) if deck_settings.get("send_images") else []
+        return prompt_key, auto_prompt, self.make_card_prompt(deck_id, prompt_key, prompt_template, card_content,
+                                                              media)
+
+    def card_media(self, card, template, target_field):
+        """Ảnh trong các field của prompt → [(đường dẫn, key cache)] (chỉ stat file, chưa encode)"""
+        if not self.images:
+            return []
+        media_dir = mw.col.media.dir()
+        media = []
+        for name in template_images(card.note(), template, target_field):
+            path = media_path(media_dir, name)
+            key = self.images.key(path) if path else None
+            if key:
+                media.append((path, key))
+            if len(media) >= self.config.get("image_max_per_card", 3):
+                break
+        return media
+
+    def image_parts(self, media):
+        """inlineData cho các ảnh (encode + cache khi cần; gọi từ background thread)"""
+        parts = (self.images.part(path, key) for path, key in media)
+        return [part for part in parts if part is not None]
+
+    def cached_answer(self, card_prompt):
+        """Câu trả lời có sẵn cho CardPrompt: response cache của máy rồi tới answer pack"""
+        if self.response_cache:
+            cached = self.response_cache.get(card_prompt)
+            if cached is not None:
+                return cached
+        if self.packs:
+            return self.packs.get(card_prompt)
+        return None
+
+    def call_gemini_api(self, input_data, deck_id=None, prompt_key=None, card_prompt=None) -> str:
+        """Call Gemini API với error handling"""
+        try:
+            return self.generate_text(input_data, deck_id, prompt_key, card_prompt)
+        except GeminiError as e:
+            return self.format_api_error(e)
+
+    def generate_text(self, input_data, deck_id=None, prompt_key=None, card_prompt=None,
+                      cancel_token=None, request_class="chat", media=None) -> str:
+        """Gọi Gemini, raise GeminiError khi lỗi.
+
+        card_prompt: CardPrompt nếu request là prompt tự động của card → dùng cache.
+        cancel_token: CancelToken để huỷ request đang chạy.
+        request_class: "chat" hoặc "prefetch" (ưu tiên thấp, theo ngân sách nền).
+        media: ảnh của card gửi kèm lượt user đầu tiên (mặc định: ảnh của card_prompt).
+        """
+        if card_prompt:
+            cached = self.cached_answer(card_prompt)
+            if cached is not None:
+                if request_class == "chat" and self.prefetcher.take(card_prompt.key):
+                    METRICS.incr("prefetch.hits")
+                return cached
+
+        if self.outbox and self.outbox.is_offline():
+            # Đang mất mạng → không chờ retry
+            raise GeminiError("network", "offline")
+
+        if media is None:
+            media = card_prompt.media if card_prompt else ()
+        if media and self.images and isinstance(input_data, list):
+            input_data = attach_images(input_data, self.image_parts(media))
 
-        # === LOGIC SỬA ĐỔI Ở ĐÂY ===
         # Kiểm tra input_data là string (Test API) hay list (Chat History)
-        if isinstance(input_data, str):
-            # Nếu là string, gói nó vào format của Gemini
-            contents = [{"parts": [{"text": input_data}]}]
-        else:
-            # Nếu là list (history), dùng trực tiếp
-            contents = input_data
-
-        payload = {
-            "contents": contents, # Truyền thẳng contents đã xử lý
-            "generationConfig": {
-                "maxOutputTokens": self.config.get("max_tokens", 500), 
-                "temperature": 0.7,
-            }
-        }
+        payload, model = self.client.build_profile_payload(input_data, deck_id)
 
         # self.debug.log("Calling Gemini API...")
-
-        # retry on 429 (rate limit) with exponential backoff
-        max_attempts = 3
-        backoff = 1.0
-        for attempt in range(1, max_attempts + 1):
-            try:
-                response = requests.post(url, json=payload, timeout=30)
-                # self.debug.log(f"Response: {response.status_code} - {response.text}")
-                if response.status_code == 429:
-                    # self.debug.log(f"Gemini API rate-limited (429). Attempt {attempt}/{max_attempts}")
-                    if attempt < max_attempts:
-                        time.sleep(backoff)
-                        backoff *= 2
-                        continue
-                    else:
-                        return get_text(lang, "rate_limit")
-                response.raise_for_status()
-
-                result = response.json()
-
-                # Safely extract response text
-                response_text = ""
-                try:
-                    response_text = result.get("candidates", [])[0].get("content", {}).get("parts", [])[0].get("text", "")
-                except (IndexError, TypeError): # Handle cases where candidates or content might be missing
-                    # If text is not found, try to return error message from API
-                    error_message = result.get("error", {}).get("message", str(result))
-                    # self.debug.log(f"Gemini API response parsing error, full result: {result}")
-                    return f"❌ Gemini Error: {error_message}"
-
-                # self.debug.log("Gemini API call successful")
-                return response_text
-
-            except requests.exceptions.RequestException as e:
-                # self.debug.log(f"Gemini API network error (attempt {attempt}): {e}")
-                if attempt < max_attempts:
-                    time.sleep(backoff)
-                    backoff *= 2
-                    continue
-                return get_text(lang, "connection_error", e=e)
-            except Exception as e:
-                # self.debug.log(f"Gemini API unexpected error: {e}", True)
-                return get_text(lang, "internal_error", e=e)
+        result = self.client.generate(payload, model, deck_id=deck_id, prompt_key=prompt_key,
+                                      cancel_token=cancel_token, request_class=request_class)
+        text = extract_text(result)
+        if card_prompt and self.response_cache:
+            self.response_cache.put(card_prompt, text)
+        return text
+
+    def answer_chat(self, request):
+        """Trả lời một ChatRequest → (text, status); status là ok / error / queued / cancelled.
+
+        Lỗi mạng không hiện như câu trả lời: lượt chat được đưa vào outbox và
+        câu trả lời sẽ hiện ở lần mở chat kế tiếp của card.
+        """
+        try:
+            return self.generate_text(request.history, request.deck_id, request.prompt_key,
+                                      request.card_prompt, request.token, media=request.media), "ok"
+        except GeminiError as e:
+            if e.kind == "cancelled":
+                return "", "cancelled"
+            if e.kind != "network" or not self.outbox:
+                return self.format_api_error(e), "error"
+            self.outbox.mark_offline()
+            self.outbox.add_chat(request.note_id, request.card_id, request.deck_id, request.prompt_key,
+                                 request.question, request.history, request.card_prompt)
+            return get_text(self.config.get("language", "vi"), "queued_offline"), "queued"
+
+    def format_api_error(self, error: GeminiError) -> str:
+        """Chuyển GeminiError thành thông báo hiển thị cho người dùng"""
+        lang = self.config.get("language", "vi")
+        if error.kind == "api_key_missing":
+            return get_text(lang, "api_key_missing")
+        if error.kind == "rate_limit":
+            return get_text(lang, "rate_limit")
+        if error.kind == "budget":
+            return get_text(lang, "budget_exhausted")
+        if error.kind == "timeout":
+            return get_text(lang, "api_timeout", e=error)
+        if error.kind == "unavailable":
+            return get_text(lang, "api_unavailable", seconds=int(self.client.breaker().retry_in()) + 1)
+        if error.kind == "network":
+            return get_text(lang, "connection_error", e=error)
+        if error.kind == "api":
+            return f"❌ Gemini Error: {error}"
+        return get_text(lang, "internal_error", e=error)
+
+    def run_bulk_job(self, deck_id):
+        """Sinh câu trả lời cho toàn bộ deck theo batch"""
+        lang = self.config.get("language", "vi")
+        if not self.config["api_key"]:
+            showInfo(get_text(lang, "api_key_missing"))
+            return
+        if self.bulk_job and self.bulk_job.thread:
+            showInfo(get_text(lang, "bulk_already_running"))
+            return
+        self.bulk_job = BulkJob(self, deck_id)
+        self.bulk_job.start()
 
     def show_config_dialog(self):
         """Show configuration dialog"""
@@ -767,6 +991,9 @@ class GeminiChatBot:
             if dialog.exec():
                 self.config = dialog.get_config()
                 self.save_config()
+                self.apply_watchdog()
+                # Panel được tạo lại với theme / ngôn ngữ / chế độ mới
+                self.close_chat_panel()
                 showInfo(get_text(self.config.get("language", "vi"), "config_saved"))
         except Exception as e:
             # self.debug.log(f"Config dialog error: {e}", True)
@@ -781,30 +1008,105 @@ class GeminiChatBot:
             # self.debug.log(f"Deck config error: {e}", True)
             pass
 
-    def test_api_key(self):
-        """Test API key"""
+    def export_answer_pack(self):
+        """Xuất các câu trả lời đã cache thành answer pack để chia sẻ"""
         lang = self.config.get("language", "vi")
-        if not self.config["api_key"]:
-            showInfo(get_text(lang, "api_key_missing"))
+        if not self.response_cache:
+            showInfo(get_text(lang, "pack_export_empty"))
+            return
+        path, _ = QFileDialog.getSaveFileName(mw, get_text(lang, "menu_export_pack"),
+                                              "answers.gapk", "Answer packs (*.gapk)")
+        if not path:
+            return
+        if not path.endswith(".gapk"):
+            path += ".gapk"
+        cache = self.response_cache
+
+        def on_done(future):
+            try:
+                count = future.result()
+            except Exception as e:
+                showInfo(get_text(lang, "pack_invalid", error=e))
+                return
+            if count:
+                showInfo(get_text(lang, "pack_export_done", count=count, path=path))
+            else:
+                os.remove(path)
+                showInfo(get_text(lang, "pack_export_empty"))
+
+        meta = {"name": os.path.basename(path)[:-len(".gapk")]}
+        mw.taskman.run_in_background(lambda: write_pack(path, cache.pack_answers(), meta), on_done)
+
+    def import_answer_pack(self):
+        """Import answer pack của người khác làm cache chỉ đọc"""
+        lang = self.config.get("language", "vi")
+        if not self.packs:
+            return
+        path, _ = QFileDialog.getOpenFileName(mw, get_text(lang, "menu_import_pack"), "",
+                                              "Answer packs (*.gapk)")
+        if not path:
+            return
+        try:
+            pack = self.packs.import_pack(path)
+        except (OSError, PackError) as e:
+            showInfo(get_text(lang, "pack_invalid", error=e))
             return
+        showInfo(get_text(lang, "pack_import_done", name=pack.name, count=pack.count))
 
-        # self.debug.log("Testing API key...")
-        result = self.call_gemini_api("Xin chào! Hãy trả lời ngắn gọn 'Kết nối thành công!'")
+    @traced("run_diagnostics")
+    def run_diagnostics(self):
+        """Kiểm tra API key và đo độ trễ endpoint trong background (không chặn UI)"""
+        lang = self.config.get("language", "vi")
+        targets = default_targets(self.config)
+        if not targets:
+            showInfo(get_text(lang, "api_key_missing"))
+            return
+        if self.diagnostics_running:
+            tooltip(get_text(lang, "diagnostics_running"))
+            return
 
-        if "Kết nối thành công" in result or "Success" in result or "success" in result:
-            showInfo(get_text(lang, "api_test_success"))
-            # self.debug.log("API test: SUCCESS")
-        else:
-            showInfo(get_text(lang, "api_test_failed", result=result))
-            # self.debug.log(f"API test: FAILED - {result}")
+        # self.debug.log("Running diagnostics...")
+        self.diagnostics_running = True
+        usage = self.usage
+        diagnostics = Diagnostics(
+            targets,
+            calls=self.config.get("diagnostics_calls", 5),
+            timeout=self.config.get("request_deadline", 40),
+            on_usage=(lambda u: usage.record(u, "chat", prompt_key="diagnostics")) if usage else None,
+        )
+        tooltip(get_text(lang, "diagnostics_started"))
+        mw.taskman.run_in_background(diagnostics.run, self._on_diagnostics_done)
+
+    def _on_diagnostics_done(self, future):
+        """Main thread: hiện kết quả diagnostics"""
+        self.diagnostics_running = False
+        lang = self.config.get("language", "vi")
+        try:
+            diagnostics = future.result()
+        except Exception as e:
+            showInfo(get_text(lang, "api_test_failed", result=e))
+            return
+        title = get_text(lang, "api_test_success" if diagnostics.healthy else "api_test_failed", result="")
+        showInfo("\n".join([title, ""] + diagnostics.report()))
+        # self.debug.log(f"Diagnostics: {'OK' if diagnostics.healthy else 'FAILED'}")
 
     def cleanup(self):
         """Clean up resources"""
         try:
             self._cleanup_injected_elements() # Ensure cleanup on profile close
             if self.chat_window:
-                self.chat_window.close() # Now chat_window.close() will hide the injected UI
+                self.chat_window.dispose() # Hide the injected UI and drop its routes
                 self.chat_window = None # Dereference the chat window
+            self.close_chat_panel()
+            # Gỡ handler khỏi webview_did_receive_js_message
+            self.router.unregister()
+            if self.bulk_job:
+                self.bulk_job.cancel()
+            self.prefetcher.stop()
+            # Không để request nào (chat, bulk, outbox) giữ thread/connection sau khi đóng profile
+            self.client.cancel_all()
+            if self.response_cache:
+                self.response_cache.close()
             # self.debug.log("Cleanup completed")
         except Exception as e:
             # self.debug.log(f"Cleanup error: {e}")
@@ -0,0 +1,322 @@
+import threading
+import time
+
+import requests
+
+from .circuit import BreakerRegistry
+from .latency_profiles import DEFAULT_PROFILE, PROFILES, LatencyMonitor, get_profile
+from .prompt_layout import record_usage
+from .single_flight import SingleFlight, flight_key
+from .tracing import TRACER
+from .transport import CancelToken, DeadlineExceeded, RequestCancelled, create_session, current_token, use_token
+from .usage import BudgetExceeded, TokenBudget, estimate_payload_tokens
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+DEFAULT_MODEL = PROFILES[DEFAULT_PROFILE].model
+
+# Timeout tối đa của từng bước; tổng thời gian bị giới hạn bởi deadline của request
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+
+class GeminiError(Exception):
+    """Lỗi khi gọi Gemini API.
+
+    kind: "api_key_missing", "rate_limit", "network", "api", "internal",
+    "timeout" (hết deadline của request), "unavailable" (circuit breaker đang
+    mở, request không được gửi), "budget" (vượt ngân sách token cục bộ,
+    request chưa được gửi) hoặc "cancelled" (request bị huỷ giữa chừng, không
+    phải lỗi).
+    """
+
+    def __init__(self, kind, message="", status=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status = status
+
+
+def extract_text(result):
+    """Lấy text của candidate đầu tiên, raise GeminiError nếu không có."""
+    try:
+        return result.get("candidates", [])[0].get("content", {}).get("parts", [])[0].get("text", "")
+    except (IndexError, TypeError, AttributeError):
+        # If text is not found, surface the error message from the API
+        error_message = result.get("error", {}).get("message", str(result)) if isinstance(result, dict) else str(result)
+        raise GeminiError("api", error_message)
+
+
+def finish_reason(result):
+    """finishReason của candidate đầu tiên (vd: STOP, MAX_TOKENS)."""
+    try:
+        return result.get("candidates", [])[0].get("finishReason", "")
+    except (IndexError, TypeError, AttributeError):
+        return ""
+
+
+class GeminiClient:
+    """HTTP client cho endpoint generateContent.
+
+    Không import aqt để có thể dùng lại ngoài GUI (bulk job, script).
+    """
+
+    def __init__(self, get_config, usage=None):
+        # get_config: callable trả về dict config hiện tại
+        self.get_config = get_config
+        # usage: UsageStore (None → không ghi nhận token, không giới hạn ngân sách)
+        self.usage = usage
+        self.budget = TokenBudget(usage, get_config) if usage is not None else None
+        self.http = create_session()
+        self.lock = threading.Lock()
+        self.active_tokens = set() # CancelToken của các request đang chạy
+        self.flights = SingleFlight() # Gộp các request giống hệt nhau đang chạy cùng lúc
+        self.breakers = BreakerRegistry() # Circuit breaker theo (backend, API key)
+        self.latency = LatencyMonitor() # p95 theo model → fallback sang profile nhanh hơn
+
+        from .context_cache import DeckContextCache
+        self.context_cache = DeckContextCache(self)
+
+    def deck_system_context(self, deck_id):
+        """System instruction dài của deck (grammar reference, style rules...)."""
+        if deck_id is None:
+            return ""
+        settings = self.get_config().get("deck_settings", {}).get(str(deck_id), {})
+        return (settings.get("system_context") or "").strip()
+
+    def profile(self, deck_id):
+        """LatencyProfile cấu hình cho deck (mặc định: latency_profile trong config)."""
+        config = self.get_config()
+        name = config.get("latency_profile", DEFAULT_PROFILE)
+        if deck_id is not None:
+            name = config.get("deck_settings", {}).get(str(deck_id), {}).get("latency_profile") or name
+        return get_profile(name)
+
+    def build_profile_payload(self, contents, deck_id=None):
+        """(payload, model) theo profile của deck, hoặc profile nhanh hơn khi model đang chậm."""
+        profile = self.latency.select(self.profile(deck_id), self.get_config().get("latency_objective", 8))
+        options = profile.payload_options(self.get_config().get("max_tokens", 500))
+        return self.build_payload(contents, **options), profile.model
+
+    def build_payload(self, contents, max_tokens=None, temperature=0.7, **generation_config):
+        """Tạo payload generateContent từ contents (string hoặc history)."""
+        if isinstance(contents, str):
+            contents = [{"parts": [{"text": contents}]}]
+        config = {
+            "maxOutputTokens": max_tokens or self.get_config().get("max_tokens", 500),
+            "temperature": temperature,
+        }
+        config.update(generation_config)
+        return {"contents": contents, "generationConfig": config}
+
+    def generate(self, payload, model=None, deck_id=None, prompt_key=None, cancel_token=None,
+                 request_class="chat"):
+        """Gọi generateContent và ghi nhận usageMetadata theo deck/prompt key/loại request.
+
+        cancel_token: CancelToken để huỷ request từ thread khác; khi bị huỷ
+        raise GeminiError("cancelled"). Request giống hệt một request đang chạy
+        dùng chung network call và kết quả của nó.
+        request_class: "chat", "prefetch" hoặc "bulk"; request nền bị giãn ra
+        hoặc từ chối (GeminiError("budget")) khi gần hết ngân sách token.
+        Mỗi request có deadline tổng (request_deadline, bulk_request_deadline)
+        bao gồm connect, chờ server và retry; hết hạn → GeminiError("timeout").
+        model: mặc định là model của latency profile của deck. Độ trễ của
+        request chat/prefetch được ghi vào LatencyMonitor (hết deadline tính
+        như một request chậm bằng deadline).
+        """
+        token = cancel_token or CancelToken()
+        with self.lock:
+            self.active_tokens.add(token)
+        config = self.get_config()
+        deadline = config.get("bulk_request_deadline", 120) if request_class == "bulk" \
+            else config.get("request_deadline", 40)
+        if model is None:
+            model = self.profile(deck_id).model
+
+        def call(flight_token):
+            flight_token.set_deadline(deadline)
+            started = time.monotonic()
+            try:
+                with use_token(flight_token), TRACER.span("gemini.call", "network", model=model):
+                    result = self._generate_with_context(payload, model, deck_id)
+            except DeadlineExceeded:
+                if request_class != "bulk":
+                    self.latency.record(model, deadline, config.get("latency_objective", 8))
+                raise
+            finally:
+                flight_token.clear_deadline()
+            if request_class != "bulk":
+                self.latency.record(model, time.monotonic() - started, config.get("latency_objective", 8))
+            return result
+
+        try:
+            token.check()
+            if self.budget is not None:
+                with TRACER.span("budget.admit", "scheduler", request_class=request_class):
+                    token.sleep(self.budget.admit(request_class, estimate_payload_tokens(payload)))
+            with TRACER.span("gemini.generate", "request", model=model, request_class=request_class) as span:
+                result, shared = self.flights.run(flight_key(payload, model, deck_id), token, call)
+                span["shared"] = shared
+        except DeadlineExceeded:
+            raise GeminiError("timeout", f"no answer within {deadline}s")
+        except RequestCancelled:
+            raise GeminiError("cancelled")
+        except BudgetExceeded as e:
+            raise GeminiError("budget", str(e))
+        finally:
+            with self.lock:
+                self.active_tokens.discard(token)
+        if isinstance(result, dict) and not shared:
+            # Request dùng chung kết quả không tốn thêm token
+            usage = result.get("usageMetadata")
+            record_usage(usage, deck_id, prompt_key)
+            if self.usage is not None:
+                self.usage.record(usage, request_class, deck_id, prompt_key)
+        return result
+
+    def breaker(self, api_key=None):
+        """CircuitBreaker của endpoint Gemini với API key (mặc định key trong config)."""
+        if api_key is None:
+            api_key = self.get_config().get("api_key")
+        return self.breakers.get(GEMINI_BASE_URL, api_key)
+
+    def cancel_all(self):
+        """Huỷ mọi request đang chạy (vd: khi đóng profile)."""
+        with self.lock:
+            tokens = list(self.active_tokens)
+        for token in tokens:
+            token.cancel()
+
+    def _generate_with_context(self, payload, model, deck_id):
+        """Gọi generateContent, kèm system context của deck nếu có.
+
+        Nếu server từ chối cached content (hết hạn, bị xoá) thì bỏ cache của
+        deck và gửi lại một lần với systemInstruction inline.
+        """
+        system_text = self.deck_system_context(deck_id)
+        if not system_text:
+            return self._post_generate(payload, model)
+        if model != self.profile(deck_id).model:
+            # Profile dự phòng: gửi inline, không tạo context cache cho model tạm thời
+            inline = dict(payload)
+            inline["systemInstruction"] = {"parts": [{"text": system_text}]}
+            return self._post_generate(inline, model)
+
+        prepared = self.context_cache.apply(deck_id, system_text, payload, model)
+        try:
+            return self._post_generate(prepared, model)
+        except GeminiError as e:
+            if "cachedContent" not in prepared or e.status not in (400, 403, 404):
+                raise
+            self.context_cache.invalidate(deck_id)
+            inline = dict(payload)
+            inline["systemInstruction"] = {"parts": [{"text": system_text}]}
+            return self._post_generate(inline, model)
+
+    def _send(self, breaker, method, url, read_timeout=READ_TIMEOUT, **kwargs):
+        """Một HTTP request qua circuit breaker, timeout không vượt deadline của request.
+
+        Lỗi mạng / 5xx → GeminiError("network") và được tính cho breaker; request
+        bị huỷ → RequestCancelled (hết deadline cũng tính là lỗi của backend).
+        """
+        if not breaker.allow():
+            raise GeminiError("unavailable", f"retry in {breaker.retry_in():.0f}s")
+        token = current_token() or CancelToken()
+        try:
+            timeout = (token.remaining(CONNECT_TIMEOUT), token.remaining(read_timeout))
+            # Không ghi query string (chứa API key) vào trace
+            with TRACER.span(f"http {method}", "network", path=url.split("?")[0].rsplit("/", 1)[-1]) as span:
+                response = self.http.request(method, url, timeout=timeout, **kwargs)
+                span["status"] = response.status_code
+            if response.status_code >= 500:
+                response.raise_for_status()
+        except (requests.exceptions.RequestException, RequestCancelled) as e:
+            if token.cancelled and not token.expired:
+                breaker.release()
+                raise RequestCancelled()
+            breaker.record_failure()
+            token.check()
+            status = e.response.status_code if getattr(e, "response", None) is not None else None
+            raise GeminiError("network", str(e), status=status)
+        breaker.record_success()
+        return response
+
+    def _request(self, method, path, payload=None, timeout=READ_TIMEOUT):
+        """Request một lần tới API, raise GeminiError với status khi lỗi HTTP."""
+        api_key = self.get_config().get("api_key")
+        if not api_key:
+            raise GeminiError("api_key_missing")
+        url = f"{GEMINI_BASE_URL}/{path}"
+        response = self._send(self.breaker(api_key), method, url, timeout, params={"key": api_key}, json=payload)
+        if response.status_code >= 400:
+            raise GeminiError("api", _error_message(response), status=response.status_code)
+        try:
+            return response.json() if response.content else {}
+        except ValueError as e:
+            raise GeminiError("internal", str(e))
+
+    def create_cached_content(self, model, system_text, ttl):
+        """Upload system instruction lên cachedContents, trả về tên cache."""
+        result = self._request("POST", "cachedContents", {
+            "model": f"models/{model}",
+            "systemInstruction": {"parts": [{"text": system_text}]},
+            "ttl": f"{int(ttl)}s",
+        })
+        name = result.get("name")
+        if not name:
+            raise GeminiError("api", "cachedContents response has no name")
+        return name
+
+    def update_cached_content_ttl(self, name, ttl):
+        self._request("PATCH", f"{name}?updateMask=ttl", {"ttl": f"{int(ttl)}s"})
+
+    def delete_cached_content(self, name):
+        self._request("DELETE", name)
+
+    def _post_generate(self, payload, model):
+        """POST payload tới generateContent và trả về JSON đã parse.
+
+        Retry khi bị rate limit (429) hoặc lỗi mạng/5xx với exponential backoff,
+        nếu backoff còn nằm trong deadline. Lỗi 4xx khác không được retry. Nếu
+        request bị huỷ (socket bị đóng hoặc đang chờ backoff) thì raise
+        RequestCancelled, không retry.
+        """
+        api_key = self.get_config().get("api_key")
+        if not api_key:
+            raise GeminiError("api_key_missing")
+
+        url = f"{GEMINI_BASE_URL}/models/{model}:generateContent?key={api_key}"
+
+        token = current_token() or CancelToken()
+        breaker = self.breaker(api_key)
+        max_attempts = 3
+        backoff = 1.0
+        for attempt in range(1, max_attempts + 1):
+            try:
+                response = self._send(breaker, "POST", url, json=payload)
+            except GeminiError as e:
+                if e.kind == "network" and attempt < max_attempts and token.can_wait(backoff):
+                    with TRACER.span("retry.backoff", "network", reason="network", seconds=backoff):
+                        token.sleep(backoff)
+                    backoff *= 2
+                    continue
+                raise
+            if response.status_code == 429:
+                if attempt < max_attempts and token.can_wait(backoff):
+                    with TRACER.span("retry.backoff", "network", reason="rate_limit", seconds=backoff):
+                        token.sleep(backoff)
+                    backoff *= 2
+                    continue
+                raise GeminiError("rate_limit", status=429)
+            if 400 <= response.status_code < 500:
+                raise GeminiError("api", _error_message(response), status=response.status_code)
+            try:
+                return response.json()
+            except ValueError as e:
+                # Body is not valid JSON
+                raise GeminiError("internal", str(e))
+
+
+def _error_message(response):
+    try:
+        return response.json().get("error", {}).get("message") or response.text
+    except ValueError:
+        return response.text
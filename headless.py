@@ -0,0 +1,457 @@
+"""Bulk generation không cần GUI: chạy trên file collection bằng thư viện anki.
+
+    python headless.py path/to/collection.anki2 [--deck "Tên deck"] [--workers 4]
+
+Collection không được mở trong Anki cùng lúc. Tiến độ được ghi vào journal
+(SQLite, mặc định <collection>.gemini-journal) nên chạy lại cùng lệnh sau khi
+bị ngắt sẽ tiếp tục từ chỗ dừng.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+if not __package__:
+    # Chạy trực tiếp: nạp thư mục add-on như một package tổng hợp để dùng các
+    # module không phụ thuộc aqt mà không chạy __init__.py (cần Anki GUI)
+    __package__ = "gemini_chatbot_headless"
+    if __package__ not in sys.modules:
+        _package = types.ModuleType(__package__)
+        _package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+        sys.modules[__package__] = _package
+
+from .answer_packs import AnswerPackShelf
+from .batching import AdaptiveBatcher, BatchItem
+from .card_text import CardTextCache, card_content
+from .gemini_client import GeminiClient
+from .latency_profiles import DEFAULT_PROFILE, get_profile
+from .prompt_templates import DEFAULT_CAP, load_template
+from .response_cache import CardPrompt, ResponseCache
+from .storage import ADDON_DIR, USER_FILES_DIR, connect
+from .usage import UsageStore
+
+# Lỗi làm dừng cả lần chạy (chạy tiếp chỉ tốn thời gian) và không tính là một
+# lần thử của note (không phải lỗi của note); lỗi khác chỉ làm hỏng item
+STOP_ERRORS = ("api_key_missing", "budget", "network", "unavailable")
+
+JOURNAL_SUFFIX = ".gemini-journal"
+
+
+def load_addon_config(path=None):
+    """Config như trong Anki: config.json của add-on, đè bởi config người dùng
+    (meta.json) rồi bởi file path (nếu có)."""
+    with open(os.path.join(ADDON_DIR, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    overlays = []
+    meta_path = os.path.join(ADDON_DIR, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            overlays.append(json.load(f).get("config") or {})
+    if path:
+        with open(path, encoding="utf-8") as f:
+            overlays.append(json.load(f))
+    for overlay in overlays:
+        prompts = {**config.get("custom_prompts", {}), **overlay.get("custom_prompts", {})}
+        config.update(overlay)
+        config["custom_prompts"] = prompts
+    config.setdefault("target_field", "Front")
+    return config
+
+
+class Journal:
+    """Trạng thái từng note của lần chạy (SQLite cạnh collection).
+
+    status: "answered" (đã có câu trả lời, chưa ghi vào collection),
+    "written" (đã ghi) hoặc "failed" (thử lại ở lần chạy sau, tối đa
+    max_attempts lần). Câu trả lời được ghi vào journal trước khi ghi vào
+    collection nên dừng giữa chừng không mất request nào đã trả tiền.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "nid INTEGER PRIMARY KEY, cid INTEGER, deck_id TEXT, output_field TEXT, status TEXT, "
+            "answer TEXT, error TEXT, attempts INTEGER DEFAULT 0, updated REAL)"
+        )
+
+    def answered(self):
+        """{nid: (output_field, answer)} đã có câu trả lời nhưng chưa ghi vào collection."""
+        rows = self.conn.execute("SELECT nid, output_field, answer FROM items WHERE status = 'answered'")
+        return {nid: (field, answer) for nid, field, answer in rows}
+
+    def exhausted(self, max_attempts):
+        """nid của các note đã thất bại max_attempts lần (bỏ qua)."""
+        rows = self.conn.execute(
+            "SELECT nid FROM items WHERE status = 'failed' AND attempts >= ?", (max_attempts,)
+        )
+        return {nid for nid, in rows}
+
+    def record(self, answered, failed):
+        """Ghi kết quả của một chunk trong một transaction.
+
+        answered: [(nid, cid, deck_id, output_field, answer)];
+        failed: [(nid, cid, deck_id, output_field, error)]. Lỗi trong STOP_ERRORS
+        (mất mạng, hết ngân sách...) không tăng attempts.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN")
+        self.conn.executemany(
+            "INSERT INTO items (nid, cid, deck_id, output_field, status, answer, updated) "
+            "VALUES (?, ?, ?, ?, 'answered', ?, ?) ON CONFLICT (nid) DO UPDATE SET "
+            "status = 'answered', answer = excluded.answer, error = NULL, updated = excluded.updated",
+            [row + (now,) for row in answered],
+        )
+        self.conn.executemany(
+            "INSERT INTO items (nid, cid, deck_id, output_field, status, error, attempts, updated) "
+            "VALUES (?, ?, ?, ?, 'failed', ?, ?, ?) ON CONFLICT (nid) DO UPDATE SET "
+            "status = 'failed', error = excluded.error, attempts = attempts + excluded.attempts, "
+            "updated = excluded.updated",
+            [row + (0 if row[4] in STOP_ERRORS else 1, now) for row in failed],
+        )
+        self.conn.execute("COMMIT")
+
+    def reset_failed(self):
+        """Cho các note đã thất bại được thử lại từ đầu → số note."""
+        cursor = self.conn.execute("UPDATE items SET attempts = 0 WHERE status = 'failed' AND attempts > 0")
+        return cursor.rowcount
+
+    def mark_written(self, nids):
+        self.conn.execute("BEGIN")
+        self.conn.executemany(
+            "UPDATE items SET status = 'written', answer = NULL, updated = ? WHERE nid = ?",
+            [(time.time(), nid) for nid in nids],
+        )
+        self.conn.execute("COMMIT")
+
+    def counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status"))
+
+    def close(self):
+        self.conn.close()
+
+
+# ---------- worker process ----------
+_worker = {}
+
+
+def _init_worker(config):
+    """Mỗi process có GeminiClient riêng (session, circuit breaker) và ghi token
+    vào bảng usage dùng chung để ngân sách của add-on vẫn được áp dụng."""
+    try:
+        usage = UsageStore(connect())
+    except Exception:
+        usage = None
+    _worker["config"] = config
+    _worker["usage"] = usage
+    _worker["client"] = GeminiClient(lambda: config, usage)
+
+
+def _generate_chunk(deck_id, prompt_key, template, items):
+    """Sinh câu trả lời cho items [(card_id, text)] → (answers, failures, số request)."""
+    if _worker["usage"] is not None:
+        # Các process khác cũng tiêu token: đọc lại tổng trước mỗi chunk
+        _worker["usage"].reload()
+    answers, failures = [], []
+    batcher = AdaptiveBatcher(_worker["client"], max_batch=_worker["config"].get("bulk_max_batch", 20),
+                              deck_id=deck_id, prompt_key=prompt_key)
+    batcher.run(
+        template,
+        [BatchItem(cid, text) for cid, text in items],
+        on_result=lambda cid, answer: answers.append((cid, answer)),
+        on_failed=lambda cid, error: failures.append((cid, error)),
+    )
+    return answers, failures, batcher.requests_sent
+
+
+class WorkItem:
+    __slots__ = ("nid", "cid", "deck_id", "output_field", "card_prompt")
+
+    def __init__(self, nid, cid, deck_id, output_field, card_prompt):
+        self.nid = nid
+        self.cid = cid
+        self.deck_id = deck_id
+        self.output_field = output_field
+        self.card_prompt = card_prompt
+
+
+class HeadlessRunner:
+    """Bulk generation cho mọi deck có Answer Field trong Deck Settings.
+
+    Mỗi card dùng settings của deck gần nhất (chính nó hoặc deck cha) đã được
+    cấu hình; mỗi note chỉ lấy một card. Item được chia thành chunk cùng
+    (deck, prompt) và chạy trên process pool (mỗi chunk một AdaptiveBatcher).
+    Main process là nơi duy nhất chạm vào collection: kết quả vào journal ngay,
+    rồi được ghi vào note theo lô commit_every note trong một update_notes.
+    """
+
+    def __init__(self, col, config, journal, workers=4, chunk_size=200, commit_every=1000,
+                 max_attempts=3, decks=None, log=print):
+        self.col = col
+        self.config = config
+        self.journal = journal
+        self.workers = max(1, workers)
+        self.chunk_size = max(1, chunk_size)
+        self.commit_every = max(1, commit_every)
+        self.max_attempts = max_attempts
+        self.deck_filter = decks
+        self.log = log
+        self.text_cache = CardTextCache()
+        self.settings_cache = {}
+        self.pending = {} # nid → (output_field, answer) chưa ghi vào collection
+        self.answered = 0
+        self.failed = 0
+        self.cached = 0
+        self.written = 0
+        self.requests = 0
+        self.stop_reason = None
+        self.response_cache = self._open_response_cache()
+        self.packs = self._open_packs()
+
+    def _open_response_cache(self):
+        # Chỉ exact cache: semantic index giữ trong bộ nhớ của process GUI
+        try:
+            return ResponseCache(connect(), lambda: self.config)
+        except Exception:
+            return None
+
+    def _open_packs(self):
+        try:
+            return AnswerPackShelf(os.path.join(USER_FILES_DIR, "packs"))
+        except Exception:
+            return None
+
+    # ---------- chọn card ----------
+    def configured_decks(self):
+        """{deck id: settings} của các deck có Answer Field (lọc theo --deck)."""
+        decks = {}
+        for deck_id, settings in self.config.get("deck_settings", {}).items():
+            if not settings.get("output_field"):
+                continue
+            deck = self.col.decks.get(int(deck_id), default=False)
+            if not deck:
+                continue
+            if self.deck_filter and deck_id not in self.deck_filter and deck["name"] not in self.deck_filter:
+                continue
+            decks[int(deck_id)] = settings
+        return decks
+
+    def settings_for(self, did, configured):
+        """(deck id, settings) của deck gần nhất đã cấu hình cho deck did."""
+        if did not in self.settings_cache:
+            chain = [did] + [parent["id"] for parent in reversed(self.col.decks.parents(did))]
+            owner = next((deck_id for deck_id in chain if deck_id in configured), None)
+            self.settings_cache[did] = (owner, configured.get(owner))
+        return self.settings_cache[did]
+
+    def collect(self):
+        """{(deck id, prompt key, template): [WorkItem]} cho các note còn trống Answer Field."""
+        configured = self.configured_decks()
+        if not configured:
+            return {}
+        deck_ids = set()
+        for deck_id in configured:
+            deck_ids.update(self.col.decks.deck_and_child_ids(deck_id))
+        ids = ",".join(str(did) for did in deck_ids)
+        rows = self.col.db.all(f"SELECT id, nid, did FROM cards WHERE did IN ({ids}) ORDER BY nid, ord")
+        skip = self.journal.exhausted(self.max_attempts) | set(self.pending)
+        cap = self.config.get("prompt_placeholder_cap", DEFAULT_CAP)
+        groups = {}
+        seen = set()
+        for cid, nid, did in rows:
+            if nid in seen:
+                continue
+            seen.add(nid)
+            if nid in skip:
+                continue
+            owner, settings = self.settings_for(did, configured)
+            output_field = settings["output_field"]
+            card = self.col.get_card(cid)
+            note = card.note()
+            if output_field not in note or note[output_field].strip():
+                continue
+            prompt_key = settings.get("selected_prompt") or self.config.get("selected_prompt")
+            template = self.config["custom_prompts"].get(prompt_key) or "Giải thích về: {text}"
+            target_field = settings.get("target_field", self.config["target_field"])
+            text = card_content(card, note, template, target_field, self.text_cache, self.col.decks.name, cap)
+            if not text.strip():
+                continue
+            system_context = (settings.get("system_context") or "").strip()
+            profile = get_profile(settings.get("latency_profile")
+                                  or self.config.get("latency_profile", DEFAULT_PROFILE))
+            card_prompt = CardPrompt(prompt_key, template, text, profile.model, system_context)
+            cached = self.cached_answer(card_prompt)
+            if cached is not None:
+                self.pending[nid] = (output_field, cached)
+                self.cached += 1
+                continue
+            groups.setdefault((str(owner), prompt_key, template), []).append(
+                WorkItem(nid, cid, str(owner), output_field, card_prompt)
+            )
+        return groups
+
+    def cached_answer(self, card_prompt):
+        if self.response_cache is not None:
+            answer = self.response_cache.get(card_prompt)
+            if answer is not None:
+                return answer
+        if self.packs is not None:
+            return self.packs.get(card_prompt)
+        return None
+
+    def chunks(self, groups):
+        for (deck_id, prompt_key, template), items in groups.items():
+            batch_template = load_template(template).batch_template()
+            for start in range(0, len(items), self.chunk_size):
+                yield deck_id, prompt_key, batch_template, items[start:start + self.chunk_size]
+
+    # ---------- ghi vào collection ----------
+    def flush(self):
+        """Ghi các câu trả lời đang chờ vào note trong một update_notes."""
+        if not self.pending:
+            return
+        notes = []
+        for nid, (output_field, answer) in self.pending.items():
+            try:
+                note = self.col.get_note(nid)
+            except Exception:
+                # Note đã bị xoá
+                continue
+            if output_field in note:
+                note[output_field] = answer
+                notes.append(note)
+        if notes:
+            self.col.update_notes(notes)
+        self.journal.mark_written(list(self.pending))
+        self.written += len(notes)
+        self.pending = {}
+
+    def _on_chunk_done(self, items, answers, failures):
+        by_cid = {str(item.cid): item for item in items}
+        answered = []
+        for cid, answer in answers:
+            item = by_cid[cid]
+            answered.append((item.nid, item.cid, item.deck_id, item.output_field, answer))
+            self.pending[item.nid] = (item.output_field, answer)
+            if self.response_cache is not None:
+                self.response_cache.put(item.card_prompt, answer)
+        failed = [(by_cid[cid].nid, by_cid[cid].cid, by_cid[cid].deck_id, by_cid[cid].output_field, error)
+                  for cid, error in failures]
+        self.journal.record(answered, failed)
+        self.answered += len(answered)
+        self.failed += len(failed)
+        for _, error in failures:
+            if error in STOP_ERRORS:
+                self.stop_reason = error
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def _progress(self, total, started):
+        finished = self.answered + self.failed
+        rate = finished / max(time.time() - started, 1e-6)
+        eta = (total - finished) / rate if rate else 0
+        self.log(
+            f"{finished:,}/{total:,} notes · {self.answered:,} answered · {self.failed:,} failed · "
+            f"{self.requests:,} requests · {rate:.1f} notes/s · ETA {eta / 60:.0f} min"
+        )
+
+    def _finish_running(self, futures, done):
+        """Sau lỗi dừng: huỷ các chunk chưa chạy, chờ các chunk đang chạy và ghi
+        kết quả vào journal (câu trả lời đã trả tiền không bị hỏi lại ở lần sau)."""
+        running = [future for future in futures if future not in done and not future.cancel()]
+        for future in as_completed(running):
+            try:
+                answers, failures, requests_sent = future.result()
+            except Exception:
+                continue
+            self.requests += requests_sent
+            self._on_chunk_done(futures[future], answers, failures)
+
+    def run(self):
+        # Câu trả lời của lần chạy trước chưa kịp ghi vào collection
+        self.pending = self.journal.answered()
+        resumed = len(self.pending)
+        groups = self.collect()
+        total = sum(len(items) for items in groups.values())
+        self.log(f"{total:,} notes to generate, {self.cached:,} from cache, {resumed:,} resumed from journal")
+        self.flush()
+        if not total:
+            return self
+        started = time.time()
+        executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.config,))
+        try:
+            futures = {executor.submit(_generate_chunk, deck_id, prompt_key, template,
+                                       [(item.cid, item.card_prompt.content) for item in items]): items
+                       for deck_id, prompt_key, template, items in self.chunks(groups)}
+            done = set()
+            for future in as_completed(futures):
+                done.add(future)
+                answers, failures, requests_sent = future.result()
+                self.requests += requests_sent
+                self._on_chunk_done(futures[future], answers, failures)
+                self._progress(total, started)
+                if self.stop_reason:
+                    self.log(f"Stopping: {self.stop_reason}")
+                    self._finish_running(futures, done)
+                    break
+        finally:
+            # Ctrl+C hoặc lỗi: bỏ các chunk chưa chạy, giữ những gì đã có câu trả lời
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.flush()
+        return self
+
+    def summary(self):
+        counts = self.journal.counts()
+        return (
+            f"Written {self.written:,} notes ({self.cached:,} from cache), {self.failed:,} failed, "
+            f"{self.requests:,} requests. Journal: {counts.get('written', 0):,} written, "
+            f"{counts.get('failed', 0):,} failed (retried next run, up to {self.max_attempts} attempts)."
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate answers for a collection without the Anki GUI.")
+    parser.add_argument("collection", help="path to collection.anki2 (must not be open in Anki)")
+    parser.add_argument("--deck", action="append", help="deck name or id (repeatable, default: all configured decks)")
+    parser.add_argument("--config", help="JSON file overriding the add-on config")
+    parser.add_argument("--journal", help="journal path (default: <collection>%s)" % JOURNAL_SUFFIX)
+    parser.add_argument("--workers", type=int, default=4, help="worker processes")
+    parser.add_argument("--chunk-size", type=int, default=200, help="notes per worker task")
+    parser.add_argument("--commit-every", type=int, default=1000, help="notes written per transaction")
+    parser.add_argument("--max-attempts", type=int, default=3, help="runs a failed note is retried for")
+    parser.add_argument("--retry-failed", action="store_true", help="retry notes that used up --max-attempts")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        from anki.collection import Collection
+    except ImportError:
+        sys.exit("The 'anki' package is required: pip install anki")
+    config = load_addon_config(args.config)
+    if not config.get("api_key"):
+        sys.exit("No API key in the add-on config")
+    journal = Journal(args.journal or args.collection + JOURNAL_SUFFIX)
+    if args.retry_failed:
+        print(f"{journal.reset_failed():,} failed notes will be retried", file=sys.stderr)
+    col = Collection(args.collection)
+    runner = HeadlessRunner(col, config, journal, args.workers, args.chunk_size, args.commit_every,
+                            args.max_attempts, args.deck, log=lambda line: print(line, file=sys.stderr, flush=True))
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume.", file=sys.stderr)
+    finally:
+        col.close()
+        journal.close()
+    print(runner.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,22 @@ TRANSLATIONS = {
         # Config Dialog
         "menu_config": "Cấu hình ChatBot",
         "menu_deck_config": "Cài đặt theo Deck",
-        "menu_test_api": "Test API Key",
+        "menu_test_api": "Test API Key & độ trễ",
+        "menu_stall_report": "Báo cáo giật / treo UI",
+        "menu_trace": "Ghi trace hiệu năng (bắt đầu / dừng)",
         "menu_debug": "Debug Info",
+        "menu_search": "Tìm trong lịch sử chat",
+        "menu_export_pack": "Xuất answer pack…",
+        "menu_import_pack": "Import answer pack…",
         "config_title": "Cấu hình Gemini ChatBot",
         "api_key_label": "🔑 Gemini API Key:",
         "language_label": "🌐 Ngôn ngữ / Language:",
         "enable_chatbot": "Bật ChatBot",
+        "chat_panel_label": "Mở chat trong panel riêng (giữ nguyên khi đổi card)",
+        "stall_watchdog_label": "Theo dõi giật / treo UI (chẩn đoán, bình thường nên tắt)",
+        "stall_watchdog_off": "Chưa bật theo dõi giật UI.\nBật \"Theo dõi giật / treo UI\" trong Cấu hình ChatBot, dùng Anki như bình thường rồi mở lại báo cáo này.",
+        "stall_report_empty": "Chưa ghi nhận lần treo nào dài hơn {threshold} ms.",
+        "stall_report_title": "Các lần UI treo hơn {threshold} ms (xếp theo tổng thời gian):",
         "max_tokens_label": "📊 Giới hạn Tokens:",
         "default_prompt_label": "💡 Prompt mặc định (fallback):",
         "custom_prompt_group": "🧠 Quản lý Prompt Tùy Chỉnh",
@@ -24,6 +34,10 @@ TRANSLATIONS = {
         "error_key_space": "❌ Key không được chứa khoảng trắng.",
         "error_prompt_empty": "❌ Prompt không được để trống.",
         "error_prompt_format": "❌ Prompt phải chứa {text} hoặc {field_content}.",
+        "error_template_syntax": "❌ Template sai cú pháp gần: {text}",
+        "error_template_no_placeholder": "❌ Prompt phải chứa ít nhất một placeholder, vd: {text}, {Front}, {deck}, {tags}, {ord}.",
+        "error_template_bad_cap": "❌ Giới hạn độ dài của {{{name}}} phải là số nguyên dương, vd: {{{name}:300}}.",
+        "error_template_unknown_field": "❌ Field \"{name}\" không có trong notetype. Các field: {fields}",
         "msg_prompt_saved": "✅ Prompt '{key}' đã được thêm hoặc cập nhật.",
         "error_no_selection": "❌ Chưa chọn prompt nào để xóa.",
         "msg_prompt_deleted": "🗑️ Đã xóa prompt '{key}'.",
@@ -34,8 +48,13 @@ TRANSLATIONS = {
         "select_deck_label": "📚 Chọn Deck:",
         "deck_search_placeholder": "Nhập tên deck để tìm nhanh",
         "enable_deck_chatbot": "Bật ChatBot cho deck này",
+        "send_images_label": "Gửi kèm ảnh trong field (ảnh được thu nhỏ trước khi gửi)",
         "target_field_label": "🎯 Trường mục tiêu:",
         "deck_prompt_label": "💡 Prompt cho deck:",
+        "latency_profile_label": "⚡ Tốc độ trả lời:",
+        "latency_profile_fast": "Nhanh (Flash-Lite, không suy luận)",
+        "latency_profile_balanced": "Cân bằng (Flash, suy luận ngắn)",
+        "latency_profile_thorough": "Kỹ lưỡng (Pro, suy luận sâu, chậm hơn)",
         "create_custom_prompt_label": "➕ Tự tạo prompt mới:",
         "custom_key_placeholder": "Nhập key (vd: synonyms)",
         "custom_prompt_placeholder": "Nhập prompt (phải có {text})",
@@ -44,6 +63,27 @@ TRANSLATIONS = {
         "msg_deck_saved": "✅ Đã lưu cho deck: {deck_name}",
         "error_no_notetype": "❌ Không tìm thấy notetype trong deck hoặc subdeck.",
         "error_custom_prompt_empty": "❌ Vui lòng nhập prompt tùy chỉnh trước khi lưu.",
+        "output_field_label": "📝 Trường lưu câu trả lời (sinh hàng loạt):",
+        "btn_bulk_generate": "⚡ Sinh cho cả deck",
+        "bulk_save_first": "❌ Hãy lưu cài đặt cho deck này trước.",
+        "bulk_no_output_field": "❌ Chưa chọn trường lưu câu trả lời cho deck này.",
+        "bulk_nothing_to_do": "✅ Không còn note nào cần sinh câu trả lời.",
+        "bulk_already_running": "⏳ Đang có một tác vụ sinh hàng loạt chạy.",
+        "bulk_progress": "Đang sinh câu trả lời... {done}/{total}",
+        "bulk_done": "✅ Hoàn tất: {done} thành công, {failed} lỗi, {requests} request.",
+        "system_context_label": "📘 Hướng dẫn chung cho deck (ngữ pháp, quy tắc, ví dụ):",
+        "system_context_placeholder": "Được gửi kèm mọi request của deck và cache phía Gemini khi đủ dài",
+        "queued_offline": "📥 Đang mất kết nối — câu hỏi đã được lưu, câu trả lời sẽ hiện ở lần mở chat sau của thẻ này.",
+        "bulk_queued_offline": "📥 {queued} note được xếp hàng chờ mạng, sẽ tự hoàn tất khi có kết nối.",
+        "bulk_deferred_budget": "⏸️ {deferred} note bị hoãn vì đã gần hết ngân sách token, sẽ tự hoàn tất khi ngân sách mới bắt đầu.",
+
+        # Search Dialog
+        "search_title": "Tìm trong lịch sử chat",
+        "search_placeholder": "Nhập từ khoá (vd: động từ bất quy tắc)",
+        "search_all_decks": "Tất cả deck",
+        "search_no_results": "Không tìm thấy kết quả nào.",
+        "search_result_count": "{count} kết quả — bấm vào tên deck để mở card trong Browser",
+        "search_unavailable": "❌ SQLite của Anki không hỗ trợ FTS5, không thể tìm kiếm.",
 
         # Chat Window
         "header": "Anki Chatbot",
@@ -57,6 +97,11 @@ TRANSLATIONS = {
         # Gemini Chatbot
         "api_key_missing": "❌ Lỗi: Chưa cấu hình API Key",
         "rate_limit": "❌ Lỗi Gemini: Quá nhiều yêu cầu (rate limited). Hãy thử lại sau",
+        "budget_exhausted": "❌ Đã hết ngân sách token (daily_token_budget / monthly_token_budget trong config).",
+        "api_timeout": "❌ Gemini không trả lời kịp ({e}). Hãy thử lại.",
+        "api_unavailable": "❌ Gemini đang không khả dụng (lỗi liên tục). Sẽ thử lại sau khoảng {seconds} giây.",
+        "status_unavailable": "Gemini không khả dụng · thử lại sau {seconds}s",
+        "status_recovering": "Đang kết nối lại Gemini…",
         "connection_error": "❌ Lỗi kết nối Gemini: {e}",
         "internal_error": "❌ Lỗi Gemini nội bộ: {e}",
         "no_active_card": "Không có card nào đang active!",
@@ -64,6 +109,15 @@ TRANSLATIONS = {
         "chatbot_disabled_deck": "Chưa bật chatbot cho bộ deck này.",
         "api_test_success": "✅ API Key hoạt động tốt!",
         "api_test_failed": "❌ Lỗi API Key: {result}",
+        "diagnostics_started": "⏱️ Đang kiểm tra kết nối Gemini trong nền…",
+        "diagnostics_running": "⏱️ Đang kiểm tra kết nối, vui lòng chờ…",
+        "pack_export_done": "✅ Đã xuất {count} câu trả lời vào {path}",
+        "trace_started": "⏺ Đang ghi trace. Chọn lại menu Ghi trace hiệu năng để dừng và lưu.",
+        "trace_saved": "✅ Đã lưu {count} sự kiện vào {path}\nMở bằng https://ui.perfetto.dev hoặc chrome://tracing",
+        "trace_save_failed": "❌ Không lưu được trace: {error}",
+        "pack_export_empty": "ℹ️ Chưa có câu trả lời nào trong cache để xuất.",
+        "pack_import_done": "✅ Đã import {name} ({count} câu trả lời).",
+        "pack_invalid": "❌ Không đọc/ghi được answer pack: {error}",
         "config_saved": "Cấu hình đã được lưu!",
         "tooltip_prompt": "Hỏi Gemini về: {text}"
     },
@@ -71,12 +125,22 @@ TRANSLATIONS = {
         # Config Dialog
         "menu_config": "ChatBot Configuration",
         "menu_deck_config": "Deck Settings",
-        "menu_test_api": "Test API Key",
+        "menu_test_api": "Test API Key & Latency",
+        "menu_stall_report": "UI Stall Report",
+        "menu_trace": "Performance Trace (start / stop)",
         "menu_debug": "Debug Info",
+        "menu_search": "Search Chat History",
+        "menu_export_pack": "Export Answer Pack…",
+        "menu_import_pack": "Import Answer Pack…",
         "config_title": "Gemini ChatBot Configuration",
         "api_key_label": "🔑 Gemini API Key:",
         "language_label": "🌐 Language / Ngôn ngữ:",
         "enable_chatbot": "Enable ChatBot",
+        "chat_panel_label": "Open chat in a docked panel (stays open across cards)",
+        "stall_watchdog_label": "Watch for UI stalls (diagnostics, leave off normally)",
+        "stall_watchdog_off": "The UI stall watchdog is off.\nTick \"Watch for UI stalls\" in ChatBot Configuration, use Anki as usual, then open this report again.",
+        "stall_report_empty": "No stalls longer than {threshold} ms recorded yet.",
+        "stall_report_title": "UI stalls longer than {threshold} ms (ranked by total time):",
         "max_tokens_label": "📊 Max Tokens:",
         "default_prompt_label": "💡 Default Prompt (fallback):",
         "custom_prompt_group": "🧠 Custom Prompt Management",
@@ -90,6 +154,10 @@ TRANSLATIONS = {
         "error_key_space": "❌ Key cannot contain spaces.",
         "error_prompt_empty": "❌ Prompt cannot be empty.",
         "error_prompt_format": "❌ Prompt must contain {text} or {field_content}.",
+        "error_template_syntax": "❌ Template syntax error near: {text}",
+        "error_template_no_placeholder": "❌ Prompt must contain at least one placeholder, e.g. {text}, {Front}, {deck}, {tags}, {ord}.",
+        "error_template_bad_cap": "❌ Length limit of {{{name}}} must be a positive integer, e.g. {{{name}:300}}.",
+        "error_template_unknown_field": "❌ Field \"{name}\" is not in the notetype. Fields: {fields}",
         "msg_prompt_saved": "✅ Prompt '{key}' added or updated.",
         "error_no_selection": "❌ No prompt selected to delete.",
         "msg_prompt_deleted": "🗑️ Deleted prompt '{key}'.",
@@ -100,8 +168,13 @@ TRANSLATIONS = {
         "select_deck_label": "📚 Select Deck:",
         "deck_search_placeholder": "Type deck name to search",
         "enable_deck_chatbot": "Enable ChatBot for this deck",
+        "send_images_label": "Send images in the fields too (downscaled before upload)",
         "target_field_label": "🎯 Target Field:",
         "deck_prompt_label": "💡 Deck Prompt:",
+        "latency_profile_label": "⚡ Answer Speed:",
+        "latency_profile_fast": "Fast (Flash-Lite, no thinking)",
+        "latency_profile_balanced": "Balanced (Flash, short thinking)",
+        "latency_profile_thorough": "Thorough (Pro, deep thinking, slower)",
         "create_custom_prompt_label": "➕ Create Custom Prompt:",
         "custom_key_placeholder": "Enter key (e.g., synonyms)",
         "custom_prompt_placeholder": "Enter prompt (must have {text})",
@@ -110,6 +183,27 @@ TRANSLATIONS = {
         "msg_deck_saved": "✅ Saved for deck: {deck_name}",
         "error_no_notetype": "❌ No notetype found in deck or subdecks.",
         "error_custom_prompt_empty": "❌ Please enter a custom prompt before saving.",
+        "output_field_label": "📝 Answer Field (bulk generation):",
+        "btn_bulk_generate": "⚡ Generate for Deck",
+        "bulk_save_first": "❌ Please save the settings for this deck first.",
+        "bulk_no_output_field": "❌ No answer field selected for this deck.",
+        "bulk_nothing_to_do": "✅ No notes left to generate answers for.",
+        "bulk_already_running": "⏳ A bulk generation job is already running.",
+        "bulk_progress": "Generating answers... {done}/{total}",
+        "bulk_done": "✅ Done: {done} succeeded, {failed} failed, {requests} requests.",
+        "system_context_label": "📘 Deck Instructions (grammar reference, style rules, examples):",
+        "system_context_placeholder": "Sent with every request for this deck; cached on Gemini's side when long enough",
+        "queued_offline": "📥 You're offline — your question was saved and the answer will appear the next time you open this card's chat.",
+        "bulk_queued_offline": "📥 {queued} notes are queued until the connection is back and will be completed automatically.",
+        "bulk_deferred_budget": "⏸️ {deferred} notes were deferred because the token budget is almost used up; they will be completed automatically when the next budget period starts.",
+
+        # Search Dialog
+        "search_title": "Search Chat History",
+        "search_placeholder": "Type keywords (e.g. irregular verbs)",
+        "search_all_decks": "All decks",
+        "search_no_results": "No results found.",
+        "search_result_count": "{count} results — click a deck name to open the card in the Browser",
+        "search_unavailable": "❌ Anki's SQLite has no FTS5 support, search is unavailable.",
 
         # Chat Window
         "header": "Anki Chatbot",
@@ -123,6 +217,11 @@ TRANSLATIONS = {
         # Gemini Chatbot
         "api_key_missing": "❌ Error: API Key not configured",
         "rate_limit": "❌ Gemini Error: Rate limited. Please try again later.",
+        "budget_exhausted": "❌ Token budget used up (daily_token_budget / monthly_token_budget in the config).",
+        "api_timeout": "❌ Gemini did not answer in time ({e}). Please try again.",
+        "api_unavailable": "❌ Gemini is currently unavailable (repeated failures). Retrying in about {seconds} seconds.",
+        "status_unavailable": "Gemini unavailable · retrying in {seconds}s",
+        "status_recovering": "Reconnecting to Gemini…",
         "connection_error": "❌ Gemini Connection Error: {e}",
         "internal_error": "❌ Gemini Internal Error: {e}",
         "no_active_card": "No active card!",
@@ -130,6 +229,15 @@ TRANSLATIONS = {
         "chatbot_disabled_deck": "Chatbot is not enabled for this deck.",
         "api_test_success": "✅ API Key is working!",
         "api_test_failed": "❌ API Key Error: {result}",
+        "diagnostics_started": "⏱️ Checking the Gemini connection in the background…",
+        "diagnostics_running": "⏱️ A connection check is already running…",
+        "pack_export_done": "✅ Exported {count} answers to {path}",
+        "trace_started": "⏺ Recording a trace. Choose Performance Trace again to stop and save it.",
+        "trace_saved": "✅ Saved {count} events to {path}\nOpen it in https://ui.perfetto.dev or chrome://tracing",
+        "trace_save_failed": "❌ Could not save the trace: {error}",
+        "pack_export_empty": "ℹ️ There are no cached answers to export yet.",
+        "pack_import_done": "✅ Imported {name} ({count} answers).",
+        "pack_invalid": "❌ Could not read/write the answer pack: {error}",
         "config_saved": "Configuration saved!",
         "tooltip_prompt": "Ask Gemini about: {text}"
     }
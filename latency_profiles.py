@@ -0,0 +1,111 @@
+import math
+import threading
+import time
+from collections import deque
+
+from .metrics import METRICS
+
+
+def percentile(values, p):
+    """Percentile kiểu nearest-rank (values không rỗng)."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class LatencyProfile:
+    """Model, giới hạn độ dài câu trả lời và thinking budget dùng cho một deck.
+
+    max_tokens None → dùng max_tokens trong config. Thinking token được tính
+    vào maxOutputTokens nên budget được cộng thêm vào giới hạn output.
+    """
+
+    def __init__(self, name, model, max_tokens=None, thinking_budget=None):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.thinking_budget = thinking_budget
+
+    def payload_options(self, default_max_tokens):
+        """Tham số cho GeminiClient.build_payload."""
+        options = {"max_tokens": (self.max_tokens or default_max_tokens) + (self.thinking_budget or 0)}
+        if self.thinking_budget is not None:
+            options["thinkingConfig"] = {"thinkingBudget": self.thinking_budget}
+        return options
+
+
+PROFILES = {
+    "fast": LatencyProfile("fast", "gemini-2.5-flash-lite", thinking_budget=0),
+    "balanced": LatencyProfile("balanced", "gemini-2.5-flash", 800, 512),
+    "thorough": LatencyProfile("thorough", "gemini-2.5-pro", 1500, 2048),
+}
+DEFAULT_PROFILE = "fast"
+
+# Profile nhanh hơn kế tiếp khi model của profile vượt latency objective
+FALLBACK = {"thorough": "balanced", "balanced": "fast"}
+
+
+def get_profile(name):
+    return PROFILES.get(name) or PROFILES[DEFAULT_PROFILE]
+
+
+class LatencyMonitor:
+    """p95 độ trễ gần đây theo model → profile thực sự dùng cho request.
+
+    Mỗi model giữ window độ trễ gần nhất của request chat/prefetch. Khi p95
+    (ít nhất min_samples mẫu) vượt latency objective, model bị coi là chậm
+    và request chuyển sang profile nhanh hơn kế tiếp. Trong lúc đó cứ
+    probe_interval giây có một request được gửi thử tới model gốc (như
+    half_open của circuit breaker); recovery_samples lần thử liên tiếp đạt
+    objective → quay lại model gốc.
+    """
+
+    def __init__(self, window=40, min_samples=8, probe_interval=60.0, recovery_samples=3):
+        self.lock = threading.Lock()
+        self.window = window
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.recovery_samples = recovery_samples
+        self.samples = {}  # model -> deque độ trễ (giây)
+        self.degraded = {} # model -> {"since", "probe_at", "good"}
+
+    def record(self, model, seconds, objective):
+        """Ghi nhận độ trễ một request; objective <= 0 → chỉ ghi, không fallback."""
+        now = time.monotonic()
+        with self.lock:
+            samples = self.samples.setdefault(model, deque(maxlen=self.window))
+            samples.append(seconds)
+            state = self.degraded.get(model)
+            if state is not None:
+                state["good"] = state["good"] + 1 if seconds <= objective else 0
+                if state["good"] >= self.recovery_samples:
+                    # Bỏ các mẫu chậm cũ để không bị đánh dấu chậm lại ngay
+                    del self.degraded[model]
+                    samples.clear()
+                    METRICS.incr("latency.recovered", model=model)
+            elif objective > 0 and len(samples) >= self.min_samples and percentile(samples, 95) > objective:
+                self.degraded[model] = {"since": now, "probe_at": now + self.probe_interval, "good": 0}
+                METRICS.incr("latency.degraded", model=model)
+
+    def select(self, profile, objective):
+        """Profile dùng cho request: profile của deck, hoặc profile dự phòng khi model đang chậm."""
+        if objective <= 0:
+            return profile
+        now = time.monotonic()
+        with self.lock:
+            while profile.name in FALLBACK:
+                state = self.degraded.get(profile.model)
+                if state is None:
+                    break
+                if now >= state["probe_at"]:
+                    state["probe_at"] = now + self.probe_interval
+                    METRICS.incr("latency.probes", model=profile.model)
+                    break
+                METRICS.incr("latency.fallbacks", model=profile.model)
+                profile = PROFILES[FALLBACK[profile.name]]
+        return profile
+
+    def snapshot(self):
+        """{model: (số mẫu, p95 giây, đang chậm)} cho Debug Info."""
+        with self.lock:
+            return {model: (len(samples), percentile(samples, 95), model in self.degraded)
+                    for model, samples in self.samples.items() if samples}
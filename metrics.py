@@ -0,0 +1,34 @@
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """Bộ đếm dùng chung giữa các module (thread-safe), hiển thị trong Debug Info."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self._key(name, labels)] += value
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def by_labels(self, name):
+        """{labels (dict-items tuple): value} của mọi bộ đếm cùng tên."""
+        with self.lock:
+            return {labels: value for (n, labels), value in self.counters.items() if n == name}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+METRICS = Metrics()
@@ -0,0 +1,196 @@
+import json
+import socket
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from .gemini_client import GEMINI_BASE_URL, GeminiError, extract_text
+from .prompt_layout import assemble_prompt
+from .response_cache import CardPrompt
+
+PROBE_HOST = GEMINI_BASE_URL.split("/")[2]
+
+# Số lần API trả lỗi thật sự trước khi bỏ request (mất mạng không tính)
+MAX_ATTEMPTS = 5
+# Request đã bỏ được giữ lại (hiện trong Debug Info) trong khoảng thời gian này
+FAILED_RETENTION = 7 * 24 * 3600
+
+
+def is_online(timeout=3.0):
+    """Kiểm tra nhanh kết nối tới endpoint Gemini (TCP connect, không tốn quota)."""
+    try:
+        socket.create_connection((PROBE_HOST, 443), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def card_prompt_to_dict(card_prompt):
+    if card_prompt is None:
+        return None
+    return {
+        "prompt_key": card_prompt.prompt_key,
+        "template": card_prompt.template,
+        "content": card_prompt.content,
+        "model": card_prompt.model,
+        "system_context": card_prompt.system_context,
+        "media": card_prompt.media,
+    }
+
+
+def card_prompt_from_dict(data):
+    if not data:
+        return None
+    return CardPrompt(data["prompt_key"], data["template"], data["content"],
+                      data["model"], data.get("system_context", ""), data.get("media", ()))
+
+
+class Outbox:
+    """Hàng đợi bền vững cho request thất bại vì mất mạng (hoặc bulk item bị
+    hoãn vì hết ngân sách token).
+
+    kind = "chat": một lượt chat (history đầy đủ) — câu trả lời được lưu lại để
+    hiện ở lần mở chat kế tiếp của note đó.
+    kind = "bulk": một item của bulk job — câu trả lời được ghi vào trường output.
+    Câu trả lời cho prompt tự động của card còn được đưa vào response cache.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.offline_since = None
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, note_id INTEGER, card_id INTEGER, "
+            "deck_id TEXT, prompt_key TEXT, output_field TEXT, question TEXT, payload TEXT, "
+            "answer TEXT, attempts INTEGER DEFAULT 0, created REAL)"
+        )
+
+    # ---------- trạng thái mạng ----------
+    def mark_offline(self):
+        if self.offline_since is None:
+            self.offline_since = time.time()
+
+    def mark_online(self):
+        self.offline_since = None
+
+    def is_offline(self):
+        return self.offline_since is not None
+
+    # ---------- thêm vào hàng đợi ----------
+    def add_chat(self, note_id, card_id, deck_id, prompt_key, question, history, card_prompt=None):
+        payload = {"history": history, "card_prompt": card_prompt_to_dict(card_prompt)}
+        self._add("chat", note_id, card_id, deck_id, prompt_key, "", question, payload)
+
+    def add_bulk(self, note_id, card_id, deck_id, output_field, card_prompt):
+        payload = {"card_prompt": card_prompt_to_dict(card_prompt)}
+        self._add("bulk", note_id, card_id, deck_id, card_prompt.prompt_key, output_field,
+                  card_prompt.content, payload)
+
+    def _add(self, kind, note_id, card_id, deck_id, prompt_key, output_field, question, payload):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO outbox (kind, note_id, card_id, deck_id, prompt_key, output_field, "
+                "question, payload, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, note_id, card_id, str(deck_id) if deck_id is not None else None,
+                 prompt_key, output_field, question, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+
+    def pending_count(self, max_attempts=MAX_ATTEMPTS):
+        """Số request còn chờ gửi (không tính request đã bỏ sau max_attempts lần lỗi)."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE answer IS NULL AND attempts < ?", (max_attempts,)
+        ).fetchone()[0]
+
+    def failed_count(self, max_attempts=MAX_ATTEMPTS):
+        """Số request đã bỏ vì API lỗi max_attempts lần."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE answer IS NULL AND attempts >= ?", (max_attempts,)
+        ).fetchone()[0]
+
+    def purge_failed(self, max_attempts=MAX_ATTEMPTS, max_age=FAILED_RETENTION):
+        """Xoá request đã bỏ cũ hơn max_age giây."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM outbox WHERE answer IS NULL AND attempts >= ? AND created < ?",
+                (max_attempts, time.time() - max_age),
+            )
+
+    # ---------- xả hàng đợi ----------
+    def _send(self, client, lang, row):
+        row_id, kind, deck_id, prompt_key, payload = row
+        data = json.loads(payload)
+        card_prompt = card_prompt_from_dict(data.get("card_prompt"))
+        if kind == "chat":
+            request, model = client.build_profile_payload(data["history"], deck_id)
+        else:
+            request, model = client.build_profile_payload(
+                assemble_prompt(card_prompt.template, card_prompt.content, lang), deck_id)
+        answer = extract_text(client.generate(request, model, deck_id=deck_id, prompt_key=prompt_key,
+                                              request_class="chat" if kind == "chat" else "bulk"))
+        return row_id, kind, card_prompt, answer
+
+    def drain(self, client, response_cache=None, lang="vi", concurrency=2, max_attempts=MAX_ATTEMPTS):
+        """Gửi lại các request đang chờ, tối đa `concurrency` request song song.
+
+        Trả về danh sách bulk item đã có câu trả lời: [(row_id, note_id, output_field, answer)]
+        để main thread ghi vào note. Dừng sớm nếu lại mất mạng. Chỉ lỗi từ API
+        (kể cả 5xx) mới tính là một lần thử; mất kết nối thì request được giữ nguyên.
+        """
+        self.purge_failed(max_attempts)
+        rows = self.conn.execute(
+            "SELECT id, kind, deck_id, prompt_key, payload FROM outbox "
+            "WHERE answer IS NULL AND attempts < ? ORDER BY id",
+            (max_attempts,),
+        ).fetchall()
+        # Bulk item đã có câu trả lời nhưng chưa được ghi vào note (vd: Anki bị đóng)
+        delivered = [tuple(r) for r in self.conn.execute(
+            "SELECT id, note_id, output_field, answer FROM outbox WHERE kind = 'bulk' AND answer IS NOT NULL"
+        ).fetchall()]
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = [pool.submit(self._send, client, lang, row) for row in rows]
+            for row, future in zip(rows, futures):
+                try:
+                    row_id, kind, card_prompt, answer = future.result()
+                except CancelledError:
+                    continue
+                except GeminiError as e:
+                    # "network" có status là server trả 5xx: lỗi thật của API, được tính
+                    # như các lỗi khác để request không bị gửi lại mãi
+                    if e.kind in ("cancelled", "unavailable", "budget") or (e.kind == "network" and not e.status):
+                        # Đóng profile / circuit breaker mở / hết ngân sách token / lại
+                        # mất mạng → request còn nguyên trong outbox (không tính là một
+                        # lần thử); bulk item hết ngân sách được gửi lại khi ngân sách mới bắt đầu
+                        if e.kind == "network":
+                            self.mark_offline()
+                        if e.kind != "budget":
+                            for other in futures:
+                                other.cancel()
+                        continue
+                    with self.lock:
+                        self.conn.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (row[0],))
+                    continue
+                if card_prompt and response_cache:
+                    response_cache.put(card_prompt, answer)
+                with self.lock:
+                    self.conn.execute("UPDATE outbox SET answer = ? WHERE id = ?", (answer, row_id))
+                if kind == "bulk":
+                    note_id, output_field = self.conn.execute(
+                        "SELECT note_id, output_field FROM outbox WHERE id = ?", (row_id,)
+                    ).fetchone()
+                    delivered.append((row_id, note_id, output_field, answer))
+        return delivered
+
+    def remove(self, row_ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in row_ids])
+
+    def take_delivered_chat(self, note_id):
+        """Các lượt chat đã có câu trả lời của note: [(question, answer)], rồi xoá khỏi outbox."""
+        rows = self.conn.execute(
+            "SELECT id, question, answer FROM outbox "
+            "WHERE kind = 'chat' AND note_id = ? AND answer IS NOT NULL ORDER BY id",
+            (note_id,),
+        ).fetchall()
+        self.remove([r[0] for r in rows])
+        return [(question, answer) for _, question, answer in rows]
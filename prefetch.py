@@ -0,0 +1,160 @@
+import threading
+
+from aqt import mw
+from aqt.qt import QTimer
+
+from .gemini_client import GeminiError
+from .metrics import METRICS
+from .tracing import TRACER, traced
+from .transport import CancelToken
+
+
+class PrefetchItem:
+    def __init__(self, card, auto_prompt, card_prompt, prompt_key):
+        self.card_id = card.id
+        self.deck_id = card.did
+        self.lapses = card.lapses
+        self.auto_prompt = auto_prompt
+        self.card_prompt = card_prompt
+        self.prompt_key = prompt_key
+
+
+class Prefetcher:
+    """Sinh trước câu trả lời cho prompt tự động của các card sắp được hỏi.
+
+    Sau khi câu hỏi hiện ra và người dùng không thao tác trong
+    prefetch_idle_delay giây, lấy prefetch_cards card kế tiếp trong hàng đợi
+    của scheduler (card lapse nhiều được ưu tiên) và gửi từng request ở loại
+    "prefetch": không chạy khi chat đang chờ trả lời và dừng khi ngân sách
+    token dành cho việc nền đã hết. Câu trả lời vào response cache nên khi
+    tới card đó, prompt tự động được trả lời ngay. Payload giống hệt request
+    của chat nên nếu người dùng hỏi trong lúc prefetch đang chạy, hai request
+    dùng chung một network call.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.queue = [] # PrefetchItem theo thứ tự ưu tiên
+        self.running = False
+        self.generated = set() # Key của CardPrompt đã sinh trước, chưa được chat dùng tới
+        self.token = CancelToken()
+        self.timer = QTimer(mw)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.on_idle)
+
+    def schedule(self):
+        """Gọi khi câu hỏi mới hiện ra: đếm lại thời gian idle."""
+        count = self.bot.config.get("prefetch_cards", 5)
+        if count <= 0 or not self.bot.response_cache or not self.bot.config.get("api_key"):
+            return
+        self.timer.start(int(self.bot.config.get("prefetch_idle_delay", 2) * 1000))
+
+    def stop(self):
+        """Rời màn hình review / đóng profile: bỏ hàng đợi, huỷ request đang chạy."""
+        self.timer.stop()
+        with self.lock:
+            self.queue = []
+        self.token.cancel()
+
+    def take(self, key):
+        """True (một lần) nếu câu trả lời cho key do prefetch sinh ra."""
+        with self.lock:
+            if key in self.generated:
+                self.generated.discard(key)
+                return True
+            return False
+
+    def busy(self):
+        """Chat đang chờ trả lời → nhường."""
+        chat_window = self.bot.chat_window
+        return bool(chat_window and chat_window.pending)
+
+    @traced("prefetch.on_idle", "scheduler")
+    def on_idle(self):
+        if self.busy():
+            self.schedule()
+            return
+        items = self.collect()
+        with self.lock:
+            self.queue = items
+            if not items or self.running:
+                return
+            self.running = True
+        if self.token.cancelled:
+            self.token = CancelToken()
+        mw.taskman.run_in_background(self._run, self._on_done)
+
+    def upcoming_card_ids(self, count):
+        """Id các card scheduler sẽ hỏi tiếp theo (không gồm card hiện tại)."""
+        try:
+            queued = mw.col.sched.get_queued_cards(fetch_limit=count + 1)
+        except Exception:
+            # Scheduler cũ không có get_queued_cards
+            return []
+        current = self.bot.current_card.id if self.bot.current_card else None
+        return [c.card.id for c in queued.cards if c.card.id != current][:count]
+
+    def collect(self):
+        """PrefetchItem cho các card sắp tới chưa có câu trả lời trong cache (main thread)."""
+        items = []
+        for position, card_id in enumerate(self.upcoming_card_ids(self.bot.config.get("prefetch_cards", 5))):
+            try:
+                card = mw.col.get_card(card_id)
+                settings = self.bot.config["deck_settings"].get(str(card.did), {})
+                if not settings.get("enabled", False) or not settings.get("target_field"):
+                    continue
+                prompt_key, auto_prompt, card_prompt = self.bot.auto_prompt_for(card)
+            except Exception:
+                continue
+            if not card_prompt.content.strip():
+                continue
+            if self.bot.cached_answer(card_prompt) is not None:
+                continue
+            items.append((-card.lapses, position, PrefetchItem(card, auto_prompt, card_prompt, prompt_key)))
+        items.sort(key=lambda entry: entry[:2])
+        return [item for _, _, item in items]
+
+    def _next(self):
+        with self.lock:
+            if not self.queue:
+                self.running = False
+                return None
+            return self.queue.pop(0)
+
+    def _run(self):
+        """Background thread: gửi lần lượt từng item, nhường khi chat đang chờ."""
+        token = self.token
+        while not token.cancelled:
+            if self.busy():
+                token.event.wait(0.5)
+                continue
+            item = self._next()
+            if item is None:
+                return
+            try:
+                # Cùng dạng history với lượt đầu tiên của chat (ô input một dòng)
+                history = [{"role": "user", "parts": [{"text": " ".join(item.auto_prompt.split())}]}]
+                with TRACER.span("prefetch.item", "scheduler", card_id=item.card_id):
+                    self.bot.generate_text(history, item.deck_id, item.prompt_key, item.card_prompt,
+                                           token, request_class="prefetch")
+                METRICS.incr("prefetch.generated")
+                with self.lock:
+                    if len(self.generated) > 1000:
+                        self.generated.clear()
+                    self.generated.add(item.card_prompt.key)
+            except GeminiError as e:
+                METRICS.incr("prefetch.failed", kind=e.kind)
+                if e.kind in ("cancelled", "budget", "unavailable", "network", "api_key_missing"):
+                    break
+        with self.lock:
+            self.queue = []
+            self.running = False
+
+    def _on_done(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            # self.bot.debug.log(f"Prefetch error: {e}", True)
+            with self.lock:
+                self.running = False
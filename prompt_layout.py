@@ -0,0 +1,59 @@
+import re
+
+from .metrics import METRICS
+from .prompt_templates import load_template
+
+# Cụm thay cho placeholder trong phần instruction tĩnh
+CONTENT_REFERENCE = {
+    "vi": "(nội dung ở cuối)",
+    "en": "(the content at the end)",
+}
+
+
+def assemble_prompt(template, content, lang="vi", separator="\n\n"):
+    """Đặt instruction tĩnh lên trước, nội dung của card xuống cuối.
+
+    "Giải thích chi tiết về: {text} ngắn gọn dưới 200 từ" trở thành
+    "Giải thích chi tiết về: (nội dung ở cuối) ngắn gọn dưới 200 từ<separator><content>",
+    nên mọi card dùng chung template có cùng prefix và được implicit cache của
+    provider dùng lại. content là khối nội dung đã render bởi
+    CompiledTemplate.content (nhiều placeholder → các dòng "Tên: giá trị").
+    """
+    reference = CONTENT_REFERENCE.get(lang, CONTENT_REFERENCE["vi"])
+    instruction = load_template(template).instruction(reference)
+    instruction = re.sub(r"[ \t]{2,}", " ", instruction).strip()
+    if not content:
+        return instruction
+    return f"{instruction}{separator}{content}"
+
+
+def record_usage(usage, deck_id=None, prompt_key=None):
+    """Ghi nhận cachedContentTokenCount từ usageMetadata theo deck và prompt key."""
+    if not usage:
+        return
+    labels = {"deck": str(deck_id or "-"), "prompt": prompt_key or "-"}
+    prompt_tokens = usage.get("promptTokenCount", 0)
+    cached_tokens = usage.get("cachedContentTokenCount", 0)
+    METRICS.incr("prefix_cache.requests", **labels)
+    METRICS.incr("prefix_cache.prompt_tokens", prompt_tokens, **labels)
+    METRICS.incr("prefix_cache.cached_tokens", cached_tokens, **labels)
+    if cached_tokens:
+        METRICS.incr("prefix_cache.hits", **labels)
+
+
+def prefix_cache_report(deck_name=str):
+    """Tỉ lệ prefix-cache hit theo (deck, prompt key), dạng các dòng text."""
+    requests = METRICS.by_labels("prefix_cache.requests")
+    lines = []
+    for labels, count in sorted(requests.items()):
+        label_dict = dict(labels)
+        prompt_tokens = METRICS.get("prefix_cache.prompt_tokens", **label_dict)
+        cached_tokens = METRICS.get("prefix_cache.cached_tokens", **label_dict)
+        hits = METRICS.get("prefix_cache.hits", **label_dict)
+        rate = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0
+        lines.append(
+            f"{deck_name(label_dict['deck'])} / {label_dict['prompt']}: "
+            f"{rate:.0f}% tokens cached ({int(cached_tokens)}/{int(prompt_tokens)}), "
+            f"{int(hits)}/{int(count)} requests hit"
+        )
+    return lines
@@ -0,0 +1,159 @@
+import re
+from functools import lru_cache
+
+# {Name} hoặc {{Name}} (kiểu Anki), tuỳ chọn giới hạn độ dài: {Name:300}
+PLACEHOLDER_RE = re.compile(r"\{\{([^{}]+)\}\}|\{([^{}]+)\}")
+
+# Placeholder dành riêng; tên khác là tên field của note
+TEXT_NAMES = ("text", "field_content") # Trường mục tiêu của deck (đã làm sạch)
+SPECIAL_NAMES = ("deck", "tags", "ord")
+
+# Giới hạn mặc định (ký tự) cho mỗi placeholder không ghi rõ giới hạn
+DEFAULT_CAP = 4000
+
+
+class TemplateError(ValueError):
+    """Template không hợp lệ.
+
+    code: "syntax", "no_placeholder", "bad_cap" hoặc "unknown_field";
+    details dùng để format thông báo (languages: error_template_<code>).
+    """
+
+    def __init__(self, code, **details):
+        super().__init__(f"{code}: {details}")
+        self.code = code
+        self.details = details
+
+
+class Placeholder:
+    __slots__ = ("name", "kind", "cap")
+
+    def __init__(self, name, kind, cap=None):
+        self.name = name
+        self.kind = kind # "text", "field", "deck", "tags" hoặc "ord"
+        self.cap = cap
+
+
+class CompiledTemplate:
+    """Template đã parse: danh sách phần literal và Placeholder.
+
+    Nội dung thay đổi theo card được gom thành một khối (content) để đặt ở cuối
+    prompt; phần instruction chỉ còn tham chiếu tới placeholder.
+    """
+
+    def __init__(self, source, parts):
+        self.source = source
+        self.parts = parts
+        self.placeholders = []
+        seen = set()
+        for part in parts:
+            if isinstance(part, Placeholder) and part.name not in seen:
+                seen.add(part.name)
+                self.placeholders.append(part)
+        if not self.placeholders:
+            # Template cũ không có placeholder: nội dung card được nối vào cuối
+            self.placeholders.append(Placeholder("text", "text"))
+        self.fields = [p.name for p in self.placeholders if p.kind == "field"]
+
+    @property
+    def single(self):
+        """Chỉ có một placeholder → content là giá trị của nó, không kèm nhãn."""
+        return len(self.placeholders) == 1
+
+    def instruction(self, reference):
+        """Phần tĩnh: mỗi placeholder thay bằng reference (hoặc "(Tên)" khi có nhiều)."""
+        return "".join(
+            part if isinstance(part, str) else (reference if self.single else f"({part.name})")
+            for part in self.parts
+        )
+
+    def batch_template(self):
+        """Template cho bulk: {text} khi chỉ có một placeholder, {Tên} khi có nhiều."""
+        return "".join(
+            part if isinstance(part, str) else ("{text}" if self.single else "{%s}" % part.name)
+            for part in self.parts
+        )
+
+    def content(self, values, default_cap=DEFAULT_CAP):
+        """Khối nội dung của card từ values {tên placeholder: text}, đã áp giới hạn.
+
+        Trả về "" nếu mọi field đều rỗng (card không có gì để hỏi).
+        """
+        if not any(values.get(p.name, "").strip() for p in self.placeholders if p.kind in ("text", "field")):
+            return ""
+        if self.single:
+            placeholder = self.placeholders[0]
+            return _cap(values.get(placeholder.name, ""), placeholder.cap or default_cap)
+        return "\n".join(
+            f"{p.name}: {_cap(values.get(p.name, ''), p.cap or default_cap)}" for p in self.placeholders
+        )
+
+    def render(self, values, default_cap=DEFAULT_CAP):
+        """Template với giá trị điền trực tiếp vào chỗ placeholder."""
+        return "".join(
+            part if isinstance(part, str) else _cap(values.get(part.name, ""), part.cap or default_cap)
+            for part in self.parts
+        )
+
+    def validate_fields(self, field_names):
+        """Raise TemplateError nếu template dùng field không có trong note type."""
+        for name in self.fields:
+            if name not in field_names:
+                raise TemplateError("unknown_field", name=name, fields=", ".join(field_names))
+
+
+def _cap(value, cap):
+    value = value or ""
+    if cap and len(value) > cap:
+        return value[:cap].rstrip() + "…"
+    return value
+
+
+def _parse_placeholder(spec):
+    name, _, cap = spec.partition(":")
+    name = name.strip()
+    if not name:
+        raise TemplateError("syntax", text="{" + spec + "}")
+    if cap:
+        if not cap.strip().isdigit() or int(cap) <= 0:
+            raise TemplateError("bad_cap", name=name)
+        cap = int(cap)
+    else:
+        cap = None
+    if name in TEXT_NAMES:
+        return Placeholder(name, "text", cap)
+    if name in SPECIAL_NAMES:
+        return Placeholder(name, name, cap)
+    return Placeholder(name, "field", cap)
+
+
+@lru_cache(maxsize=256)
+def compile_template(source):
+    """Parse template một lần (cache theo nội dung), raise TemplateError nếu sai."""
+    parts = []
+    pos = 0
+    for match in PLACEHOLDER_RE.finditer(source):
+        literal = source[pos:match.start()]
+        if "{" in literal or "}" in literal:
+            raise TemplateError("syntax", text=literal.strip()[:40])
+        if literal:
+            parts.append(literal)
+        parts.append(_parse_placeholder(match.group(1) or match.group(2)))
+        pos = match.end()
+    literal = source[pos:]
+    if "{" in literal or "}" in literal:
+        raise TemplateError("syntax", text=literal.strip()[:40])
+    if literal:
+        parts.append(literal)
+    if not any(isinstance(part, Placeholder) for part in parts):
+        raise TemplateError("no_placeholder")
+    return CompiledTemplate(source, parts)
+
+
+def load_template(source):
+    """Template dùng lúc chạy: template lỗi (lưu từ phiên bản cũ) được coi là
+    text thuần với nội dung card nối vào cuối thay vì làm hỏng request."""
+    try:
+        return compile_template(source)
+    except TemplateError:
+        return CompiledTemplate(source, [source])
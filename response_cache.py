@@ -0,0 +1,130 @@
+import hashlib
+import threading
+import time
+
+from .metrics import METRICS
+from .semantic_cache import create_semantic_index, normalize_text
+
+
+class CardPrompt:
+    """Yêu cầu "áp dụng template cho nội dung card" — đơn vị được cache.
+
+    Không phụ thuộc cách prompt được lắp (chat hay batch), nên câu trả lời
+    của bulk job và của chat dùng chung cache.
+    """
+
+    def __init__(self, prompt_key, template, content, model, system_context="", media=()):
+        self.prompt_key = prompt_key or "-"
+        self.template = template
+        self.content = content
+        self.model = model
+        self.system_context = system_context or ""
+        self.media = [tuple(item) for item in media] # [(đường dẫn ảnh, key của ImageCache)] gửi kèm
+
+    @property
+    def namespace(self):
+        """Các request cùng namespace chỉ khác nhau ở nội dung card."""
+        parts = [self.prompt_key, self.template, self.system_context, self.model]
+        if self.media:
+            # Câu trả lời phụ thuộc cả ảnh (key đổi khi file ảnh đổi)
+            parts.append(",".join(key for _, key in self.media))
+        raw = "\x1f".join(parts)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def pack_namespace(self):
+        """Namespace dùng cho answer pack: như namespace nhưng không có model
+        (câu trả lời dùng chung giữa các model); None nếu có ảnh (không đưa vào pack)."""
+        if self.media:
+            return None
+        raw = "\x1f".join([self.prompt_key, self.template, self.system_context])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def key(self):
+        raw = self.namespace + "\x1f" + normalize_text(self.content)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Cache câu trả lời: exact match (SQLite) rồi tới semantic index (numpy)."""
+
+    def __init__(self, conn, get_config, index_path=None):
+        self.conn = conn
+        self.get_config = get_config
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, prompt_key TEXT, content TEXT, answer TEXT, created REAL, pack_namespace TEXT)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(responses)")]
+        if "pack_namespace" not in columns:
+            # Database cũ: các câu trả lời đã có không biết template nên không được export
+            self.conn.execute("ALTER TABLE responses ADD COLUMN pack_namespace TEXT")
+        self.semantic = None
+        config = get_config()
+        if index_path and config.get("semantic_cache_enabled", True):
+            try:
+                self.semantic = create_semantic_index(
+                    conn, index_path, config.get("semantic_cache_max_entries", 10000)
+                )
+            except Exception:
+                # File index hỏng hoặc không mmap được → chỉ dùng exact cache
+                self.semantic = None
+
+    def _threshold(self, prompt_key):
+        thresholds = self.get_config().get("semantic_cache_thresholds", {})
+        return thresholds.get(prompt_key, thresholds.get("default", 0.92))
+
+    def _get_exact(self, key):
+        row = self.conn.execute("SELECT answer FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, request):
+        """Câu trả lời đã cache cho CardPrompt, hoặc None."""
+        answer = self._get_exact(request.key)
+        if answer is not None:
+            METRICS.incr("cache.exact_hits")
+            return answer
+
+        if self.semantic is not None and request.content.strip():
+            similar_key = self.semantic.lookup(
+                request.namespace, request.content, self._threshold(request.prompt_key)
+            )
+            if similar_key:
+                answer = self._get_exact(similar_key)
+                if answer is not None:
+                    METRICS.incr("cache.semantic_hits")
+                    return answer
+
+        METRICS.incr("cache.misses")
+        return None
+
+    def put(self, request, answer):
+        if not answer:
+            return
+        with self.lock:
+            exists = self._get_exact(request.key) is not None
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, prompt_key, content, answer, created, pack_namespace) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (request.key, request.prompt_key, request.content, answer, time.time(), request.pack_namespace),
+            )
+        if self.semantic is not None and not exists and request.content.strip():
+            self.semantic.insert(request.namespace, request.key, request.content)
+
+    def pack_answers(self):
+        """[(pack_namespace, content, answer)] của các câu trả lời export được thành pack.
+
+        Đọc hết dưới lock (connection dùng chung với main thread); bỏ câu trả
+        lời có ảnh và câu trả lời cũ không biết template.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT pack_namespace, content, answer FROM responses "
+                "WHERE pack_namespace IS NOT NULL ORDER BY created"
+            ).fetchall()
+
+    def close(self):
+        if self.semantic is not None:
+            self.semantic.flush()
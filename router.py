@@ -0,0 +1,62 @@
+from .bridge import PREFIX, parse_message
+from .metrics import METRICS
+from .stall_watchdog import WATCHDOG
+from .tracing import TRACER, entry_span
+
+
+class CommandRouter:
+    """Handler duy nhất của add-on cho webview_did_receive_js_message.
+
+    Message được tra theo prefix (phần trước dấu ":" đầu tiên) rồi theo type
+    trong bảng dict, nên chi phí mỗi message không đổi dù có bao nhiêu route.
+    Component đăng ký route kèm owner và gỡ toàn bộ route của mình khi bị huỷ.
+    """
+
+    def __init__(self):
+        self.prefixes = {PREFIX: self._dispatch_json} # prefix → hàm xử lý message
+        self.routes = {} # type → (handler, owner)
+        self.hook = None
+
+    def register(self):
+        """Gắn router vào hook của Anki (chỉ một lần)."""
+        from aqt.gui_hooks import webview_did_receive_js_message
+        if self.hook is None:
+            self.hook = webview_did_receive_js_message
+            self.hook.append(self.dispatch)
+
+    def unregister(self):
+        if self.hook is not None:
+            self.hook.remove(self.dispatch)
+            self.hook = None
+        self.routes.clear()
+
+    def add(self, msg_type, handler, owner=None):
+        """handler(data) xử lý message JSON có type = msg_type."""
+        self.routes[msg_type] = (handler, owner)
+
+    def remove_owner(self, owner):
+        """Gỡ mọi route do owner đăng ký."""
+        for msg_type in [t for t, (_, o) in self.routes.items() if o is owner]:
+            del self.routes[msg_type]
+
+    def dispatch(self, handled, message, context):
+        if handled[0]:
+            return handled
+        colon = message.find(":")
+        dispatcher = self.prefixes.get(message[:colon + 1]) if colon >= 0 else None
+        if dispatcher is None:
+            return handled
+        METRICS.incr("router.invocations")
+        return dispatcher(message)
+
+    def _dispatch_json(self, message):
+        data = parse_message(message)
+        route = self.routes.get(data["type"])
+        if route is None:
+            # Message của add-on nhưng không còn ai xử lý (vd: chat đã đóng) → bỏ qua
+            return True, None
+        METRICS.incr("bridge.actions")
+        if not (WATCHDOG.enabled or TRACER.enabled):
+            return True, route[0](data)
+        with entry_span("bridge:" + data["type"], "bridge"):
+            return True, route[0](data)
@@ -0,0 +1,97 @@
+import html
+
+from aqt import mw, dialogs
+from aqt.qt import *
+
+from .chat_search import MATCH_END, MATCH_START
+from .debug_tools import DebugTools
+from .languages import get_text
+
+
+# ======================================================================
+# SEARCH DIALOG — TÌM TRONG CÁC CUỘC CHAT ĐÃ LƯU
+# ======================================================================
+class ChatSearchDialog(QDialog):
+    def __init__(self, config, search_index):
+        super().__init__(mw)
+        self.config = config
+        self.search_index = search_index
+        self.debug = DebugTools("ChatSearchDialog")
+        self.deck_names = {}
+        # Tìm lại sau khi ngừng gõ một chút, không chạy query mỗi phím
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.run_search)
+        self.initUI()
+
+    def initUI(self):
+        lang = self.config.get("language", "vi")
+        self.setWindowTitle(get_text(lang, "search_title"))
+        self.resize(640, 560)
+
+        layout = QVBoxLayout()
+
+        row = QHBoxLayout()
+        self.query_input = QLineEdit()
+        self.query_input.setPlaceholderText(get_text(lang, "search_placeholder"))
+        self.query_input.textChanged.connect(lambda _: self.search_timer.start())
+        row.addWidget(self.query_input, 1)
+
+        self.deck_filter = QComboBox()
+        self.deck_filter.addItem(get_text(lang, "search_all_decks"), None)
+        for deck in sorted(mw.col.decks.all_names_and_ids(), key=lambda d: d.name):
+            self.deck_names[str(deck.id)] = deck.name
+            self.deck_filter.addItem(deck.name, str(deck.id))
+        self.deck_filter.currentIndexChanged.connect(lambda _: self.run_search())
+        row.addWidget(self.deck_filter)
+        layout.addLayout(row)
+
+        self.results = QTextBrowser()
+        self.results.setOpenLinks(False)
+        self.results.anchorClicked.connect(self.open_in_browser)
+        layout.addWidget(self.results)
+
+        self.status = QLabel("")
+        layout.addWidget(self.status)
+
+        self.setLayout(layout)
+        self.query_input.setFocus()
+
+    def run_search(self):
+        lang = self.config.get("language", "vi")
+        text = self.query_input.text()
+        if not text.strip():
+            self.results.clear()
+            self.status.setText("")
+            return
+
+        hits = self.search_index.search(text, self.deck_filter.currentData())
+        if not hits:
+            self.results.setHtml(f"<i>{get_text(lang, 'search_no_results')}</i>")
+            self.status.setText("")
+            return
+
+        blocks = []
+        for hit in hits:
+            snippet = html.escape(hit.snippet).replace(MATCH_START, "<b>").replace(MATCH_END, "</b>")
+            who = get_text(lang, "you") if hit.role == "user" else get_text(lang, "ai")
+            deck = html.escape(self.deck_names.get(hit.deck_id or "", ""))
+            blocks.append(
+                f"<p><a href='nid:{hit.note_id}'>{deck or 'nid:' + str(hit.note_id)}</a>"
+                f" <span style='color:gray'>· {html.escape(hit.prompt_key or '')}</span><br>"
+                f"<b>{who}:</b> {snippet}</p>"
+            )
+        self.results.setHtml("".join(blocks))
+        self.status.setText(get_text(lang, "search_result_count").format(count=len(hits)))
+
+    def open_in_browser(self, url):
+        """Mở Browser và lọc theo note của kết quả."""
+        query = url.toString()
+        browser = dialogs.open("Browser", mw)
+        try:
+            browser.search_for(query)
+        except AttributeError:
+            # Anki cũ chưa có search_for
+            browser.form.searchEdit.lineEdit().setText(query)
+            browser.onSearchActivated()
@@ -0,0 +1,114 @@
+import os
+import re
+import threading
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # numpy là tuỳ chọn; thiếu thì tắt semantic cache
+    np = None
+
+# Số chiều của vector hashing (float32 → 2 KB mỗi entry)
+DIM = 512
+NGRAM = 3
+
+
+def normalize_text(text):
+    """Bỏ HTML, gộp khoảng trắng, chữ thường (dùng chung cho key và vector)."""
+    text = re.sub(r"<[^>]+>", " ", text or "")
+    text = text.replace("&nbsp;", " ")
+    return " ".join(text.lower().split())
+
+
+def embed(text):
+    """Vector hoá bằng character n-gram hashing (có dấu), đã chuẩn hoá L2."""
+    vec = np.zeros(DIM, dtype=np.float32)
+    padded = f" {normalize_text(text)} "
+    for i in range(max(1, len(padded) - NGRAM + 1)):
+        h = zlib.crc32(padded[i:i + NGRAM].encode("utf-8"))
+        vec[h % DIM] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vec)
+    if norm:
+        vec /= norm
+    return vec
+
+
+class SemanticIndex:
+    """Index vector lưu trong file .npy memory-mapped, cấp 2 sau exact cache.
+
+    Ma trận có kích thước cố định max_entries × DIM (giới hạn bộ nhớ); khi đầy
+    thì ghi đè slot cũ nhất theo vòng. Metadata của slot (namespace, cache key)
+    nằm trong SQLite nên lúc khởi động chỉ cần mmap file, không phải đọc hết.
+    """
+
+    def __init__(self, conn, index_path, max_entries=10000):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_slots ("
+            "slot INTEGER PRIMARY KEY, namespace TEXT, cache_key TEXT, seq INTEGER)"
+        )
+        self.matrix = self._open_matrix(index_path)
+
+        rows = self.conn.execute("SELECT slot, namespace, cache_key, seq FROM semantic_slots").fetchall()
+        self.namespaces = [None] * self.max_entries
+        self.keys = [None] * self.max_entries
+        self.seq = 0
+        for slot, namespace, cache_key, seq in rows:
+            if slot < self.max_entries:
+                self.namespaces[slot] = namespace
+                self.keys[slot] = cache_key
+                self.seq = max(self.seq, seq + 1)
+        self.namespace_ids = np.array(
+            [zlib.crc32(n.encode("utf-8")) if n else -1 for n in self.namespaces], dtype=np.int64
+        )
+
+    def _open_matrix(self, path):
+        if os.path.exists(path):
+            matrix = np.load(path, mmap_mode="r+")
+            if matrix.shape == (self.max_entries, DIM):
+                return matrix
+            # Kích thước thay đổi (cấu hình mới) → dựng lại index
+            del matrix
+            self.conn.execute("DELETE FROM semantic_slots")
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(self.max_entries, DIM))
+
+    def insert(self, namespace, cache_key, text):
+        vec = embed(text)
+        with self.lock:
+            slot = self.seq % self.max_entries
+            self.matrix[slot] = vec
+            self.namespaces[slot] = namespace
+            self.keys[slot] = cache_key
+            self.namespace_ids[slot] = zlib.crc32(namespace.encode("utf-8"))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO semantic_slots (slot, namespace, cache_key, seq) VALUES (?, ?, ?, ?)",
+                (slot, namespace, cache_key, self.seq),
+            )
+            self.seq += 1
+
+    def lookup(self, namespace, text, threshold):
+        """Cache key của entry giống nhất nếu cosine similarity ≥ threshold."""
+        vec = embed(text)
+        with self.lock:
+            rows = np.nonzero(self.namespace_ids == zlib.crc32(namespace.encode("utf-8")))[0]
+            if not len(rows):
+                return None
+            sims = self.matrix[rows] @ vec
+            best = int(np.argmax(sims))
+            slot = int(rows[best])
+            if sims[best] < threshold or self.namespaces[slot] != namespace:
+                return None
+            return self.keys[slot]
+
+    def flush(self):
+        with self.lock:
+            self.matrix.flush()
+
+
+def create_semantic_index(conn, index_path, max_entries):
+    """SemanticIndex, hoặc None nếu không có numpy."""
+    if np is None:
+        return None
+    return SemanticIndex(conn, index_path, max_entries)
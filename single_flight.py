@@ -0,0 +1,119 @@
+import hashlib
+import json
+import threading
+
+from .metrics import METRICS
+from .transport import CancelToken, RequestCancelled
+
+
+def _normalize(value):
+    """Gộp khoảng trắng trong mọi chuỗi của payload (không đổi cấu trúc)."""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def flight_key(payload, model, deck_id):
+    """Key của request: JSON chuẩn hoá của payload + model + deck."""
+    raw = json.dumps(
+        {"model": model, "deck_id": str(deck_id) if deck_id is not None else None, "payload": _normalize(payload)},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.token = CancelToken() # Huỷ network call khi không còn ai chờ
+        self.waiters = 0
+        self.listeners = []
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Gộp các request giống hệt nhau đang chạy đồng thời thành một network call.
+
+    Caller đầu tiên (leader) thực hiện call, các caller sau chờ và nhận cùng kết
+    quả. Một caller bị huỷ chỉ rời khỏi flight; network call chỉ bị huỷ khi mọi
+    caller đã rời đi. Bộ đếm singleflight.calls / singleflight.shared cho biết
+    tỉ lệ request bị trùng.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(self, key, token, fn):
+        """Chạy fn(flight_token) hoặc chờ flight cùng key → (result, shared).
+
+        Raise RequestCancelled nếu token của caller bị huỷ.
+        """
+        wake = threading.Event()
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+            flight.waiters += 1
+            flight.listeners.append(wake.set)
+        METRICS.incr("singleflight.calls")
+        if not leader:
+            METRICS.incr("singleflight.shared")
+
+        ticket = {"left": False}
+
+        def leave():
+            self._leave(key, flight, ticket)
+            wake.set()
+
+        token.add_callback(leave)
+        try:
+            if leader:
+                self._execute(key, flight, fn)
+            else:
+                wake.wait()
+            token.check()
+        finally:
+            token.remove_callback(leave)
+            self._leave(key, flight, ticket)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, not leader
+
+    def _execute(self, key, flight, fn):
+        try:
+            flight.result = fn(flight.token)
+        except BaseException as e:
+            flight.error = e
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.done = True
+                listeners = list(flight.listeners)
+            for listener in listeners:
+                listener()
+
+    def _leave(self, key, flight, ticket):
+        with self.lock:
+            if ticket["left"]:
+                return
+            ticket["left"] = True
+            flight.waiters -= 1
+            abandoned = flight.waiters <= 0 and not flight.done
+            if abandoned and self.flights.get(key) is flight:
+                # Không còn ai chờ → request mới cùng key phải bắt đầu flight mới
+                del self.flights[key]
+        if abandoned:
+            flight.token.cancel()
+
+    def dedup_rate(self):
+        calls = METRICS.get("singleflight.calls")
+        return METRICS.get("singleflight.shared") / calls if calls else 0.0
@@ -0,0 +1,694 @@
+"""Soak test một phiên review dài, phát hiện tài nguyên tăng không giới hạn.
+
+    python soak.py [--cards 3000] [--chat-every 4] [--panel]
+
+Chạy GeminiChatBot thật trên một aqt giả: webview giả (chỉ đếm eval), event
+loop giả trên main thread (QTimer, signal từ QThread được chuyển về main
+thread như queued connection), taskman là thread pool, và Gemini API giả trên
+localhost. Không cần Anki; không import file này bên trong Anki (nó thay
+module aqt trong sys.modules). Dữ liệu của add-on được ghi vào thư mục tạm.
+
+Mỗi --window card đo: độ trễ thêm vào reviewer_did_show_question (p95),
+thời gian main thread chạy code của add-on, heap Python (tracemalloc), số
+thread, số handler (route của router, hook, timer đang chạy), số ChatWindow
+và QThread còn sống, số lượt chat giữ trong bộ nhớ. Bỏ 20% đầu (warm-up,
+cache đầy dần); chỉ số nào còn tăng theo xu hướng (hồi quy tuyến tính) quá
+ngưỡng cho phép → in vị trí cấp phát tăng nhiều nhất, exit code 1.
+"""
+import argparse
+import gc
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+if not __package__:
+    # Chạy trực tiếp: nạp thư mục add-on như một package tổng hợp (xem headless.py)
+    __package__ = "gemini_chatbot_soak"
+    if __package__ not in sys.modules:
+        _package = types.ModuleType(__package__)
+        _package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+        sys.modules[__package__] = _package
+
+from .latency_profiles import percentile
+
+
+# ======================================================================
+# AQT GIẢ
+# ======================================================================
+class EventLoop:
+    """Event loop của main thread: callback được post từ thread khác và timer."""
+
+    def __init__(self):
+        self.posted = queue.SimpleQueue()
+        self.timers = [] # [due, seq, callback], sắp theo due
+        self.seq = 0
+        self.busy = 0.0 # Tổng thời gian chạy callback (giây)
+        self.errors = []
+
+    def post(self, callback):
+        self.posted.put(callback)
+
+    def call_later(self, ms, callback):
+        self.seq += 1
+        self.timers.append((time.monotonic() + ms / 1000, self.seq, callback))
+        self.timers.sort(key=lambda timer: timer[:2])
+
+    def run(self, callback):
+        started = time.perf_counter()
+        try:
+            callback()
+        except Exception as e:
+            self.errors.append(repr(e))
+        finally:
+            self.busy += time.perf_counter() - started
+
+    def process(self):
+        """Chạy các callback đã post và timer đến hạn; trả về số callback đã chạy."""
+        ran = 0
+        while True:
+            try:
+                callback = self.posted.get_nowait()
+            except queue.Empty:
+                break
+            self.run(callback)
+            ran += 1
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            self.run(self.timers.pop(0)[2])
+            ran += 1
+        return ran
+
+    def run_until(self, done, timeout):
+        """Xử lý event tới khi done() đúng (True) hoặc hết timeout (False)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            if not self.process() and done():
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+
+
+LOOP = EventLoop()
+QTHREADS = weakref.WeakSet()
+QTIMERS = weakref.WeakSet()
+
+
+class _Sink:
+    """Nhận mọi thuộc tính / lời gọi (setObjectName, addWidget, ...) và bỏ qua."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _Sink()
+
+    def __call__(self, *args, **kwargs):
+        return _Sink()
+
+    def __or__(self, other):
+        return self
+
+
+class _BoundSignal:
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot=None):
+        self.slots = [] if slot is None else [s for s in self.slots if s is not slot]
+
+    def emit(self, *args):
+        # Emit từ thread khác → chạy slot trên main thread (queued connection)
+        if threading.current_thread() is threading.main_thread():
+            self._deliver(args)
+        else:
+            LOOP.post(lambda: self._deliver(args))
+
+    def _deliver(self, args):
+        for slot in list(self.slots):
+            slot(*args)
+
+
+class pyqtSignal:
+    def __init__(self, *types):
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = "_signal_" + name
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        return obj.__dict__.setdefault(self.name, _BoundSignal())
+
+
+class QObject(_Sink):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class QWidget(QObject):
+    visible = False
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+    def isVisible(self):
+        return self.visible
+
+
+class QTimer(QObject):
+    timeout = pyqtSignal()
+
+    def __init__(self, *args, **kwargs):
+        self.active = False
+        self.single_shot = False
+        self.interval = 0
+        self.generation = 0
+        QTIMERS.add(self)
+
+    def setSingleShot(self, single_shot):
+        self.single_shot = single_shot
+
+    def setInterval(self, ms):
+        self.interval = ms
+
+    def isActive(self):
+        return self.active
+
+    def start(self, ms=None):
+        if ms is not None:
+            self.interval = ms
+        self.active = True
+        self.generation += 1
+        generation = self.generation
+        LOOP.call_later(self.interval, lambda: self._fire(generation))
+
+    def stop(self):
+        self.active = False
+        self.generation += 1
+
+    def _fire(self, generation):
+        if not self.active or generation != self.generation:
+            return
+        if self.single_shot:
+            self.active = False
+        else:
+            self.start()
+        self.timeout.emit()
+
+    @staticmethod
+    def singleShot(ms, callback):
+        LOOP.call_later(ms, callback)
+
+
+class QThread(QObject):
+    def __init__(self, *args, **kwargs):
+        self.thread = None
+        QTHREADS.add(self)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pass
+
+    def isRunning(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def wait(self, ms=None):
+        if self.thread:
+            self.thread.join(None if ms is None else ms / 1000)
+        return not self.isRunning()
+
+
+class QAction(QObject):
+    triggered = pyqtSignal(bool)
+
+
+class QShortcut(QObject):
+    activated = pyqtSignal()
+
+
+class AnkiWebView(QWidget):
+    """Webview giả: đếm số lần eval / load và số byte."""
+
+    def __init__(self, *args, **kwargs):
+        self.evals = 0
+        self.eval_bytes = 0
+        self.loads = 0
+
+    def eval(self, js):
+        self.evals += 1
+        self.eval_bytes += len(js.encode("utf-8"))
+
+    def stdHtml(self, html, *args, **kwargs):
+        self.loads += 1
+
+    def cleanup(self):
+        pass
+
+
+class Hook:
+    def __init__(self):
+        self.handlers = []
+
+    def append(self, handler):
+        self.handlers.append(handler)
+
+    def remove(self, handler):
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+
+    def count(self):
+        return len(self.handlers)
+
+    def __call__(self, *args):
+        for handler in list(self.handlers):
+            handler(*args)
+
+
+class FilterHook(Hook):
+    def __call__(self, value, *args):
+        for handler in list(self.handlers):
+            value = handler(value, *args)
+        return value
+
+
+class TaskManager:
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="taskman")
+
+    def run_in_background(self, task, on_done=None, args=None):
+        future = self.pool.submit(task, **(args or {}))
+        if on_done is not None:
+            future.add_done_callback(lambda f: LOOP.post(lambda: on_done(f)))
+        return future
+
+    def run_on_main(self, callback):
+        LOOP.post(callback)
+
+
+class Note:
+    def __init__(self, nid, fields):
+        self.id = nid
+        self.mod = 0
+        self.tags = []
+        self._fields = dict(fields)
+
+    @property
+    def fields(self):
+        return list(self._fields.values())
+
+    def keys(self):
+        return list(self._fields)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __getitem__(self, name):
+        return self._fields[name]
+
+    def __setitem__(self, name, value):
+        self._fields[name] = value
+
+
+class Card:
+    def __init__(self, col, cid, nid, did):
+        self.col = col
+        self.id = cid
+        self.nid = nid
+        self.did = did
+        self.ord = 0
+        self.lapses = cid % 3
+
+    def note(self):
+        return self.col.notes[self.nid]
+
+
+class Collection:
+    """Collection giả: một deck, mỗi note một card, hàng đợi review theo thứ tự."""
+
+    DECK_ID = 1
+
+    def __init__(self, count, media_dir):
+        self.notes = {}
+        self.cards = []
+        self.position = 0
+        self.media_dir = media_dir
+        for i in range(1, count + 1):
+            self.notes[i] = Note(i, {"Front": f"<b>word {i}</b> &nbsp;in context {i % 97}", "Back": ""})
+            self.cards.append(Card(self, i * 10, i, self.DECK_ID))
+        self.by_id = {card.id: card for card in self.cards}
+        self.decks = types.SimpleNamespace(
+            name=lambda did: "Soak",
+            get=lambda did, default=True: {"id": did, "name": "Soak"},
+            all_names_and_ids=lambda: [types.SimpleNamespace(id=self.DECK_ID, name="Soak")],
+            deck_and_child_ids=lambda did: [did],
+            parents=lambda did: [],
+        )
+        self.media = types.SimpleNamespace(dir=lambda: self.media_dir)
+        self.sched = types.SimpleNamespace(get_queued_cards=self.get_queued_cards)
+
+    def get_queued_cards(self, fetch_limit=1):
+        cards = self.cards[self.position:self.position + fetch_limit]
+        return types.SimpleNamespace(cards=[types.SimpleNamespace(card=card) for card in cards])
+
+    def get_card(self, cid):
+        return self.by_id[cid]
+
+    def get_note(self, nid):
+        return self.notes[nid]
+
+    def update_notes(self, notes):
+        pass
+
+
+class MainWindow(QWidget):
+    def __init__(self, config):
+        self.config = config
+        self.col = None
+        self.state = "review"
+        self.reviewer = types.SimpleNamespace(web=AnkiWebView(), card=None)
+        self.taskman = TaskManager()
+        self.form = _Sink()
+        self.addonManager = types.SimpleNamespace(getConfig=lambda name: json.loads(json.dumps(self.config)),
+                                                  writeConfig=self.write_config)
+
+    def write_config(self, name, config):
+        self.config = config
+
+
+def install_fake_aqt(mw):
+    """Đưa aqt, aqt.qt, aqt.utils, aqt.webview, aqt.gui_hooks giả vào sys.modules."""
+    messages = []
+    aqt = types.ModuleType("aqt")
+    qt = types.ModuleType("aqt.qt")
+    for cls in (QObject, QWidget, QTimer, QThread, QAction, QShortcut, pyqtSignal):
+        setattr(qt, cls.__name__, cls)
+    for name in ("QDialog", "QDockWidget", "QMenu", "QLabel", "QComboBox", "QLineEdit", "QPushButton",
+                 "QDialogButtonBox", "QCheckBox", "QVBoxLayout", "QHBoxLayout", "QFormLayout", "QGroupBox",
+                 "QListWidget", "QPlainTextEdit", "QSpinBox", "QTextBrowser", "QProgressDialog", "QFileDialog",
+                 "QKeySequence", "QPixmap", "QDateTime"):
+        setattr(qt, name, type(name, (QWidget,), {}))
+    qt.Qt = _Sink()
+    utils = types.ModuleType("aqt.utils")
+    utils.showInfo = lambda text, *args, **kwargs: messages.append(str(text))
+    utils.tooltip = lambda *args, **kwargs: None
+    webview = types.ModuleType("aqt.webview")
+    webview.AnkiWebView = AnkiWebView
+    gui_hooks = types.ModuleType("aqt.gui_hooks")
+    for name in ("reviewer_did_show_question", "reviewer_will_end", "profile_will_close", "state_will_change"):
+        setattr(gui_hooks, name, Hook())
+    gui_hooks.webview_did_receive_js_message = FilterHook()
+    aqt.mw = mw
+    aqt.gui_hooks = gui_hooks
+    aqt.dialogs = _Sink()
+    aqt.qt, aqt.utils, aqt.webview = qt, utils, webview
+    pyqt = types.ModuleType("PyQt6")
+    qtcore = types.ModuleType("PyQt6.QtCore")
+    qtcore.Qt = qt.Qt
+    pyqt.QtCore = qtcore
+    sys.modules.update({"aqt": aqt, "aqt.qt": qt, "aqt.utils": utils, "aqt.webview": webview,
+                        "aqt.gui_hooks": gui_hooks, "PyQt6": pyqt, "PyQt6.QtCore": qtcore})
+    return gui_hooks, messages
+
+
+# ======================================================================
+# GEMINI API GIẢ
+# ======================================================================
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    latency = 0.02
+    answers = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if "cachedContents" in self.path:
+            self.reply({"name": "cachedContents/soak"})
+            return
+        time.sleep(self.latency)
+        FakeGeminiHandler.answers += 1
+        text = f"**Answer {FakeGeminiHandler.answers}**\n" + "A reasonably long explanation. " * 12
+        self.reply({"candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": "STOP"}],
+                    "usageMetadata": {"promptTokenCount": 40, "candidatesTokenCount": 90}})
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.reply({})
+
+    def do_DELETE(self):
+        self.reply({})
+
+    def reply(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# ======================================================================
+# SOAK
+# ======================================================================
+# (chỉ số, mức tăng cho phép sau warm-up); heap và độ trễ có ngưỡng riêng
+CHECKS = (
+    ("threads", 2),
+    ("handlers", 0),
+    ("chat_windows", 0),
+    ("qthreads", 2),
+    ("history_turns", 8),
+)
+
+
+def trend(samples, name):
+    """Mức tăng của chỉ số theo đường hồi quy tuyến tính, từ window đầu tới window cuối."""
+    xs = [sample["cards"] for sample in samples]
+    ys = [sample[name] for sample in samples]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum((x - mean_x) ** 2 for x in xs)
+    return slope * (xs[-1] - xs[0])
+
+
+class SoakRunner:
+    """Chạy các card qua add-on như một phiên review và lấy mẫu tài nguyên."""
+
+    def __init__(self, cards=3000, chat_every=4, window=250, panel=False, api_latency_ms=20,
+                 heap_slack_kb=256, latency_factor=2.0, log=print):
+        self.cards = cards
+        self.chat_every = max(1, chat_every)
+        self.window = window
+        self.panel = panel
+        self.api_latency = api_latency_ms / 1000
+        self.heap_slack_kb = heap_slack_kb
+        self.latency_factor = latency_factor
+        self.log = log
+        self.samples = []
+        self.hook_ms = [] # Độ trễ hook (ms) của window hiện tại
+        self.stuck = 0
+        self.chats = 0
+        self.snapshots = [] # tracemalloc snapshot sau warm-up và cuối phiên
+
+    def config(self):
+        return {
+            "api_key": "soak",
+            "language": "en",
+            "chat_panel": self.panel,
+            "prefetch_cards": 2,
+            "prefetch_idle_delay": 0,
+            "outbox_probe_interval": 3600,
+            # Cache nhỏ để đầy trong lúc warm-up: sau đó heap chỉ được phép dao động
+            "semantic_cache_max_entries": 256,
+            "target_field": "Front",
+            "deck_settings": {str(Collection.DECK_ID): {
+                "enabled": True, "target_field": "Front", "output_field": "Back",
+                "selected_prompt": "explain_simple",
+            }},
+        }
+
+    def run(self):
+        workdir = tempfile.mkdtemp(prefix="gemini-soak-")
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeminiHandler)
+        FakeGeminiHandler.latency = self.api_latency
+        threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+        mw = MainWindow(self.config())
+        self.hooks, self.messages = install_fake_aqt(mw)
+        try:
+            from . import gemini_client, storage
+            from . import gemini_chatbot
+            from .bridge import PREFIX, PROTOCOL_VERSION
+            from .chat_window import ChatWindow
+
+            storage.USER_FILES_DIR = gemini_chatbot.USER_FILES_DIR = os.path.join(workdir, "user_files")
+            gemini_client.GEMINI_BASE_URL = f"http://127.0.0.1:{server.server_port}/v1beta"
+            self.prefix, self.protocol, self.chat_window_type = PREFIX, PROTOCOL_VERSION, ChatWindow
+            mw.col = Collection(self.cards, os.path.join(workdir, "media"))
+            self.mw = mw
+            tracemalloc.start()
+            self.bot = gemini_chatbot.GeminiChatBot()
+            self.bot.config = self.bot.load_config()
+            self._session()
+            self.hooks.profile_will_close()
+            LOOP.run_until(lambda: True, 1)
+        finally:
+            tracemalloc.stop()
+            server.shutdown()
+            shutil.rmtree(workdir, ignore_errors=True)
+        return self
+
+    def _session(self):
+        busy = LOOP.busy
+        for index, card in enumerate(self.mw.col.cards):
+            self.mw.col.position = index
+            self.mw.reviewer.card = card
+            started = time.perf_counter()
+            self.hooks.reviewer_did_show_question(card)
+            self.hook_ms.append((time.perf_counter() - started) * 1000)
+            if index % self.chat_every == 0:
+                self._chat(index)
+            self._settle()
+            if index % 500 == 499:
+                # Rời màn hình review rồi quay lại (overview → review)
+                self.hooks.reviewer_will_end()
+                self.hooks.state_will_change("overview", "review")
+                self.hooks.state_will_change("review", "overview")
+            if (index + 1) % self.window == 0:
+                self.samples.append(self._sample(index + 1, LOOP.busy - busy))
+                self.hook_ms = []
+                if len(self.samples) == max(1, self.cards // self.window // 5) or index + 1 == self.cards:
+                    self.snapshots.append(tracemalloc.take_snapshot().filter_traces(
+                        [tracemalloc.Filter(True, os.path.dirname(os.path.abspath(__file__)) + os.sep + "*"),
+                         tracemalloc.Filter(False, os.path.abspath(__file__))]))
+                busy = LOOP.busy
+                self.log(self._format(self.samples[-1]))
+
+    def _bridge(self, msg_type, **data):
+        message = self.prefix + json.dumps({"v": self.protocol, "type": msg_type, **data})
+        return self.hooks.webview_did_receive_js_message((False, None), message, self.mw.reviewer)
+
+    def _chat(self, index):
+        """Mở chat, gửi prompt tự động (xen kẽ câu hỏi tự do, đôi khi hỏi tiếp), đôi khi đóng."""
+        self._bridge("open")
+        chat_window = self.bot.chat_window
+        if chat_window is None:
+            return
+        self.chats += 1
+        text = chat_window.auto_prompt if self.chats % 2 and chat_window.auto_prompt else f"Tell me more about {index}"
+        self._bridge("send", text=text)
+        self._settle()
+        if self.chats % 5 == 0:
+            self._bridge("send", text=f"And an example for {index}?")
+            self._settle()
+        if self.chats % 3 == 0:
+            self._bridge("close")
+
+    def _idle(self):
+        chat_window = self.bot.chat_window
+        return not (chat_window and chat_window.pending) and not self.bot.prefetcher.running
+
+    def _settle(self):
+        if not LOOP.run_until(self._idle, 10):
+            self.stuck += 1
+
+    def _sample(self, cards, busy):
+        gc.collect()
+        router = self.bot.router
+        hooks = [getattr(self.hooks, name) for name in dir(self.hooks) if isinstance(getattr(self.hooks, name), Hook)]
+        return {
+            "cards": cards,
+            "hook_p95_ms": percentile(self.hook_ms, 95),
+            "main_ms_per_card": busy / self.window * 1000,
+            "heap_kb": tracemalloc.get_traced_memory()[0] // 1024,
+            "threads": threading.active_count(),
+            "handlers": len(router.routes) + sum(hook.count() for hook in hooks)
+                        + sum(1 for timer in QTIMERS if timer.active),
+            "chat_windows": sum(1 for obj in gc.get_objects() if isinstance(obj, self.chat_window_type)),
+            "qthreads": len(QTHREADS),
+            "history_turns": sum(len(session.turns) for session in self.bot.sessions.sessions.values()),
+        }
+
+    @staticmethod
+    def _format(sample):
+        return ("{cards:>6} cards  hook p95 {hook_p95_ms:6.2f} ms  main {main_ms_per_card:6.2f} ms/card  "
+                "heap {heap_kb:>7,} KB  threads {threads:>3}  handlers {handlers:>3}  "
+                "chat windows {chat_windows}  qthreads {qthreads:>2}  turns {history_turns:>3}").format(**sample)
+
+    def growth(self, limit=10):
+        """Vị trí cấp phát (trong code add-on) tăng nhiều nhất từ sau warm-up tới cuối phiên."""
+        if len(self.snapshots) < 2:
+            return []
+        stats = self.snapshots[-1].compare_to(self.snapshots[0], "lineno")
+        return [str(stat) for stat in stats[:limit] if stat.size_diff > 0]
+
+    def failures(self):
+        """Các chỉ số tăng không giới hạn (rỗng → đạt)."""
+        failures = [f"uncaught error on the main thread: {error}" for error in LOOP.errors[:5]]
+        failures += [f"unexpected dialog: {message[:80]}" for message in self.messages[:5]]
+        if self.stuck:
+            failures.append(f"{self.stuck} cards never became idle (chat or prefetch stuck)")
+        warmup = max(1, len(self.samples) // 5)
+        measured = self.samples[warmup:]
+        if len(measured) < 4:
+            return failures + ["not enough windows to judge growth (use more --cards or a smaller --window)"]
+        first = measured[:len(measured) // 2]
+        limits = dict(CHECKS)
+        baseline_heap = sum(sample["heap_kb"] for sample in first) / len(first)
+        limits["heap_kb"] = max(self.heap_slack_kb, baseline_heap / 10)
+        for name in ("hook_p95_ms", "main_ms_per_card"):
+            baseline = sum(sample[name] for sample in first) / len(first)
+            limits[name] = baseline * (self.latency_factor - 1) + 1
+        for name, limit in limits.items():
+            grew = trend(measured, name)
+            if grew > limit:
+                failures.append(f"{name} grows by {grew:,.2f} over {measured[-1]['cards'] - measured[0]['cards']} "
+                                f"cards after warm-up (allowed {limit:,.2f})")
+        return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a long review session against stub webviews and "
+                                                 "a local API server, and fail on unbounded growth.")
+    parser.add_argument("--cards", type=int, default=3000, help="cards shown in the session")
+    parser.add_argument("--chat-every", type=int, default=4, help="open the chat and ask on every N-th card")
+    parser.add_argument("--window", type=int, default=250, help="cards per measurement window")
+    parser.add_argument("--panel", action="store_true", help="use the docked chat panel instead of the reviewer")
+    parser.add_argument("--api-latency-ms", type=int, default=20, help="latency of the fake Gemini API")
+    parser.add_argument("--heap-slack-kb", type=int, default=256, help="heap growth allowed after warm-up")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runner = SoakRunner(args.cards, args.chat_every, args.window, args.panel, args.api_latency_ms,
+                        args.heap_slack_kb, log=lambda line: print(line, file=sys.stderr, flush=True))
+    runner.run()
+    failures = runner.failures()
+    print(f"{runner.cards} cards, {runner.chats} chats, {FakeGeminiHandler.answers} API calls")
+    if failures:
+        print("FAIL\n" + "\n".join("  " + failure for failure in failures))
+        print("Largest allocation growth after warm-up:\n" + "\n".join("  " + line for line in runner.growth()))
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from .latency_profiles import percentile
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OUTSIDE = "(outside add-on)"
+
+# Timer bị dừng lâu hơn thế này thường là máy ngủ / cửa sổ bị treo bởi hệ điều hành
+MAX_STALL = 30.0
+
+
+class StallWatchdog:
+    """Phát hiện main thread bị treo và entry point nào của add-on đang chạy lúc đó.
+
+    Bật bằng stall_watchdog. Một QTimer trên main thread "đập" mỗi interval;
+    khi nhịp tim bị trễ, một thread nền lấy mẫu span đang mở trên main thread
+    (entry point được đánh dấu bằng traced / span), nếu không có span thì
+    hàm của add-on trên stack của main thread. Nhịp tim kế tiếp đo độ trễ của
+    event loop; trễ hơn threshold → một stall, gán cho nhãn được lấy mẫu
+    nhiều nhất. Không có mẫu nào thuộc add-on → stall của Anki hoặc add-on khác.
+    """
+
+    def __init__(self, interval_ms=50, max_stalls=500):
+        self.lock = threading.Lock()
+        self.interval = interval_ms / 1000
+        self.threshold = 0.2
+        self.enabled = False
+        self.main_thread_id = threading.main_thread().ident
+        self.spans = [] # Span đang mở trên main thread (ngoài cùng trước)
+        self.last_span = (None, 0.0) # (tên, lúc kết thúc) của span vừa đóng
+        self.samples = Counter() # nhãn → số mẫu trong lần trễ đang diễn ra
+        self.stalls = deque(maxlen=max_stalls) # (nhãn, giây)
+        self.last_beat = 0.0
+        self.timer = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self, threshold_ms=200):
+        from aqt import mw
+        from aqt.qt import Qt, QTimer
+
+        self.threshold = threshold_ms / 1000
+        if self.enabled:
+            return
+        self.enabled = True
+        self.last_beat = time.monotonic()
+        self.timer = QTimer(mw)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self._beat)
+        self.timer.start(int(self.interval * 1000))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._watch, args=(self.stop_event,),
+                                       name="gemini-stall-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.stop_event.set()
+        self.timer.stop()
+        self.timer.deleteLater()
+        self.timer = None
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        """Đánh dấu đoạn code chạy trên main thread (chỉ ghi khi watchdog bật)."""
+        if not self.enabled or threading.get_ident() != self.main_thread_id:
+            yield
+            return
+        self.spans.append(name)
+        try:
+            yield
+        finally:
+            self.spans.pop()
+            self.last_span = (name, time.monotonic())
+
+    def _beat(self):
+        """Main thread: đo độ trễ so với nhịp dự kiến."""
+        now = time.monotonic()
+        lag = now - self.last_beat - self.interval
+        since = self.last_beat
+        self.last_beat = now
+        with self.lock:
+            samples, self.samples = self.samples, Counter()
+        if lag < self.threshold or lag > MAX_STALL:
+            return
+        if samples:
+            label = samples.most_common(1)[0][0]
+        else:
+            # Stall ngắn hơn chu kỳ lấy mẫu: span vừa kết thúc trong lúc trễ
+            name, ended = self.last_span
+            label = name if name and ended >= since else OUTSIDE
+        with self.lock:
+            self.stalls.append((label, lag))
+
+    def _watch(self, stop_event):
+        """Thread nền: lấy mẫu khi main thread trễ nhịp."""
+        while not stop_event.wait(self.interval):
+            if time.monotonic() - self.last_beat < self.interval * 2:
+                continue
+            label = self._sample()
+            with self.lock:
+                self.samples[label] += 1
+
+    def _sample(self):
+        spans = list(self.spans)
+        if spans:
+            return spans[0]
+        frame = sys._current_frames().get(self.main_thread_id)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(ADDON_DIR) and not filename.endswith("stall_watchdog.py"):
+                return f"{os.path.basename(filename)}:{frame.f_code.co_name}"
+            frame = frame.f_back
+        return OUTSIDE
+
+    def report(self):
+        """Dòng báo cáo: entry point xếp theo tổng thời gian treo."""
+        with self.lock:
+            stalls = list(self.stalls)
+        if not stalls:
+            return []
+        by_label = {}
+        for label, seconds in stalls:
+            by_label.setdefault(label, []).append(seconds)
+        ranked = sorted(by_label.items(), key=lambda item: sum(item[1]), reverse=True)
+        lines = [f"{'entry point':<34} {'stalls':>6} {'total':>8} {'p95':>7} {'worst':>7}"]
+        for label, values in ranked:
+            lines.append(f"{label[:34]:<34} {len(values):>6} {sum(values) * 1000:>6.0f}ms "
+                         f"{percentile(values, 95) * 1000:>5.0f}ms {max(values) * 1000:>5.0f}ms")
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.stalls.clear()
+
+
+WATCHDOG = StallWatchdog()
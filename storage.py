@@ -0,0 +1,27 @@
+import os
+import sqlite3
+
+ADDON_DIR = os.path.dirname(__file__)
+
+# Anki giữ nguyên thư mục user_files khi cập nhật add-on
+USER_FILES_DIR = os.path.join(ADDON_DIR, "user_files")
+
+DB_NAME = "gemini_chat.db"
+
+
+def user_files_path(*parts):
+    """Đường dẫn trong user_files, tạo thư mục cha nếu cần."""
+    path = os.path.join(USER_FILES_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def connect(name=DB_NAME):
+    """Mở SQLite database dùng chung của add-on (autocommit, WAL).
+
+    Connection có thể được dùng từ nhiều thread; các store tự khoá khi ghi.
+    """
+    conn = sqlite3.connect(user_files_path(name), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
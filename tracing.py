@@ -0,0 +1,159 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+from .stall_watchdog import WATCHDOG
+
+
+class Tracer:
+    """Ghi span của add-on theo Chrome Trace Event format (Perfetto, chrome://tracing).
+
+    Chỉ ghi trong lúc capture (start → stop). Span được ghi trên mọi thread
+    (UI, taskman, QThread của bulk job, pool của outbox) với tên thread, nên
+    trace viewer cho thấy UI thread, worker và thời gian chờ mạng chồng lên
+    nhau thế nào. Tuỳ chọn trong lúc capture: cProfile cho main thread (file
+    .prof đi kèm) và tracemalloc (counter bộ nhớ + top vị trí cấp phát).
+    """
+
+    def __init__(self, max_events=500000):
+        self.lock = threading.Lock()
+        self.max_events = max_events
+        self.enabled = False
+        self.events = []
+        self.threads = {} # tid → tên thread
+        self.dropped = 0
+        self.origin = 0.0
+        self.started_at = 0.0
+        self.pid = os.getpid()
+        self.profiler = None
+        self.memory = False
+        self.memory_start = None
+        self.owns_tracemalloc = False # tracemalloc do start() bật (không tắt nếu người khác đang dùng)
+
+    def start(self, profile=False, memory=False):
+        if self.enabled:
+            return
+        with self.lock:
+            self.events = []
+            self.threads = {}
+            self.dropped = 0
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.memory = memory
+        if memory:
+            self.owns_tracemalloc = not tracemalloc.is_tracing()
+            if self.owns_tracemalloc:
+                tracemalloc.start()
+            self.memory_start = tracemalloc.take_snapshot()
+        if profile:
+            # cProfile chỉ đo thread gọi enable() → main thread
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.enabled = True
+
+    def stop(self):
+        """Dừng capture; trả về (events, other_data, profiler hoặc None) cho export.
+
+        Profiler thuộc về lần capture này: không được giữ lại cho lần sau (vd:
+        khi người dùng huỷ lưu trace).
+        """
+        if not self.enabled:
+            return [], {}, None
+        self.enabled = False
+        other = {"started_at": self.started_at, "duration_s": round(time.perf_counter() - self.origin, 3),
+                 "dropped_events": self.dropped}
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            profiler.disable()
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.memory_start, "lineno")[:20]
+            other["memory_top"] = [str(stat) for stat in stats]
+            if self.owns_tracemalloc:
+                tracemalloc.stop()
+            self.owns_tracemalloc = False
+            self.memory_start = None
+        with self.lock:
+            events = self.events
+            threads = dict(self.threads)
+            self.events = []
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in threads.items()]
+        return metadata + events, other, profiler
+
+    def export(self, path, events, other, profiler=None):
+        """Ghi file trace JSON (và path.prof nếu có cProfile)."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": other}, f)
+        if profiler is not None:
+            profiler.dump_stats(os.path.splitext(path)[0] + ".prof")
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event["pid"] = self.pid
+        event["tid"] = thread.ident
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat="addon", **args):
+        """Span ("X" event) quanh một đoạn code, trên thread hiện tại.
+
+        Yield dict args để thêm thông tin biết được sau (vd: HTTP status).
+        """
+        if not self.enabled:
+            yield args
+            return
+        start = self._now()
+        try:
+            yield args
+        finally:
+            if self.enabled:
+                self._add({"name": name, "cat": cat, "ph": "X", "ts": start,
+                           "dur": self._now() - start, "args": args})
+                if self.memory and threading.current_thread() is threading.main_thread():
+                    current, peak = tracemalloc.get_traced_memory()
+                    self.counter("python memory", current_kb=current // 1024, peak_kb=peak // 1024)
+
+    def instant(self, name, cat="addon", **args):
+        if self.enabled:
+            self._add({"name": name, "cat": cat, "ph": "i", "s": "t", "ts": self._now(), "args": args})
+
+    def counter(self, name, **values):
+        if self.enabled:
+            self._add({"name": name, "ph": "C", "ts": self._now(), "args": values})
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def entry_span(name, cat):
+    """Entry point của add-on: span cho cả stall watchdog và tracer."""
+    with WATCHDOG.span(name), TRACER.span(name, cat):
+        yield
+
+
+def traced(name, cat="hook"):
+    """Decorator: chạy hàm trong entry_span (gần như không tốn gì khi cả hai đều tắt)."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (WATCHDOG.enabled or TRACER.enabled):
+                return func(*args, **kwargs)
+            with entry_span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,189 @@
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_local = threading.local()
+
+
+class RequestCancelled(Exception):
+    """Request đã bị huỷ (đổi card, đóng chat, đóng profile)."""
+
+
+class DeadlineExceeded(RequestCancelled):
+    """Request bị huỷ vì hết thời hạn tổng (connect + chờ server + retry)."""
+
+
+class CancelToken:
+    """Huỷ được một request đang chạy, kể cả khi nó đang chờ server trả lời.
+
+    Các connection mà request đang giữ được ghi lại; cancel() shutdown socket
+    của chúng nên lệnh recv đang block trả về ngay, thread được giải phóng.
+    Token có thể có deadline: hết hạn thì tự huỷ (expired = True).
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.callbacks = []
+        self.deadline = None # time.monotonic() lúc hết hạn
+        self.expired = False
+        self.timer = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            connections = list(self.connections)
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback()
+        for conn in connections:
+            sock = getattr(conn, "sock", None)
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def add_callback(self, callback):
+        """Gọi callback() khi bị huỷ (ngay lập tức nếu đã bị huỷ)."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def check(self):
+        if self.cancelled:
+            raise DeadlineExceeded() if self.expired else RequestCancelled()
+
+    def sleep(self, seconds):
+        """time.sleep nhưng dừng ngay khi bị huỷ (backoff giữa các lần retry)."""
+        if self.event.wait(seconds):
+            self.check()
+
+    # ---------- deadline ----------
+    def set_deadline(self, seconds):
+        """Tự huỷ sau seconds giây, kể cả khi đang chờ server trả lời."""
+        self.clear_deadline()
+        self.deadline = time.monotonic() + seconds
+        self.timer = threading.Timer(seconds, self._expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def clear_deadline(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.deadline = None
+
+    def _expire(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.expired = True
+        self.cancel()
+
+    def remaining(self, cap):
+        """Timeout cho một bước (connect, read...): cap, nhưng không vượt deadline."""
+        if self.deadline is not None:
+            left = self.deadline - time.monotonic()
+            if left <= 0:
+                self._expire()
+            cap = min(cap, left)
+        self.check()
+        return cap
+
+    def can_wait(self, seconds):
+        """Còn đủ thời gian để chờ seconds giây (backoff) rồi thử lại không."""
+        return self.deadline is None or self.deadline - time.monotonic() > seconds
+
+    def _track(self, conn):
+        with self.lock:
+            if self.cancelled:
+                raise RequestCancelled()
+            self.connections.add(conn)
+
+    def _untrack(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+
+
+def current_token():
+    """CancelToken của request đang chạy trên thread này (hoặc None)."""
+    return getattr(_local, "token", None)
+
+
+class use_token:
+    """Context manager: gắn CancelToken cho các request HTTP trên thread hiện tại."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __enter__(self):
+        self.previous = current_token()
+        _local.token = self.token
+        return self.token
+
+    def __exit__(self, *exc):
+        _local.token = self.previous
+
+
+class _TrackedPoolMixin:
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        token = current_token()
+        if token is not None:
+            try:
+                token._track(conn)
+            except RequestCancelled:
+                super()._put_conn(conn)
+                raise
+        return conn
+
+    def _put_conn(self, conn):
+        token = current_token()
+        if token is not None and conn is not None:
+            token._untrack(conn)
+        super()._put_conn(conn)
+
+
+class _TrackedHTTPPool(_TrackedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _TrackedHTTPSPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class CancellableAdapter(HTTPAdapter):
+    """HTTPAdapter có connection pool báo connection đang dùng cho CancelToken."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TrackedHTTPPool, "https": _TrackedHTTPSPool}
+
+
+def create_session():
+    """requests.Session dùng chung (giữ keep-alive) với connection huỷ được."""
+    session = requests.Session()
+    adapter = CancellableAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
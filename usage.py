@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+
+# Loại request: chat (người dùng đang chờ), prefetch và bulk (chạy nền)
+REQUEST_CLASSES = ("chat", "prefetch", "bulk")
+BACKGROUND_CLASSES = ("prefetch", "bulk")
+
+# Chỉ giữ số liệu gần đây (đủ cho ngân sách tháng và báo cáo)
+RETENTION_DAYS = 100
+
+# ~4 ký tự / token, như batching.estimate_tokens
+CHARS_PER_TOKEN = 4
+
+# Gemini tính ~258 token cho mỗi ảnh ≤ 768 px (ImageCache thu nhỏ về cỡ này)
+IMAGE_TOKENS = 258
+
+
+def _today():
+    return time.strftime("%Y-%m-%d")
+
+
+def usage_tokens(usage):
+    """(prompt, output, cached) token từ usageMetadata; output gồm cả thinking token."""
+    usage = usage or {}
+    output = usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
+    return usage.get("promptTokenCount", 0), output, usage.get("cachedContentTokenCount", 0)
+
+
+def estimate_payload_tokens(payload):
+    """Ước lượng token tối đa của một request: input + maxOutputTokens.
+
+    Ảnh (inlineData) tính theo IMAGE_TOKENS, không theo độ dài base64.
+    """
+    contents = payload.get("contents", [])
+    images = sum(1 for content in contents for part in content.get("parts", []) if "inlineData" in part)
+    if images:
+        contents = [{**content, "parts": [part for part in content.get("parts", []) if "inlineData" not in part]}
+                    for content in contents]
+    text = json.dumps(contents, ensure_ascii=False)
+    max_output = payload.get("generationConfig", {}).get("maxOutputTokens", 0)
+    return len(text) // CHARS_PER_TOKEN + 1 + images * IMAGE_TOKENS + max_output
+
+
+class UsageStore:
+    """Token đã dùng, gộp theo (ngày, loại request, deck, prompt key) trong SQLite.
+
+    Mỗi tổ hợp chỉ có một dòng mỗi ngày nên bảng nhỏ; dòng cũ hơn
+    RETENTION_DAYS bị xoá khi sang ngày mới. Tổng hôm nay / tháng này được giữ
+    trong bộ nhớ để kiểm tra ngân sách không phải query mỗi request.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage_daily ("
+            "day TEXT, request_class TEXT, deck_id TEXT, prompt_key TEXT, "
+            "requests INTEGER, prompt_tokens INTEGER, output_tokens INTEGER, cached_tokens INTEGER, "
+            "PRIMARY KEY (day, request_class, deck_id, prompt_key)) WITHOUT ROWID"
+        )
+        self.period_day = None
+        self.day_total = 0
+        self.month_total = 0
+
+    def record(self, usage, request_class="chat", deck_id=None, prompt_key=None):
+        """Cộng usageMetadata của một request vào dòng của ngày hôm nay."""
+        if not usage:
+            return
+        prompt, output, cached = usage_tokens(usage)
+        day = _today()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO usage_daily VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (day, request_class, deck_id, prompt_key) DO UPDATE SET "
+                "requests = requests + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "output_tokens = output_tokens + excluded.output_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens",
+                (day, request_class, str(deck_id or "-"), prompt_key or "-", prompt, output, cached),
+            )
+            if self.period_day == day:
+                self.day_total += prompt + output
+                self.month_total += prompt + output
+
+    def totals(self):
+        """(token hôm nay, token tháng này)."""
+        day = _today()
+        with self.lock:
+            if self.period_day != day:
+                self.period_day = day
+                self.day_total = self._sum(day)
+                self.month_total = self._sum(day[:8] + "01")
+                cutoff = time.strftime("%Y-%m-%d", time.localtime(time.time() - RETENTION_DAYS * 86400))
+                self.conn.execute("DELETE FROM usage_daily WHERE day < ?", (cutoff,))
+            return self.day_total, self.month_total
+
+    def reload(self):
+        """Đọc lại tổng từ database ở lần totals() sau (process khác cũng ghi vào bảng)."""
+        with self.lock:
+            self.period_day = None
+
+    def _sum(self, since_day):
+        row = self.conn.execute(
+            "SELECT SUM(prompt_tokens + output_tokens) FROM usage_daily WHERE day >= ?", (since_day,)
+        ).fetchone()
+        return row[0] or 0
+
+    def breakdown(self, group_by, since_day=None):
+        """[(giá trị cột group_by, requests, prompt, output, cached)] từ since_day (mặc định đầu tháng)."""
+        if group_by not in ("request_class", "deck_id", "prompt_key", "day"):
+            raise ValueError(group_by)
+        since_day = since_day or _today()[:8] + "01"
+        return self.conn.execute(
+            f"SELECT {group_by}, SUM(requests), SUM(prompt_tokens), SUM(output_tokens), SUM(cached_tokens) "
+            f"FROM usage_daily WHERE day >= ? GROUP BY {group_by} "
+            "ORDER BY SUM(prompt_tokens + output_tokens) DESC",
+            (since_day,),
+        ).fetchall()
+
+
+class BudgetExceeded(Exception):
+    """Request không được gửi vì sẽ vượt ngân sách token."""
+
+    def __init__(self, request_class, period):
+        super().__init__(f"{period} token budget reached ({request_class})")
+        self.request_class = request_class
+        self.period = period # "daily" hoặc "monthly"
+
+
+class TokenBudget:
+    """Ngân sách token theo ngày / tháng (config, 0 = không giới hạn).
+
+    Một phần ngân sách (budget_chat_reserve) chỉ dành cho chat: prefetch và
+    bulk dừng khi phần còn lại đã dùng hết, nên job nền không bao giờ làm chat
+    hết quota. Khi đã dùng quá THROTTLE_START phần ngân sách của mình, request
+    nền bị giãn dần (tối đa MAX_THROTTLE_DELAY giây) để không đốt hết quota
+    trong một lần chạy.
+    """
+
+    THROTTLE_START = 0.8
+    MAX_THROTTLE_DELAY = 20.0
+
+    def __init__(self, store, get_config):
+        self.store = store
+        self.get_config = get_config
+
+    def _limits(self, request_class):
+        config = self.get_config()
+        share = 1.0
+        if request_class in BACKGROUND_CLASSES:
+            reserve = min(max(float(config.get("budget_chat_reserve", 0.2)), 0.0), 1.0)
+            share = 1.0 - reserve
+        return (
+            ("daily", int(config.get("daily_token_budget", 0) or 0) * share),
+            ("monthly", int(config.get("monthly_token_budget", 0) or 0) * share),
+        )
+
+    def admit(self, request_class, estimated_tokens=0):
+        """Số giây cần chờ trước khi gửi request (0 = gửi ngay).
+
+        Raise BudgetExceeded nếu request sẽ vượt ngân sách của loại request này.
+        """
+        day_used, month_used = self.store.totals()
+        used = {"daily": day_used, "monthly": month_used}
+        fraction = 0.0
+        for period, limit in self._limits(request_class):
+            if limit <= 0:
+                continue
+            if used[period] + estimated_tokens > limit:
+                raise BudgetExceeded(request_class, period)
+            fraction = max(fraction, used[period] / limit)
+        if request_class not in BACKGROUND_CLASSES or fraction <= self.THROTTLE_START:
+            return 0.0
+        return self.MAX_THROTTLE_DELAY * (fraction - self.THROTTLE_START) / (1 - self.THROTTLE_START)
+
+    def status(self):
+        """[(period, used, limit)] cho các ngân sách đang bật."""
+        day_used, month_used = self.store.totals()
+        config = self.get_config()
+        lines = []
+        for period, used, key in (("daily", day_used, "daily_token_budget"),
+                                  ("monthly", month_used, "monthly_token_budget")):
+            limit = int(config.get(key, 0) or 0)
+            if limit > 0:
+                lines.append((period, used, limit))
+        return lines
+
+
+def usage_report(store, budget=None, deck_name=str):
+    """Token tháng này theo loại request, deck và prompt key, kèm trạng thái ngân sách."""
+    day_used, month_used = store.totals()
+    lines = [f"Today: {day_used:,} tokens", f"This month: {month_used:,} tokens"]
+    if budget is not None:
+        for period, used, limit in budget.status():
+            lines.append(f"Budget ({period}): {used:,} / {limit:,} ({used / limit:.0%})")
+    groups = (("By request class", "request_class", str), ("By deck", "deck_id", deck_name),
+              ("By prompt", "prompt_key", str))
+    for title, group_by, label in groups:
+        rows = store.breakdown(group_by)[:10]
+        if rows:
+            lines.append(f"{title}:")
+        for value, requests, prompt, output, cached in rows:
+            lines.append(
+                f"  {label(value)}: {requests} requests, {prompt:,} prompt "
+                f"({cached:,} cached) / {output:,} output tokens"
+            )
+    return lines